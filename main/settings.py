@@ -25,6 +25,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'upsets.middleware.RequestMetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -97,6 +98,68 @@ else:
     }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# The default local memory cache is per process, use a shared backend (like
+# memcached or the database cache) to benefit from the prerendered paths.
+
+CACHES = {
+    'default': {
+        'BACKEND': config(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=10000,
+                                  cast=int),
+        }
+    }
+}
+
+# Upset paths only change with a new tree, which is rebuilt every night
+UPSET_PATH_CACHE_TIMEOUT = config(
+    'UPSET_PATH_CACHE_TIMEOUT', default=60 * 60 * 48, cast=int)
+
+# Number of seconds a web process trusts its resolved ready tree containers
+# before checking the DB again for a new tree
+TREE_CONTAINER_TTL = config('TREE_CONTAINER_TTL', default=60, cast=int)
+
+# The player the upset paths lead to when no root is requested, and the root
+# players whose trees update_data builds
+DEFAULT_ROOT_PLAYER_ID = config('DEFAULT_ROOT_PLAYER_ID', default='222927')
+TREE_ROOT_PLAYER_IDS = config(
+    'TREE_ROOT_PLAYER_IDS', default=DEFAULT_ROOT_PLAYER_ID, cast=Csv())
+
+# The maximum number of players whose paths can be requested at once, see
+# the upsets/playerpaths/ endpoint
+PLAYER_PATHS_MAX_IDS = config('PLAYER_PATHS_MAX_IDS', default=100, cast=int)
+
+# Directory of the binary snapshots of the trees, written by update_data
+# and memory mapped by the web processes to answer the player paths without
+# DB queries, see upsets.lib.treesnapshot. Empty disables the snapshots.
+TREE_SNAPSHOT_DIR = config('TREE_SNAPSHOT_DIR', default='')
+
+# Serve the player search from an in-process index instead of the DB, see
+# upsets.lib.searchindex. The index is rebuilt after a new tree or once it
+# is older than PLAYER_SEARCH_INDEX_MAX_AGE seconds.
+PLAYER_SEARCH_INDEX = config('PLAYER_SEARCH_INDEX', default=False, cast=bool)
+PLAYER_SEARCH_INDEX_MAX_AGE = config(
+    'PLAYER_SEARCH_INDEX_MAX_AGE', default=60 * 60 * 6, cast=int)
+
+# The pair paths endpoint answers from an in-process graph of all the sets,
+# loaded on first use (or at warmup with UPSET_GRAPH_WARMUP) and reloaded
+# in the background after each new tree or once older than
+# UPSET_GRAPH_MAX_AGE seconds.
+UPSET_GRAPH_WARMUP = config('UPSET_GRAPH_WARMUP', default=False, cast=bool)
+UPSET_GRAPH_MAX_AGE = config(
+    'UPSET_GRAPH_MAX_AGE', default=60 * 60 * 6, cast=int)
+
+# Fraction of the API requests measured by RequestMetricsMiddleware, their
+# timings are sent in a Server-Timing header and aggregated in the process,
+# see the upsets/stats/requests/ endpoint. 0 disables the measures.
+REQUEST_METRICS_SAMPLE_RATE = config(
+    'REQUEST_METRICS_SAMPLE_RATE', default=0., cast=float)
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
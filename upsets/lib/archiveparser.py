@@ -0,0 +1,140 @@
+# Parsing of the sets rows of a PlayerDatabase sqlite export. This module
+# doesn't import Django so that its functions can run in the worker
+# processes of a multiprocessing pool, whatever their start method.
+import ast
+import json
+import sqlite3
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+# The Set fields of the tuples returned by parse_set_row, in order
+SET_FIELDS = ('id', 'tournament_id', 'winner_id', 'loser_id', 'winner_score',
+              'loser_score', 'round_name', 'best_of', 'winner_characters',
+              'loser_characters')
+
+# The JSON literals which must not appear outside of the strings of a value
+# for it to be loaded as JSON, python doesn't accept them
+_JSON_ONLY_LITERALS = ('null', 'true', 'false', 'NaN', 'Infinity')
+
+
+def literal_loads(value):
+    """Return the python object of the repr of a list, dict, string or scalar
+
+    The result is the same as ast.literal_eval, but the values JSON can
+    hold are converted to JSON and loaded by the C json decoder, which is
+    several times faster. Without double quotes and backslashes, the single
+    quotes delimit all the strings, so that the keywords outside of them can
+    be safely converted. Any other value is evaluated by ast, which also
+    raises a ValueError for a NULL value.
+    """
+    if not isinstance(value, str):
+        return ast.literal_eval(value)
+    if '"' in value or '\\' in value:
+        return ast.literal_eval(value)
+    parts = value.split("'")
+    # The even parts are out of the strings
+    structure = parts[0::2]
+    joined = ''.join(structure)
+    if any(literal in joined for literal in _JSON_ONLY_LITERALS):
+        return ast.literal_eval(value)
+    parts[0::2] = [part.replace('None', 'null')
+                   .replace('True', 'true')
+                   .replace('False', 'false') for part in structure]
+    try:
+        return json.loads('"'.join(parts))
+    except ValueError:
+        # Not JSON (a tuple, a trailing comma...) or malformed, let ast
+        # evaluate it or fail like it does
+        return ast.literal_eval(value)
+
+
+def parse_round_name(location_names):
+    """Return the last location name of a location_names value
+    """
+    return literal_loads(location_names)[-1]
+
+
+def parse_games(game_data):
+    """Return the (winner id, winner char, loser char) of each game of a
+    game_data value
+
+    The winner ids are returned as strings, as str() gives them. A
+    ValueError is raised if the value is malformed.
+    """
+    return [(str(game['winner_id']), game['winner_char'], game['loser_char'])
+            for game in literal_loads(game_data)]
+
+
+def literal_eval_games(game_data):
+    """The reference implementation of parse_games, with ast.literal_eval,
+    kept for the benchmarks
+    """
+    return [(str(game['winner_id']), game['winner_char'], game['loser_char'])
+            for game in ast.literal_eval(game_data)]
+
+
+def parse_set_row(row):
+    """Return the Set field values, see SET_FIELDS, of a sets table row
+
+    The row holds the key, tournament_key, winner_id, p1_id, p2_id,
+    p1_score, p2_score, location_names, best_of and game_data columns.
+    """
+    (key, tournament_key, winner_id, p1_id, p2_id, p1_score, p2_score,
+     location_names, best_of, game_data) = row
+    loser_id = winner_score = loser_score = None
+    if winner_id == p1_id:
+        # winner is player 1
+        loser_id = p2_id
+        winner_score = p1_score
+        loser_score = p2_score
+    elif winner_id == p2_id:
+        # winner is player 2
+        loser_id = p1_id
+        winner_score = p2_score
+        loser_score = p1_score
+    else:
+        logger.warning(
+            'winner_id does not match p1_id or p2_id on set %s' % key)
+        winner_id = None
+    round_name = parse_round_name(location_names)
+    winner_characters = []
+    loser_characters = []
+    try:
+        for (game_winner_id, game_winner_char, game_loser_char) in \
+                parse_games(game_data):
+            (game_winner_char, game_loser_char) = (
+                (game_winner_char.replace('ultimate/', '')),
+                (game_loser_char.replace('ultimate/', '')))
+            if game_winner_id == str(winner_id):
+                set_winner_char = game_winner_char
+                set_loser_char = game_loser_char
+            else:
+                set_winner_char = game_loser_char
+                set_loser_char = game_winner_char
+            if set_winner_char not in winner_characters:
+                winner_characters.append(set_winner_char)
+            if set_loser_char not in loser_characters:
+                loser_characters.append(set_loser_char)
+    except ValueError as ex:
+        # Ignore the malformed values
+        logger.debug(ex)
+    return (key, tournament_key, winner_id, loser_id, winner_score,
+            loser_score, round_name, best_of, winner_characters,
+            loser_characters)
+
+
+def parse_sets_range(db_file, query, start, end):
+    """Run the sets query on the rowid range [start, end) of the sets table
+    and return the parsed rows
+
+    The query must end with a WHERE clause, it is run in its own sqlite
+    connection so that it can be called in a worker process.
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        rows = conn.execute(
+            query + " AND sets.rowid >= ? AND sets.rowid < ?", (start, end))
+        return [parse_set_row(row) for row in rows]
+    finally:
+        conn.close()
@@ -0,0 +1,112 @@
+import threading
+import time
+from django.conf import settings
+from upsets.models import TreeContainer
+
+
+class TreeContainerRegistry:
+    """A process-local registry of the current ready tree containers
+
+    Resolving the ready container is needed by every path request, but it
+    only changes once a night. The registry keeps the current container of
+    each root player and mode in memory and checks the DB again only once
+    its entry is older than the ttl. The root player defaults to the
+    DEFAULT_ROOT_PLAYER_ID setting. The roots without ready tree are only
+    kept if they are configured, see TREE_ROOT_PLAYER_IDS, so that the
+    requests for random roots don't fill the registry. Each time a new
+    container or a new revision of the container is seen, the generation
+    counter is incremented, which gives other process-local structures a
+    cheap way to detect a new tree.
+
+    Attributes
+    ----------
+    generation: int
+        Incremented every time the container of a root and mode or its
+        revision changes
+    _ttl: float
+        The number of seconds a resolved container is trusted
+    _entries: dict
+        (root player id, offline_only) -> (container or None, resolution
+        monotonic time)
+    _lock: threading.Lock
+        Protects the entries and the generation between threads
+
+    Methods
+    -------
+    get(offline_only, root)
+        Return the current ready container of the root and mode, None if no
+        tree
+    reload(offline_only, root)
+        Resolve again the ready container of the root and mode from the DB
+    refresh()
+        Resolve again the ready containers of the configured roots
+    invalidate()
+        Forget all the resolved containers
+    """
+
+    def __init__(self, ttl=None):
+        self.generation = 0
+        self._ttl = settings.TREE_CONTAINER_TTL if ttl is None else ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, offline_only, root=None):
+        """Return the current ready container of the root and mode, None if
+        no tree
+        """
+        key = (root or settings.DEFAULT_ROOT_PLAYER_ID, offline_only)
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[1] > self._ttl:
+            return self.reload(offline_only, root)
+        return entry[0]
+
+    def reload(self, offline_only, root=None):
+        """Resolve again the ready container of the root and mode from the
+        DB
+        """
+        root = root or settings.DEFAULT_ROOT_PLAYER_ID
+        key = (root, offline_only)
+        container = TreeContainer.objects \
+            .filter(ready=True) \
+            .filter(offline_only=offline_only, root_player_id=root) \
+            .order_by('-update_date') \
+            .first()
+        with self._lock:
+            previous = self._entries.get(key)
+            if container is None and previous is None \
+                    and root not in _configured_roots():
+                return None
+            if previous is None or _container_version(previous[0]) != \
+                    _container_version(container):
+                self.generation += 1
+            self._entries[key] = (container, time.monotonic())
+        return container
+
+    def refresh(self):
+        """Resolve again the ready containers of both modes of the
+        configured roots
+        """
+        for root in _configured_roots():
+            for offline_only in (False, True):
+                self.reload(offline_only, root)
+
+    def invalidate(self):
+        """Forget all the resolved containers
+        """
+        with self._lock:
+            self._entries = {}
+            self.generation += 1
+
+
+def _configured_roots():
+    return {settings.DEFAULT_ROOT_PLAYER_ID, *settings.TREE_ROOT_PLAYER_IDS}
+
+
+def _container_version(container):
+    if container is None:
+        return None
+    return (container.id, container.revision)
+
+
+# The registry shared by the whole process
+container_registry = TreeContainerRegistry()
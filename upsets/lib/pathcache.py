@@ -0,0 +1,118 @@
+import hashlib
+from django.conf import settings
+from django.core.cache import cache
+from upsets.models import UpsetTreeNode
+from upsets.serializers import UpsetTreeNodeSerializer
+from utils.orm_operators import keyset_iterator
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+
+class UpsetPathCache:
+    """A cache of the upset path responses, versioned by tree container
+
+    A player path can only change when a new TreeContainer becomes ready or
+    when the ready one is updated in place, so the responses are cached
+    under keys containing the container id and revision. When update_tree
+    swaps or updates the containers, the API resolves the new container and
+    thus new keys: the old entries are never read again and simply expire.
+
+    Attributes
+    ----------
+    _timeout: int
+        The cache entries timeout, in seconds
+
+    Methods
+    -------
+    get(player_id, container)
+        Return the cached response data, or None
+    set(player_id, container, data)
+        Cache the response data of a player path
+    get_many(player_ids, container)
+        Return the cached response data of the players which have one
+    set_many(paths, container)
+        Cache the response data of several player paths
+    prerender(container)
+        Serialize and cache the path of every node of the given container
+    """
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout or settings.UPSET_PATH_CACHE_TIMEOUT
+
+    @staticmethod
+    def _key(player_id, container):
+        # The player id comes from the URL, it is hashed so that the key is
+        # valid for every cache backend (memcached refuses spaces, control
+        # characters and keys over 250 characters)
+        return 'upsetpath:%s:%s:%s:%s' % (
+            container.id, container.revision, int(container.offline_only),
+            hashlib.sha1(player_id.encode()).hexdigest())
+
+    def get(self, player_id, container):
+        """Return the cached response data, or None
+        """
+        return cache.get(self._key(player_id, container))
+
+    def set(self, player_id, container, data):
+        """Cache the response data of a player path
+        """
+        cache.set(self._key(player_id, container), data, self._timeout)
+
+    def get_many(self, player_ids, container):
+        """Return the cached response data of the players which have one,
+        by player id
+        """
+        keys = {self._key(player_id, container): player_id
+                for player_id in player_ids}
+        return {keys[key]: data
+                for key, data in cache.get_many(list(keys)).items()}
+
+    def set_many(self, paths, container):
+        """Cache the response data of several player paths, given by player
+        id
+        """
+        cache.set_many({self._key(player_id, container): data
+                        for player_id, data in paths.items()}, self._timeout)
+
+    def prerender(self, container, batch_size=1000):
+        """Serialize and cache the path of every node of the given container
+
+        The tree is walked layer by layer: each node is serialized once and
+        its path is its own hop followed by the already built path of its
+        parent, so only two layers of paths are held in memory at a time.
+        """
+        parent_paths = {}
+        depth = 0
+        count = 0
+        while True:
+            nodes = UpsetTreeNode.objects \
+                .filter(tree_container=container, node_depth=depth) \
+                .select_related('player', 'upset__tournament',
+                                'upset__winner', 'upset__loser')
+            paths = {}
+            batch = {}
+            for node in keyset_iterator(
+                    nodes, chunk_size=batch_size, prefetch_next=True):
+                if node.parent_id is None:
+                    path = []
+                else:
+                    path = [UpsetTreeNodeSerializer(node).data] \
+                        + parent_paths[node.parent_id]
+                paths[node.id] = path
+                batch[self._key(node.player_id, container)] = {
+                    'player_tag': node.player.tag,
+                    'offline_only': container.offline_only,
+                    'path_exist': True,
+                    'path': path}
+                if len(batch) >= batch_size:
+                    cache.set_many(batch, self._timeout)
+                    batch = {}
+            if batch:
+                cache.set_many(batch, self._timeout)
+            if not paths:
+                break
+            count += len(paths)
+            parent_paths = paths
+            depth += 1
+        logger.info('Prerendered %s upset paths.' % count)
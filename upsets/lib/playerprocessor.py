@@ -0,0 +1,176 @@
+import time
+from django.db import connection, transaction
+from upsets.models import Player
+from utils.decorators import time_it
+from utils.instrumentation import current_phase, record_batch
+from utils.orm_operators import BulkBatchManager, keyset_iterator
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+
+# Computes the processed fields of a batch of players, the ones following
+# %(after)s by id (only the ones needing processing if %(incremental)s),
+# and writes them in a single UPDATE. The last id of the batch is returned
+# for the next one. The wins and loses of the players are gathered as
+# appearances so that each set counts once per side, like the Python
+# methods do with the prefetched wins and loses.
+_UPDATE_BATCH = """
+    WITH batch AS (
+        SELECT id FROM upsets_player
+        WHERE (%(after)s::varchar IS NULL OR id > %(after)s)
+            AND (NOT %(incremental)s OR needs_processing)
+        ORDER BY id
+        LIMIT %(batch_size)s
+    ), appearances AS (
+        SELECT batch.id AS player_id, s.winner_characters AS characters,
+            s.tournament_id
+        FROM batch JOIN upsets_set s ON s.winner_id = batch.id
+        UNION ALL
+        SELECT batch.id, s.loser_characters, s.tournament_id
+        FROM batch JOIN upsets_set s ON s.loser_id = batch.id
+    ), played AS (
+        SELECT player_id, COUNT(*) AS played_sets_count
+        FROM appearances
+        GROUP BY player_id
+    ), characters AS (
+        SELECT DISTINCT ON (player_id) player_id, main_character
+        FROM (
+            SELECT player_id, character AS main_character,
+                COUNT(*) AS count
+            FROM appearances, UNNEST(characters) AS character
+            GROUP BY player_id, character
+        ) counts
+        ORDER BY player_id, count DESC, main_character
+    ), tournaments AS (
+        SELECT DISTINCT ON (a.player_id) a.player_id,
+            t.id AS last_tournament_id
+        FROM appearances a JOIN upsets_tournament t ON t.id = a.tournament_id
+        ORDER BY a.player_id, t.start_date DESC NULLS LAST, t.id
+    ), updated AS (
+        UPDATE upsets_player p SET
+            played_sets_count = COALESCE(played.played_sets_count, 0),
+            main_character = COALESCE(
+                characters.main_character, p.main_character),
+            last_tournament_id = COALESCE(
+                tournaments.last_tournament_id, p.last_tournament_id),
+            needs_processing = false
+        FROM batch
+        LEFT JOIN played ON played.player_id = batch.id
+        LEFT JOIN characters ON characters.player_id = batch.id
+        LEFT JOIN tournaments ON tournaments.player_id = batch.id
+        WHERE p.id = batch.id
+        RETURNING p.id
+    )
+    SELECT (SELECT MAX(id) FROM batch), (SELECT COUNT(*) FROM updated)
+    """
+
+
+class PlayerProcessor:
+    """Update the processed fields of the players
+
+    The main character, last tournament and played sets count of the
+    players are derived from their sets. They can be computed by two
+    engines: 'python' loads the players with their prefetched wins and loses
+    and calls the Player update methods, 'sql' computes all the fields with
+    aggregate queries in the DB and writes them with one UPDATE per batch of
+    players, without loading them in Python.
+
+    Both engines give the same results, except for the ties: the 'python'
+    engine keeps the first character or tournament met in the sets, in the
+    DB order, the 'sql' engine the first one by name or by id. A tournament
+    without start date is also older than any other for the 'sql' engine.
+
+    The batches follow the player ids (keyset pagination). The 'sql' ones
+    are committed in their own transaction, so that the player rows are
+    only locked for the time of a batch.
+
+    In incremental mode, only the players marked as needing processing by
+    the imports are processed, see Player.needs_processing: the players of
+    the new and changed sets, including the previous players of the sets
+    whose players changed.
+
+    Attributes
+    ----------
+    _engine: str
+        The engine used to compute the fields, 'python' or 'sql'
+    _batch_size: int
+        The number of players processed at a time
+    _incremental: bool
+        Only process the players needing processing
+
+    Methods
+    -------
+    process_all()
+        Update the processed fields of all the players, or only the ones
+        needing processing in incremental mode
+    """
+
+    ENGINES = ('python', 'sql')
+
+    def __init__(self, engine='python', batch_size=2000, incremental=False):
+        if engine not in self.ENGINES:
+            raise ValueError('Unknown player processing engine %s, possibles'
+                             ' are %s.' % (engine, ', '.join(self.ENGINES)))
+        self._engine = engine
+        self._batch_size = batch_size
+        self._incremental = incremental
+
+    @time_it(logger)
+    def process_all(self):
+        """Update the processed fields of all the players, or only the ones
+        needing processing in incremental mode
+
+        Return the number of processed players.
+        """
+        if self._engine == 'sql':
+            processed = self._process_sql()
+        else:
+            processed = self._process_python()
+        current_phase().rows = processed
+        return processed
+
+    def _process_python(self):
+        # The players are loaded by pages following the primary keys, with
+        # their wins and loses prefetched, see keyset_iterator. Offsets would
+        # shift as the processed players are unmarked.
+        queryset = Player.objects \
+            .prefetch_related('wins__tournament', 'loses__tournament')
+        if self._incremental:
+            queryset = queryset.filter(needs_processing=True)
+
+        processed = 0
+
+        def player_generator(players):
+            nonlocal processed
+            for player in players:
+                player.update_main_character()
+                player.update_last_tournament()
+                player.update_played_sets_count()
+                player.needs_processing = False
+                processed += 1
+                yield player
+
+        batcher = BulkBatchManager(Player, logger=logger)
+        batcher.bulk_update(
+            player_generator(keyset_iterator(
+                queryset, chunk_size=self._batch_size, prefetch_next=True)),
+            ['main_character', 'last_tournament', 'played_sets_count',
+             'needs_processing'])
+        return processed
+
+    def _process_sql(self):
+        processed = 0
+        after = None
+        while True:
+            ts = time.perf_counter()
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(_UPDATE_BATCH, {
+                    'after': after, 'batch_size': self._batch_size,
+                    'incremental': self._incremental})
+                (after, count) = cursor.fetchone()
+            if not count:
+                return processed
+            record_batch('Player', count, time.perf_counter() - ts)
+            processed += count
+            logger.info('Processed %s players' % processed)
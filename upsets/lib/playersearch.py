@@ -0,0 +1,88 @@
+from django.contrib.postgres.lookups import Unaccent
+from django.db import connection
+from django.db.models import BooleanField, Case, Value, When
+from django.db.models.functions import Upper
+from upsets.models import Player
+
+
+def normalize(expression):
+    """Return the expression normalized the way the player search compares
+    tags: unaccented, then upper cased, exactly like the tag__unaccent__i*
+    lookups do.
+    """
+    return Upper(Unaccent(expression))
+
+
+def normalize_term(term):
+    """Return the search term normalized by the DB, as a plain string
+
+    UNACCENT is only STABLE, a LIKE on UPPER(UNACCENT(term)) can't use the
+    btree pattern index, while one on a literal can.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT UPPER(UNACCENT(%s))', [term])
+        return cursor.fetchone()[0]
+
+
+def search_players(term, limit=20):
+    """Return the players whose tag matches the term, best matches first
+
+    Exact matches come first, then the tags beginning with the term, then
+    the ones containing it, each group ordered by played sets count. The
+    matching runs on the stored normalized Player.search_tag column: the
+    prefix matches are served by a btree pattern index, and when they
+    already fill the limit (the common autocomplete case) the contains
+    matches can't make it to the results so we stop there. Otherwise the
+    contains query uses the trigram index.
+    """
+    normalized_term = normalize_term(term)
+    is_exact = Case(
+        When(search_tag=normalized_term, then=Value(True)),
+        default=False,
+        output_field=BooleanField())
+
+    players = list(
+        Player.objects
+        .filter(search_tag__startswith=normalized_term)
+        .annotate(is_exact=is_exact)
+        .select_related('last_tournament')
+        .order_by('-is_exact', '-played_sets_count')[:limit])
+    if len(players) == limit:
+        return players
+
+    return list(
+        Player.objects
+        .filter(search_tag__contains=normalized_term)
+        .annotate(
+            is_start=Case(
+                When(search_tag__startswith=normalized_term,
+                     then=Value(True)),
+                default=False,
+                output_field=BooleanField()),
+            is_exact=is_exact)
+        .select_related('last_tournament')
+        .order_by('-is_exact', '-is_start', '-played_sets_count')[:limit])
+
+
+def scan_search_players(term, limit=20):
+    """The original player search, normalizing every tag on the fly
+
+    It can't use any index and scans the whole Player table. It is kept as
+    the reference implementation for the benchmarks.
+    """
+    return list(
+        Player.objects
+        .filter(tag__unaccent__icontains=term)
+        .annotate(
+            is_start=Case(
+                When(tag__unaccent__istartswith=term,
+                     then=Value(True)),
+                default=False,
+                output_field=BooleanField()),
+            is_exact=Case(
+                When(tag__unaccent__iexact=term,
+                     then=Value(True)),
+                default=False,
+                output_field=BooleanField()))
+        .select_related('last_tournament')
+        .order_by('-is_exact', '-is_start', '-played_sets_count')[:limit])
@@ -0,0 +1,151 @@
+from bisect import bisect_left
+import math
+import threading
+
+
+class DurationHistogram:
+    """Counts of durations in log scaled buckets
+
+    The bucket bounds grow by 25% from 0.1ms to about 100s, so that the
+    percentiles are known within 25% with a fixed and small memory, whatever
+    the number of recorded durations.
+
+    Attributes
+    ----------
+    count: int
+        The number of recorded durations
+    total: float
+        The sum of the recorded durations, in seconds
+    maximum: float
+        The greatest recorded duration, in seconds
+    _counts: list of int
+        The number of durations of each bucket, the last one holding the
+        durations greater than all the bounds
+
+    Methods
+    -------
+    add(duration)
+        Record a duration, in seconds
+    percentile(fraction)
+        Return the duration, in seconds, under which the given fraction of
+        the recorded durations are
+    """
+    # The upper bound of each bucket, in seconds
+    BOUNDS = [1e-4 * 1.25 ** i for i in range(63)]
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.maximum = 0.
+        self._counts = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, duration):
+        """Record a duration, in seconds
+        """
+        self._counts[bisect_left(self.BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.maximum = max(self.maximum, duration)
+
+    def percentile(self, fraction):
+        """Return the duration, in seconds, under which the given fraction of
+        the recorded durations are
+
+        The upper bound of the bucket of the percentile is returned, or the
+        greatest duration when it is lower.
+        """
+        if not self.count:
+            return None
+        rank = max(math.ceil(fraction * self.count), 1)
+        seen = 0
+        for (index, count) in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                if index == len(self.BOUNDS):
+                    return self.maximum
+                return min(self.BOUNDS[index], self.maximum)
+
+
+class RequestMetrics:
+    """The in-process aggregated metrics of the sampled API requests
+
+    For each endpoint (URL route), the total, DB, serialization and render
+    durations of the requests are counted in histograms, along with their
+    SQL queries. Each process aggregates its own requests.
+
+    Attributes
+    ----------
+    _endpoints: dict
+        route -> dict of the histograms and queries count of the endpoint
+    _lock: threading.Lock
+        Guards the updates of the metrics, the requests can be served by
+        several threads
+
+    Methods
+    -------
+    record(endpoint, total, db_time, queries, serialize_time, render_time)
+        Record the durations, in seconds, and queries of a request
+    stats()
+        Return the percentiles of the durations of each endpoint
+    reset()
+        Forget all the recorded requests
+    """
+
+    def __init__(self):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, total, db_time, queries, serialize_time,
+               render_time):
+        """Record the durations, in seconds, and queries of a request
+        """
+        with self._lock:
+            metrics = self._endpoints.get(endpoint)
+            if metrics is None:
+                metrics = self._endpoints[endpoint] = {
+                    'total': DurationHistogram(),
+                    'db': DurationHistogram(),
+                    'serialize': DurationHistogram(),
+                    'render': DurationHistogram(),
+                    'queries': 0}
+            metrics['total'].add(total)
+            metrics['db'].add(db_time)
+            metrics['serialize'].add(serialize_time)
+            metrics['render'].add(render_time)
+            metrics['queries'] += queries
+
+    def stats(self):
+        """Return the percentiles of the durations of each endpoint, in
+        milliseconds
+        """
+        def milliseconds(value):
+            return None if value is None else round(value * 1000, 2)
+
+        stats = {}
+        with self._lock:
+            for (endpoint, metrics) in self._endpoints.items():
+                count = metrics['total'].count
+                stats[endpoint] = {
+                    'count': count,
+                    'queries_per_request':
+                        round(metrics['queries'] / count, 2),
+                }
+                for name in ('total', 'db', 'serialize', 'render'):
+                    histogram = metrics[name]
+                    stats[endpoint][name] = {
+                        'mean': milliseconds(histogram.total / count),
+                        'p50': milliseconds(histogram.percentile(0.5)),
+                        'p95': milliseconds(histogram.percentile(0.95)),
+                        'p99': milliseconds(histogram.percentile(0.99)),
+                        'max': milliseconds(histogram.maximum)}
+        return stats
+
+    def reset(self):
+        """Forget all the recorded requests
+        """
+        with self._lock:
+            self._endpoints = {}
+
+
+# The metrics of the requests served by this process
+request_metrics = RequestMetrics()
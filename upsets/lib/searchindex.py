@@ -0,0 +1,311 @@
+from array import array
+from bisect import bisect_left, bisect_right
+import heapq
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.db.models.expressions import RawSQL
+from upsets.models import Player
+from upsets.lib.containers import container_registry
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+
+class _StringTable:
+    """An immutable sequence of strings packed in a single str
+
+    Holding a few hundred thousand short strings in one str with an offsets
+    array costs a fraction of the memory of a list of str objects. The
+    strings are separated by a NUL character, which Postgres text values
+    can't contain, so that substring searches can run on the whole blob.
+    """
+
+    def __init__(self, strings):
+        self._offsets = array('l', [0])
+        for string in strings:
+            self._offsets.append(self._offsets[-1] + len(string) + 1)
+        self._blob = '\0'.join(strings) + '\0'
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        return self._blob[self._offsets[index]:self._offsets[index + 1] - 1]
+
+    def find_all(self, term):
+        """Return the indexes of the strings containing the term
+        """
+        indexes = []
+        position = self._blob.find(term)
+        while position >= 0:
+            index = bisect_right(self._offsets, position) - 1
+            indexes.append(index)
+            position = self._blob.find(term, self._offsets[index + 1])
+        return indexes
+
+    def count(self, term):
+        """Return the number of occurrences of the term in the strings
+        """
+        return self._blob.count(term)
+
+
+class PlayerSearchIndex:
+    """An in-memory index answering the player search without the DB
+
+    The entries are sorted by normalized tag (the Player.search_tag column,
+    normalized by the DB) so that the prefix matches are a contiguous range
+    found by bisection. The contains matches of terms of 3 characters or
+    more are found through a trigram index of the normalized tags, shorter
+    terms scan them. The results are ranked exactly like search_players:
+    exact matches, then prefix matches, then contains matches, each by
+    played sets count.
+
+    Attributes
+    ----------
+    generation: int
+        The generation of the container registry when the index was built
+    built_at: float
+        The monotonic time of the build
+    _search_tags: _StringTable
+        The normalized tags, sorted
+    _ids, _tags: _StringTable
+        The id and tag of each entry
+    _characters: list of str
+        The distinct main characters
+    _entry_characters: array.array
+        The main character index of each entry, -1 for None
+    _counts: array.array
+        The played sets count of each entry
+    _tournaments: list of dict
+        The distinct serialized last tournaments
+    _entry_tournaments: array.array
+        The last tournament index of each entry, -1 for None
+    _by_count: array.array
+        The entries by decreasing played sets count
+    _trigrams: dict
+        trigram -> array.array of the entries containing it
+
+    Methods
+    -------
+    build(generation)
+        Load all the players from the DB and build the index
+    search(term, limit)
+        Return the serialized players matching the term
+    """
+    # Number of occurrences of a short term above which the best contains
+    # matches are looked for by decreasing count rather than all collected
+    SCAN_THRESHOLD = 1000
+
+    def __init__(self, rows, generation=None):
+        self.generation = generation
+        self.built_at = time.monotonic()
+        ids, tags, search_tags = [], [], []
+        characters = {}
+        tournaments = {}
+        self._entry_characters = array('l')
+        self._counts = array('l')
+        self._entry_tournaments = array('l')
+        self._trigrams = {}
+        for (player_id, tag, search_tag, main_character, played_sets_count,
+             tournament_id, tournament_name, tournament_date,
+             tournament_online) in rows:
+            index = len(ids)
+            ids.append(player_id)
+            tags.append(tag)
+            search_tags.append(search_tag)
+            self._counts.append(played_sets_count)
+            if main_character is None:
+                self._entry_characters.append(-1)
+            else:
+                self._entry_characters.append(
+                    characters.setdefault(main_character, len(characters)))
+            if tournament_id is None:
+                self._entry_tournaments.append(-1)
+            else:
+                if tournament_id not in tournaments:
+                    tournaments[tournament_id] = (len(tournaments), {
+                        'name': tournament_name,
+                        'start_date': tournament_date.isoformat()
+                        if tournament_date else None,
+                        'online': tournament_online})
+                self._entry_tournaments.append(tournaments[tournament_id][0])
+            for trigram in {search_tag[i:i + 3]
+                            for i in range(len(search_tag) - 2)}:
+                self._trigrams.setdefault(trigram, array('l')).append(index)
+        self._ids = _StringTable(ids)
+        self._tags = _StringTable(tags)
+        self._search_tags = _StringTable(search_tags)
+        self._by_count = array('l', sorted(
+            range(len(ids)), key=self._counts.__getitem__, reverse=True))
+        self._characters = list(characters)
+        self._tournaments = [data for (_, data) in sorted(
+            tournaments.values(), key=lambda k: k[0])]
+
+    @classmethod
+    def build(cls, generation=None):
+        """Load all the players from the DB and build the index
+        """
+        ts = time.monotonic()
+        rows = Player.objects \
+            .exclude(search_tag=None) \
+            .values_list('id', 'tag', 'search_tag', 'main_character',
+                         'played_sets_count', 'last_tournament_id',
+                         'last_tournament__name',
+                         'last_tournament__start_date',
+                         'last_tournament__online') \
+            .order_by(RawSQL('search_tag COLLATE "C"', ()).asc()) \
+            .iterator(chunk_size=20000)
+        # The "C" collation sorts by code point like Python, which the
+        # bisections need
+        index = cls(rows, generation)
+        logger.info('Built the player search index of %s players in %.2fs'
+                    % (len(index._ids), time.monotonic() - ts))
+        return index
+
+    def _serialize(self, index):
+        character = self._entry_characters[index]
+        tournament = self._entry_tournaments[index]
+        return {
+            'id': self._ids[index],
+            'tag': self._tags[index],
+            'main_character':
+                self._characters[character] if character >= 0 else None,
+            'last_tournament':
+                self._tournaments[tournament] if tournament >= 0 else None}
+
+    def _contains(self, term, limit, skip):
+        """Return the best entries whose normalized tag contains the term,
+        except the ones in the skip range
+        """
+        search_tags = self._search_tags
+        if len(term) < 3:
+            if search_tags.count(term) > self.SCAN_THRESHOLD:
+                # So many matches that the best ones come quickly when
+                # walking the entries by decreasing count
+                results = []
+                for i in self._by_count:
+                    if i not in skip and term in search_tags[i]:
+                        results.append(i)
+                        if len(results) == limit:
+                            break
+                return results
+            entries = search_tags.find_all(term)
+        else:
+            postings = []
+            for i in range(len(term) - 2):
+                posting = self._trigrams.get(term[i:i + 3])
+                if posting is None:
+                    return []
+                postings.append(posting)
+            entries = (i for i in min(postings, key=len)
+                       if term in search_tags[i])
+        return heapq.nlargest(
+            limit, (i for i in entries if i not in skip),
+            key=self._counts.__getitem__)
+
+    def search(self, term, limit=20):
+        """Return the serialized players matching the normalized term
+        """
+        search_tags = self._search_tags
+        start = bisect_left(search_tags, term)
+        exact_end = bisect_right(search_tags, term)
+        end = bisect_left(search_tags, term + '\U0010ffff')
+
+        def best(entries, count):
+            return heapq.nlargest(count, entries,
+                                  key=self._counts.__getitem__)
+
+        results = best(range(start, exact_end), limit)
+        results += best(range(exact_end, end), limit - len(results))
+        if len(results) < limit:
+            results += self._contains(
+                term, limit - len(results), range(start, end))
+        return [self._serialize(i) for i in results]
+
+
+class PlayerSearchIndexHolder:
+    """The process-local player search index, built lazily
+
+    The index is built on first use (or at warmup) when the
+    PLAYER_SEARCH_INDEX setting is on. It is rebuilt in a background thread
+    once a new tree is ready or updated, which means a data import or the
+    players processing finished (see refresh_tree_revisions), or once it is
+    older than PLAYER_SEARCH_INDEX_MAX_AGE seconds. The
+    previous index keeps serving the requests meanwhile.
+
+    Only the terms made of ASCII characters are answered from the index:
+    the DB normalization of the other terms (UNACCENT rules and UPPER) isn't
+    reproduced in Python, search returns None for them and they must be
+    searched in the DB.
+
+    Methods
+    -------
+    enabled()
+        Whether the index should be used
+    warmup()
+        Build the index if it isn't built yet
+    search(term, limit)
+        Return the serialized players matching the term, None if the term
+        must be searched in the DB
+    """
+
+    def __init__(self):
+        self._index = None
+        self._lock = threading.Lock()
+        self._building = False
+
+    def enabled(self):
+        """Whether the index should be used
+        """
+        return settings.PLAYER_SEARCH_INDEX
+
+    def warmup(self):
+        """Build the index if it isn't built yet
+        """
+        if self._index is None:
+            self._build()
+
+    def _build(self):
+        # Resolve the trees first so that their generation is the current one
+        container_registry.get(offline_only=False)
+        self._index = PlayerSearchIndex.build(container_registry.generation)
+
+    def _build_in_background(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+
+        def run():
+            try:
+                self._build()
+            except Exception:
+                logger.exception('Failed to rebuild the player search index')
+            finally:
+                self._building = False
+                connection.close()
+        threading.Thread(target=run, daemon=True).start()
+
+    def search(self, term, limit=20):
+        """Return the serialized players matching the term, None if the term
+        must be searched in the DB
+        """
+        if not term.isascii() or '\0' in term:
+            return None
+        # Resolving the online tree updates the registry generation
+        container_registry.get(offline_only=False)
+        index = self._index
+        if index is None:
+            self._build()
+            index = self._index
+        elif index.generation != container_registry.generation \
+                or time.monotonic() - index.built_at > \
+                settings.PLAYER_SEARCH_INDEX_MAX_AGE:
+            self._build_in_background()
+        return index.search(term.upper(), limit)
+
+
+# The index shared by the whole process
+player_search_index = PlayerSearchIndexHolder()
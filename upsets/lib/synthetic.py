@@ -0,0 +1,226 @@
+from datetime import datetime
+from itertools import accumulate
+import ast
+import random
+import sqlite3
+from upsets.models import Tournament, Player, Set, TwitterTag
+from upsets.lib.archiveparser import SET_FIELDS, parse_set_row
+from utils.orm_operators import BulkBatchManager, CopyBulkBatchManager
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+CHARACTERS = ['mario', 'fox', 'pikachu', 'joker', 'palutena', 'wolf', 'ness',
+              'snake', 'roy', 'cloud', 'peach', 'inkling']
+ROUNDS = ['Winners Round 1', 'Winners Quarter-Final', 'Losers Round 2',
+          "Loser's Final", 'Grand Final']
+STAGES = ['Battlefield', 'Final Destination', 'Smashville', None]
+
+
+class SyntheticArchive:
+    """Random but deterministic data shaped like a PlayerDatabase export
+
+    The players are ranked by strength, p0 being the strongest. The stronger
+    players also enter more tournaments: the entrants of a set are drawn
+    with a weight of 1 / (rank + 1) ** skew, and the stronger one wins but
+    for upset_rate of the sets, so that the numbers of sets and wins per
+    player follow a power law, like the real ones. Each player mostly plays
+    a main character. A fraction online_rate of the tournaments are online,
+    all of them started in the last 6 months so that a default
+    SqliteArchiveReader imports all the sets.
+
+    The rows of each table are drawn from their own seeded random generator
+    and streamed, so that the same rows are written whatever the table order
+    and archives far larger than the memory can be generated. They can be
+    written in a sqlite file, see write_sqlite, or straight into our DB, see
+    write_db.
+
+    Attributes
+    ----------
+    players: int
+        The number of players
+    tournaments: int
+        The number of tournaments
+    sets: int
+        The number of sets
+    seed: int
+        The seed of the random generators
+    online_rate: float
+        The fraction of online tournaments
+    skew: float
+        The exponent of the power law of the numbers of sets per player
+    upset_rate: float
+        The fraction of sets won by the weaker player
+    _now: float
+        The timestamp the tournament start dates are drawn before
+
+    Methods
+    -------
+    player_rows()
+        Yield the rows of the players table
+    tournament_rows()
+        Yield the rows of the tournament_info table
+    set_rows()
+        Yield the rows of the sets table
+    write_sqlite(path)
+        Write the archive as a sqlite file
+    write_db(bulk_engine, chunk_size)
+        Write the data in our DB, as an import of the archive would
+    """
+
+    def __init__(self, players=1000, tournaments=100, sets=10000, seed=0,
+                 online_rate=0.3, skew=1., upset_rate=0.25):
+        self.players = players
+        self.tournaments = tournaments
+        self.sets = sets
+        self.seed = seed
+        self.online_rate = online_rate
+        self.skew = skew
+        self.upset_rate = upset_rate
+        self._now = datetime.now().timestamp()
+
+    def _random(self, table):
+        return random.Random('%s-%s' % (self.seed, table))
+
+    def player_rows(self):
+        """Yield the (player_id, tag, social) rows of the players table
+        """
+        for i in range(self.players):
+            yield ('p%s' % i, 'Player %s' % i,
+                   repr({'twitter': ['tw%s' % i] if i % 3 else []}))
+
+    def tournament_rows(self):
+        """Yield the (key, cleaned_name, start, online) rows of the
+        tournament_info table
+        """
+        rng = self._random('tournaments')
+        for i in range(self.tournaments):
+            yield ('t%s' % i, 'Tournament %s' % i,
+                   int(self._now - rng.randrange(1, 150) * 86400),
+                   int(rng.random() < self.online_rate))
+
+    def set_rows(self):
+        """Yield the rows of the sets table, see SqliteArchiveReader for
+        their columns
+        """
+        rng = self._random('sets')
+        mains = [CHARACTERS[i % len(CHARACTERS)]
+                 for i in range(self.players)]
+        self._random('mains').shuffle(mains)
+        weights = list(accumulate(
+            1 / (rank + 1) ** self.skew for rank in range(self.players)))
+        ranks = range(self.players)
+
+        def character(rank):
+            if rng.random() < 0.8:
+                return 'ultimate/%s' % mains[rank]
+            return 'ultimate/%s' % rng.choice(CHARACTERS)
+
+        for i in range(self.sets):
+            (p1, p2) = rng.choices(ranks, cum_weights=weights, k=2)
+            while p1 == p2:
+                p2 = rng.choices(ranks, cum_weights=weights)[0]
+            (winner, loser) = (min(p1, p2), max(p1, p2))
+            if rng.random() < self.upset_rate:
+                (winner, loser) = (loser, winner)
+            best_of = rng.choice([3, 5])
+            winner_score = best_of // 2 + 1
+            loser_score = rng.randrange(winner_score)
+            # The game data is missing for some sets, like in the exports
+            game_winners = []
+            if rng.random() < 0.8:
+                # The winner of the set wins its last game
+                game_winners = [winner] * (winner_score - 1) \
+                    + [loser] * loser_score
+                rng.shuffle(game_winners)
+                game_winners.append(winner)
+            games = [{'winner_id': 'p%s' % game_winner,
+                      'loser_id': 'p%s' % (
+                          loser if game_winner == winner else winner),
+                      'winner_score': 1,
+                      'loser_score': 0,
+                      'winner_char': character(game_winner),
+                      'loser_char': character(
+                          loser if game_winner == winner else winner),
+                      'stage': rng.choice(STAGES)}
+                     for game_winner in game_winners]
+            scores = {winner: winner_score, loser: loser_score}
+            yield ('s%s' % i, 't%s' % rng.randrange(self.tournaments),
+                   'p%s' % winner, 'p%s' % p1, 'p%s' % p2, scores[p1],
+                   scores[p2], repr(['Pools', rng.choice(ROUNDS)]), best_of,
+                   repr(games))
+
+    def write_sqlite(self, path):
+        """Write the archive as a sqlite file, replacing its tables
+        """
+        conn = sqlite3.connect(path)
+        conn.executescript("""
+            DROP TABLE IF EXISTS players;
+            DROP TABLE IF EXISTS tournament_info;
+            DROP TABLE IF EXISTS sets;
+            CREATE TABLE players (player_id TEXT, tag TEXT, social TEXT);
+            CREATE TABLE tournament_info (
+                key TEXT, cleaned_name TEXT, start INTEGER, online INTEGER);
+            CREATE TABLE sets (
+                key TEXT, tournament_key TEXT, winner_id TEXT, p1_id TEXT,
+                p2_id TEXT, p1_score INTEGER, p2_score INTEGER,
+                location_names TEXT, best_of INTEGER, game_data TEXT);
+            """)
+        conn.executemany(
+            "INSERT INTO players VALUES (?, ?, ?)", self.player_rows())
+        conn.executemany(
+            "INSERT INTO tournament_info VALUES (?, ?, ?, ?)",
+            self.tournament_rows())
+        conn.executemany(
+            "INSERT INTO sets VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            self.set_rows())
+        conn.commit()
+        conn.close()
+
+    def write_db(self, bulk_engine='copy', chunk_size=10000):
+        """Write the data in our DB, as an import of the archive would, but
+        without going through a sqlite file
+
+        The rows are converted like SqliteArchiveReader does and written by
+        batches with the given bulk engine, 'orm' or 'copy', see
+        CopyBulkBatchManager. The fingerprints are set, so that importing the
+        same archive afterwards leaves the rows unchanged.
+        """
+        batcher_class = CopyBulkBatchManager if bulk_engine == 'copy' \
+            else BulkBatchManager
+
+        def batcher(model, fingerprint_field=None):
+            return batcher_class(model, batch_size=chunk_size,
+                                 ignore_conflicts=True, logger=logger,
+                                 fingerprint_field=fingerprint_field)
+
+        batcher(Tournament, 'fingerprint').bulk_update_or_create(
+            (Tournament(id=key, name=name,
+                        start_date=datetime.fromtimestamp(start).date(),
+                        online=online == 1)
+             for (key, name, start, online) in self.tournament_rows()),
+            ['name', 'start_date', 'online'])
+        batcher(Player, 'fingerprint').bulk_update_or_create(
+            (Player(id=player_id, tag=tag)
+             for (player_id, tag, social) in self.player_rows()),
+            ['tag'])
+        Player.update_search_tags()
+        batcher(TwitterTag).bulk_create(
+            TwitterTag(tag=twitter, player_id=player_id)
+            for (player_id, tag, social) in self.player_rows()
+            for twitter in ast.literal_eval(social)['twitter'])
+        batcher(Set, 'fingerprint').bulk_update_or_create(
+            (Set(**dict(zip(SET_FIELDS, parse_set_row(row))))
+             for row in self.set_rows()),
+            ['tournament_id', 'winner_id', 'loser_id', 'winner_score',
+             'loser_score', 'round_name', 'best_of', 'winner_characters',
+             'loser_characters'])
+
+
+def write_synthetic_archive(path, players=1000, tournaments=100, sets=10000,
+                            seed=0):
+    """Write a sqlite archive shaped like a PlayerDatabase export, see
+    SyntheticArchive
+    """
+    SyntheticArchive(players=players, tournaments=tournaments, sets=sets,
+                     seed=seed).write_sqlite(path)
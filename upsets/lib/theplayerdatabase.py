@@ -1,8 +1,16 @@
+from collections import deque
+from contextlib import contextmanager, ExitStack
 from datetime import datetime
 import ast
+import multiprocessing
 import sqlite3
 from upsets.models import Tournament, Player, Set, TwitterTag
-from utils.orm_operators import BulkBatchManager
+from upsets.lib.archiveparser import SET_FIELDS, parse_set_row, \
+    parse_sets_range
+from utils.orm_operators import BulkBatchManager, CopyBulkBatchManager
+from utils.decorators import time_it
+from utils.instrumentation import phase, current_phase
+from utils.pipeline import Pipeline
 # LOGGING
 import logging
 logger = logging.getLogger('data_processing')
@@ -15,10 +23,37 @@ class SqliteArchiveReader:
     in sqlite exports coming from The Player Satabase website
     https://github.com/smashdata/ThePlayerDatabase
 
+    The rows are streamed from the db file by chunks of chunk_size rows
+    straight into the batched DB writes, so the memory used doesn't depend on
+    the size of the db file.
+
+    In pipelined mode, the rows are read from the db file and turned into
+    model instances by the threads of a Pipeline while this thread writes
+    them to the DB. update_all_data also starts reading and parsing the sets
+    while the tournaments and the players are written, only the writes must
+    follow the foreign keys order.
+
+    The players, tournaments and sets rows are fingerprinted with a hash of
+    their imported fields, only the new rows and the ones whose fingerprint
+    changed are written. The players of the written sets, and of the sets of
+    the written tournaments, are marked as needing processing, see
+    Player.needs_processing.
+
     Attributes
     ----------
     _connection: sqlite3.Connection object
         The connection object used to fetch data from the db file
+    _db_file: str
+        The path of the db file
+    _chunk_size: int
+        The number of rows fetched at once from the db file
+    _workers: int
+        The number of processes parsing the sets
+    _bulk_engine: str
+        How the rows are written in our DB, 'orm' for the Django bulk
+        methods or 'copy' for the postgres COPY, see CopyBulkBatchManager
+    _pipelined: bool
+        Whether the reads and the writes overlap, see Pipeline
 
     Methods
     -------
@@ -32,81 +67,182 @@ class SqliteArchiveReader:
         Query the db file and update all the data in our db
     """
 
-    def __init__(self, db_file, full_backfill=False):
+    BULK_ENGINES = ('orm', 'copy')
+
+    def __init__(self, db_file, full_backfill=False, chunk_size=10000,
+                 workers=1, bulk_engine='orm', pipelined=False):
+        if bulk_engine not in self.BULK_ENGINES:
+            raise ValueError('Unknown bulk engine %s, possibles are %s.'
+                             % (bulk_engine, ', '.join(self.BULK_ENGINES)))
         # Setup connection object
         conn = sqlite3.connect(db_file)
         self._connection = conn
+        self._db_file = db_file
+        self._chunk_size = chunk_size
+        self._workers = workers
+        self._bulk_engine = bulk_engine
+        self._pipelined = pipelined
         if full_backfill:
             self.cutoff_timestamp = 0
         else:
             # 6 months ago
             self.cutoff_timestamp = datetime.now().timestamp() - 15778463
 
+    def _batcher(self, model, fingerprint_field=None):
+        """Return the batch manager writing the given model in our DB
+        """
+        if self._bulk_engine == 'copy':
+            batcher_class = CopyBulkBatchManager
+        else:
+            batcher_class = BulkBatchManager
+        return batcher_class(model, batch_size=self._chunk_size,
+                             ignore_conflicts=True, logger=logger,
+                             fingerprint_field=fingerprint_field)
+
+    def _stream(self, query, connection=None):
+        """Execute the query and yield its rows, fetched by chunks
+
+        The query runs on the given sqlite connection, or on the one of the
+        reader.
+        """
+        cur = (connection or self._connection).cursor()
+        cur.execute(query)
+        while True:
+            rows = cur.fetchmany(self._chunk_size)
+            if not rows:
+                break
+            yield from rows
+
+    @contextmanager
+    def _source(self, name, read, build):
+        """Yield an iterator of the model instances built from the rows of
+        the db file
+
+        read(connection) returns the rows read on the given sqlite
+        connection, build(rows) the instances built from them. In pipelined
+        mode both run in the threads of a Pipeline, started when entering
+        the context, with a sqlite connection of their own.
+        """
+        if not self._pipelined:
+            yield build(read(self._connection))
+            return
+
+        def read_in_thread():
+            # The sqlite connections can't be shared between threads
+            connection = sqlite3.connect(self._db_file)
+            try:
+                yield from read(connection)
+            finally:
+                connection.close()
+        with Pipeline(name, logger=logger) as pipeline:
+            pipeline.add('read', read_in_thread)
+            pipeline.add('build', build)
+            pipeline.start()
+            yield pipeline.output('write')
+
+    @time_it(logger)
     def update_players(self):
         """Query all rows in the player table and save them in our DB
+
+        Return the numbers of new, changed and unchanged players.
         """
-        cur = self._connection.cursor()
-        cur.execute("SELECT player_id, tag, social FROM players")
-        rows = cur.fetchall()
-        logger.info('Successfully fetched players data from db file, '
+        logger.info('Streaming players data from db file, '
                     + 'handling players and twitter tags updates...')
+        batcher = self._batcher(Player, fingerprint_field='fingerprint')
+        with self._source(
+                'players',
+                lambda connection: self._stream(
+                    "SELECT player_id, tag FROM players", connection),
+                lambda rows: (Player(id=row[0], tag=row[1])
+                              for row in rows)) as players_generator:
+            counts = batcher.bulk_update_or_create(players_generator, ['tag'])
+        current_phase().rows = sum(counts.values())
+        logger.info('Successfully updated players from db file: %(new)s new, '
+                    '%(changed)s changed and %(unchanged)s unchanged.'
+                    % counts)
+        count = Player.update_search_tags()
+        logger.info('Successfully updated %s players search tags.' % count)
 
-        players_generator = (Player(id=row[0], tag=row[1]) for row in rows)
-        batcher = BulkBatchManager(
-            Player, ignore_conflicts=True, logger=logger)
-        batcher.bulk_update_or_create(players_generator, ['tag'])
-        logger.info('Successfully updated players from db file.')
-
-        # Create new twitter tags on the go
+        # Create new twitter tags on the go, in a second pass over the
+        # players table as the rows are not kept in memory
         def twitter_tag_generator(data):
             for row in data:
-                twitters = ast.literal_eval(row[2])['twitter']
+                twitters = ast.literal_eval(row[1])['twitter']
                 for twitter in twitters:
                     tag = TwitterTag(tag=twitter, player_id=row[0])
                     yield tag
-        batcher = BulkBatchManager(
-            TwitterTag, ignore_conflicts=True, logger=logger)
-        batcher.bulk_create(twitter_tag_generator(rows))
+        batcher = self._batcher(TwitterTag)
+        with self._source(
+                'twitter tags',
+                lambda connection: self._stream(
+                    "SELECT player_id, social FROM players", connection),
+                twitter_tag_generator) as twitter_tags:
+            batcher.bulk_create(twitter_tags)
         logger.info('Successfully added new twitter tags from db file.')
+        return counts
 
+    @time_it(logger)
     def update_tournaments(self):
         """Query all rows in the tournament_info table and save them in our DB
+
+        Return the numbers of new, changed and unchanged tournaments.
         """
-        cur = self._connection.cursor()
-        cur.execute(
-            f"""
+        query = f"""
             SELECT key, cleaned_name, start, online
             FROM tournament_info
             WHERE start >= {self.cutoff_timestamp}
-            """)
-        rows = cur.fetchall()
-        logger.info('Successfully fetched tournament data from db file, '
+            """
+        logger.info('Streaming tournament data from db file, '
                     + 'handling tournaments updates...')
 
-        tournaments_generator = (Tournament(
-            id=row[0],
-            name=row[1],
-            start_date=datetime.fromtimestamp(row[2]).date(),
-            online=(True if row[3] == 1 else False)
-        ) for row in rows)
+        def tournaments_generator(rows):
+            return (Tournament(
+                id=row[0],
+                name=row[1],
+                start_date=datetime.fromtimestamp(row[2]).date(),
+                online=(True if row[3] == 1 else False)
+            ) for row in rows)
 
-        batcher = BulkBatchManager(
-            Tournament, ignore_conflicts=True, logger=logger)
-        batcher.bulk_update_or_create(
-            tournaments_generator, ['name', 'start_date', 'online'])
-        logger.info('Successfully updated tournaments from db file.')
+        batcher = self._batcher(Tournament, fingerprint_field='fingerprint')
+        with self._source(
+                'tournaments',
+                lambda connection: self._stream(query, connection),
+                tournaments_generator) as tournaments:
+            counts = batcher.bulk_update_or_create(
+                tournaments, ['name', 'start_date', 'online'],
+                on_written=lambda pks: Player.mark_for_processing(
+                    Set.objects.filter(tournament_id__in=pks)))
+        current_phase().rows = sum(counts.values())
+        logger.info('Successfully updated tournaments from db file: '
+                    '%(new)s new, %(changed)s changed and %(unchanged)s '
+                    'unchanged.' % counts)
+        return counts
 
+    @time_it(logger)
     def update_sets(self):
         """
         Query all rows in the sets table and save them in our DB
+
+        With more than one worker, the sets table is split in rowid ranges
+        of chunk_size rows which are read and parsed in a process pool, the
+        parsed sets stream back in order to this process which writes them.
+
+        Return the numbers of new, changed and unchanged sets.
+        """
+        with self._sets_source() as sets_generator:
+            return self._write_sets(sets_generator)
+
+    @contextmanager
+    def _sets_source(self):
+        """Yield an iterator of the Set instances of the db file, see
+        _source
         """
-        cur = self._connection.cursor()
         # The sets table presents some player id values that are not in the
         # player table. This cause some integrity errors in our bulk create
         # operations. To handle this we inner join the sets table with
         # the player table when requesting the sqlite file, which takes a
         # little more time but solves the integrity problem upstream
-        cur.execute(f"""
+        query = f"""
             SELECT
                 sets.key,
                 sets.tournament_key,
@@ -129,67 +265,78 @@ class SqliteArchiveReader:
                 AND sets.tournament_key IS NOT NULL
                 AND sets.winner_id IS NOT NULL
                 AND t.start >= {self.cutoff_timestamp}
-            """)
+            """
 
-        rows = cur.fetchall()
-        logger.info('Successfully fetched sets data from db file, '
-                    + 'handling sets updates...')
+        def build(parsed_rows):
+            return (Set(**dict(zip(SET_FIELDS, values)))
+                    for values in parsed_rows)
 
-        def sets_generator(data):
-            for row in data:
-                set = Set(id=row[0], tournament_id=row[1])
-                if row[2] == row[3]:
-                    # winner is player 1
-                    set.winner_id = row[3]
-                    set.loser_id = row[4]
-                    set.winner_score = row[5]
-                    set.loser_score = row[6]
-                elif row[2] == row[4]:
-                    # winner is player 2
-                    set.winner_id = row[4]
-                    set.loser_id = row[3]
-                    set.winner_score = row[6]
-                    set.loser_score = row[5]
-                else:
-                    logger.warning(
-                        'winner_id does not match p1_id or p2_id on set %s'
-                        % row[0])
-                set.round_name = ast.literal_eval(row[7])[-1]
-                set.best_of = row[8]
-                set.winner_characters = []
-                set.loser_characters = []
-                try:
-                    for gamedata in ast.literal_eval(row[9]):
-                        (game_winner_char, game_loser_char) = (
-                            (gamedata['winner_char'].replace('ultimate/', '')),
-                            (gamedata['loser_char'].replace('ultimate/', '')))
-                        if str(gamedata['winner_id']) == str(set.winner_id):
-                            set_winner_char = game_winner_char
-                            set_loser_char = game_loser_char
-                        else:
-                            set_winner_char = game_loser_char
-                            set_loser_char = game_winner_char
-                        if set_winner_char not in set.winner_characters:
-                            set.winner_characters.append(set_winner_char)
-                        if set_loser_char not in set.loser_characters:
-                            set.loser_characters.append(set_loser_char)
-                except ValueError as ex:
-                    # Ignore the malformed values when doing literal_eval
-                    logger.debug(ex)
-                yield set
-
-        batcher = BulkBatchManager(
-            Set, ignore_conflicts=True, logger=logger)
-        batcher.bulk_update_or_create(
-            sets_generator(rows),
+        with ExitStack() as stack:
+            if self._workers > 1:
+                # The pool is created before the threads of the pipeline so
+                # that the workers are forked from a single threaded process
+                pool = stack.enter_context(
+                    multiprocessing.Pool(self._workers))
+
+                def read(connection):
+                    return self._parse_in_pool(query, pool, connection)
+            else:
+                def read(connection):
+                    return map(parse_set_row, self._stream(query, connection))
+            yield stack.enter_context(self._source('sets', read, build))
+
+    def _write_sets(self, sets_generator):
+        """Write the sets of the generator in our DB
+
+        Return the numbers of new, changed and unchanged sets.
+        """
+        logger.info('Streaming sets data from db file with %s worker(s), '
+                    'handling sets updates...' % self._workers)
+        batcher = self._batcher(Set, fingerprint_field='fingerprint')
+        counts = batcher.bulk_update_or_create(
+            sets_generator,
             ['tournament_id', 'winner_id', 'loser_id', 'winner_score',
              'loser_score', 'round_name', 'best_of', 'winner_characters',
-             'loser_characters'])
-        logger.info('Successfully updated sets from db file.')
+             'loser_characters'],
+            # The previous players of the changed sets need processing too
+            on_writing=lambda pks: Player.mark_for_processing(
+                Set.objects.filter(pk__in=pks)),
+            on_written=lambda pks: Player.mark_for_processing(
+                Set.objects.filter(pk__in=pks)))
+        current_phase().rows = sum(counts.values())
+        logger.info('Successfully updated sets from db file: %(new)s new, '
+                    '%(changed)s changed and %(unchanged)s unchanged.'
+                    % counts)
+        return counts
+
+    def _parse_in_pool(self, query, pool, connection):
+        """Yield the parsed rows of the sets query, parsed by rowid ranges in
+        the process pool
+
+        At most two ranges per worker are pending at a time, so that the
+        parsed sets don't pile up in memory when the DB writes are slower
+        than the parsing.
+        """
+        (first, last) = connection.execute(
+            "SELECT MIN(rowid), MAX(rowid) FROM sets").fetchone()
+        if first is None:
+            return
+        pending = deque()
+        for start in range(first, last + 1, self._chunk_size):
+            pending.append(pool.apply_async(
+                parse_sets_range,
+                (self._db_file, query, start, start + self._chunk_size)))
+            if len(pending) >= 2 * self._workers:
+                yield from pending.popleft().get()
+        while pending:
+            yield from pending.popleft().get()
 
     def update_all_data(self):
         """Query the db file and update all the data in our db
         """
-        self.update_tournaments()
-        self.update_players()
-        self.update_sets()
+        with self._sets_source() as sets_generator:
+            # In pipelined mode, the sets are read and parsed meanwhile
+            self.update_tournaments()
+            self.update_players()
+            with phase('update_sets'):
+                self._write_sets(sets_generator)
@@ -0,0 +1,445 @@
+from array import array
+from datetime import date
+from urllib.parse import quote
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from django.conf import settings
+from upsets.models import UpsetTreeNode
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+MAGIC = b'UPSTREE1'
+# magic, container id, revision, offline_only, then the counts of nodes,
+# tournaments, strings, string lists, string list items, hash table slots
+# and the size of the strings blob
+HEADER = struct.Struct('=8s10q')
+# The int value standing for NULL in the int columns
+NULL = -2 ** 31
+# The int columns of the nodes, in this order in the file
+NODE_COLUMNS = ('player_id', 'tag', 'main_character', 'parent', 'depth',
+                'tournament', 'winner_score', 'loser_score', 'round_name',
+                'best_of', 'winner_characters', 'loser_characters')
+# The int columns of the tournaments, in this order in the file
+TOURNAMENT_COLUMNS = ('name', 'start_date', 'online')
+
+
+class TreeSnapshot:
+    """An immutable binary snapshot of an upset tree, read from a memory
+    mapped file
+
+    The snapshot holds everything the player path endpoint returns, so
+    that a path is a walk in flat arrays, without any DB query. All the
+    web processes map the same file read-only and share its pages. The file
+    is made of a header and of sections of native ints, like array.tofile
+    writes them:
+
+    - the offsets of the strings in the strings blob, the strings being the
+      ids and tags of the players, the characters, the round and tournament
+      names, each stored once
+    - the offsets of the string lists (the characters of a set) in the list
+      items, which are string indexes
+    - the NODE_COLUMNS parallel arrays, one value per node: the string
+      index of the player id, tag and main character, the index of the
+      parent node, the depth, and the fields of the upset of the node. The
+      winner of the upset is the player of the node and its loser the
+      player of the parent node, see UpsetTreeManager.
+    - the TOURNAMENT_COLUMNS parallel arrays: the string index of the
+      name, the ordinal of the start date and the online flag
+    - an open addressing hash table of the node indexes by player id
+    - the strings blob, in UTF-8
+
+    The missing values are NULL, or -1 for the indexes.
+
+    The tags and main characters are copied when the snapshot is written,
+    the players processing writes the snapshots again once it changed them,
+    see refresh_tree_revisions.
+
+    Attributes
+    ----------
+    container_id: int
+        The id of the TreeContainer of the tree
+    revision: int
+        The revision of the container the snapshot was written at
+    offline_only: bool
+        Whether the online sets are excluded from the tree
+    nodes: int
+        The number of nodes
+
+    Methods
+    -------
+    write(path, container)
+        Write the snapshot of the tree of a container, atomically replacing
+        the file
+    open(path)
+        Map a snapshot file
+    node_index(player_id)
+        Return the node index of a player, None if not in the tree
+    path_data(player_id)
+        Return the player path response data, None if the player is not
+        in the tree
+    """
+
+    def __init__(self, buffer):
+        (magic, self.container_id, self.revision, offline_only, self.nodes,
+         tournaments, strings, lists, items, slots, blob_size) = \
+            HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ValueError('Not an upset tree snapshot.')
+        size = HEADER.size + 8 * (strings + 1) + blob_size + 4 * (
+            lists + 1 + items + len(NODE_COLUMNS) * self.nodes
+            + len(TOURNAMENT_COLUMNS) * tournaments + slots)
+        if len(buffer) != size:
+            raise ValueError('Truncated upset tree snapshot.')
+        self.offline_only = bool(offline_only)
+        self._buffer = buffer
+        view = memoryview(buffer)
+        position = HEADER.size
+
+        def section(typecode, count):
+            nonlocal position
+            size = array(typecode).itemsize * count
+            values = view[position:position + size].cast(typecode)
+            position += size
+            return values
+
+        self._string_offsets = section('q', strings + 1)
+        self._list_offsets = section('i', lists + 1)
+        self._list_items = section('i', items)
+        self._nodes = {column: section('i', self.nodes)
+                       for column in NODE_COLUMNS}
+        self._tournaments = {column: section('i', tournaments)
+                             for column in TOURNAMENT_COLUMNS}
+        self._slots = section('i', slots)
+        self._blob = view[position:position + blob_size]
+
+    @classmethod
+    def open(cls, path):
+        """Map a snapshot file read-only
+
+        The file can be replaced meanwhile, the mapping keeps the pages of
+        the opened one.
+        """
+        with open(path, 'rb') as snapshot_file:
+            return cls(mmap.mmap(snapshot_file.fileno(), 0,
+                                 access=mmap.ACCESS_READ))
+
+    @staticmethod
+    def write(path, container):
+        """Write the snapshot of the tree of a container
+
+        The nodes are read from the DB by depth, so that the parents are
+        indexed before their children. The file is written next to path
+        and renamed over it, the readers see either the old or the new
+        snapshot. Return the number of nodes.
+        """
+        strings = {}
+        lists = {}
+        tournaments = {}
+        tournament_columns = {column: array('i')
+                              for column in TOURNAMENT_COLUMNS}
+        node_columns = {column: array('i') for column in NODE_COLUMNS}
+        node_indexes = {}
+
+        def string(value):
+            if value is None:
+                return -1
+            return strings.setdefault(value, len(strings))
+
+        def string_list(values):
+            return lists.setdefault(
+                tuple(string(value) for value in values), len(lists))
+
+        def tournament(tournament_id, name, start_date, online):
+            index = tournaments.get(tournament_id)
+            if index is None:
+                index = tournaments[tournament_id] = len(tournaments)
+                tournament_columns['name'].append(string(name))
+                tournament_columns['start_date'].append(
+                    NULL if start_date is None else start_date.toordinal())
+                tournament_columns['online'].append(int(online))
+            return index
+
+        def nullable(value):
+            return NULL if value is None else value
+
+        # A single streamed query rather than keyset_iterator: the rows are
+        # plain tuples with nothing to prefetch, and they are read by depth
+        # so that the parents come before their children
+        rows = UpsetTreeNode.objects \
+            .filter(tree_container=container) \
+            .order_by('node_depth', 'id') \
+            .values_list('id', 'parent_id', 'node_depth', 'player_id',
+                         'player__tag', 'player__main_character',
+                         'upset__tournament_id', 'upset__tournament__name',
+                         'upset__tournament__start_date',
+                         'upset__tournament__online', 'upset__winner_score',
+                         'upset__loser_score', 'upset__round_name',
+                         'upset__best_of', 'upset__winner_characters',
+                         'upset__loser_characters') \
+            .iterator(chunk_size=20000)
+        for (node_id, parent_id, depth, player_id, tag, main_character,
+             tournament_id, name, start_date, online, winner_score,
+             loser_score, round_name, best_of, winner_characters,
+             loser_characters) in rows:
+            node_indexes[node_id] = len(node_indexes)
+            values = {
+                'player_id': string(player_id),
+                'tag': string(tag),
+                'main_character': string(main_character),
+                'parent': -1 if parent_id is None
+                else node_indexes[parent_id],
+                'depth': depth,
+                'tournament': -1 if tournament_id is None
+                else tournament(tournament_id, name, start_date, online),
+                'winner_score': nullable(winner_score),
+                'loser_score': nullable(loser_score),
+                'round_name': string(round_name),
+                'best_of': nullable(best_of),
+                'winner_characters': string_list(winner_characters or []),
+                'loser_characters': string_list(loser_characters or [])}
+            for column in NODE_COLUMNS:
+                node_columns[column].append(values[column])
+
+        nodes = len(node_indexes)
+        string_offsets = array('q', [0])
+        blob = bytearray()
+        encoded = []
+        for value in strings:
+            encoded.append(value.encode())
+            blob += encoded[-1]
+            string_offsets.append(len(blob))
+        list_offsets = array('i', [0])
+        list_items = array('i')
+        for values in lists:
+            list_items.extend(values)
+            list_offsets.append(len(list_items))
+        # A power of two at least twice the number of nodes, to keep the
+        # probes short
+        slots = array('i', [-1]) * (1 << max(nodes * 2 - 1, 1).bit_length())
+        player_ids = node_columns['player_id']
+        for node in range(nodes):
+            slot = _hash(encoded[player_ids[node]]) & (len(slots) - 1)
+            while slots[slot] != -1:
+                slot = (slot + 1) & (len(slots) - 1)
+            slots[slot] = node
+
+        directory = os.path.dirname(os.path.abspath(path))
+        (fd, temporary_path) = tempfile.mkstemp(
+            dir=directory, prefix='.snapshot-')
+        try:
+            with os.fdopen(fd, 'wb') as snapshot_file:
+                snapshot_file.write(HEADER.pack(
+                    MAGIC, container.id, container.revision,
+                    int(container.offline_only), nodes, len(tournaments),
+                    len(strings), len(lists), len(list_items), len(slots),
+                    len(blob)))
+                string_offsets.tofile(snapshot_file)
+                list_offsets.tofile(snapshot_file)
+                list_items.tofile(snapshot_file)
+                for column in NODE_COLUMNS:
+                    node_columns[column].tofile(snapshot_file)
+                for column in TOURNAMENT_COLUMNS:
+                    tournament_columns[column].tofile(snapshot_file)
+                slots.tofile(snapshot_file)
+                snapshot_file.write(blob)
+            os.chmod(temporary_path, 0o644)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.unlink(temporary_path)
+            raise
+        logger.info('Wrote the snapshot of %s nodes of container %s in %s'
+                    % (nodes, container.id, path))
+        return nodes
+
+    def _string(self, index):
+        if index == -1:
+            return None
+        offsets = self._string_offsets
+        return str(self._blob[offsets[index]:offsets[index + 1]], 'utf-8')
+
+    def _string_list(self, index):
+        offsets = self._list_offsets
+        return [self._string(item) for item
+                in self._list_items[offsets[index]:offsets[index + 1]]]
+
+    def node_index(self, player_id):
+        """Return the node index of a player, None if not in the tree
+        """
+        key = player_id.encode()
+        slots = self._slots
+        player_ids = self._nodes['player_id']
+        offsets = self._string_offsets
+        slot = _hash(key) & (len(slots) - 1)
+        while slots[slot] != -1:
+            node = slots[slot]
+            string = player_ids[node]
+            if self._blob[offsets[string]:offsets[string + 1]] == key:
+                return node
+            slot = (slot + 1) & (len(slots) - 1)
+        return None
+
+    def _player(self, node):
+        return {'id': self._string(self._nodes['player_id'][node]),
+                'tag': self._string(self._nodes['tag'][node]),
+                'main_character':
+                    self._string(self._nodes['main_character'][node])}
+
+    def _tournament(self, index):
+        columns = self._tournaments
+        start_date = columns['start_date'][index]
+        return {'name': self._string(columns['name'][index]),
+                'start_date': None if start_date == NULL
+                else date.fromordinal(start_date).isoformat(),
+                'online': bool(columns['online'][index])}
+
+    def _hop(self, node):
+        """Return the serialized node, like UpsetTreeNodeSerializer does
+        """
+        columns = self._nodes
+
+        def nullable(column):
+            value = columns[column][node]
+            return None if value == NULL else value
+
+        tournament = columns['tournament'][node]
+        return {
+            'node_depth': columns['depth'][node],
+            'upset': {
+                'tournament': None if tournament == -1
+                else self._tournament(tournament),
+                'winner': self._player(node),
+                'loser': self._player(columns['parent'][node]),
+                'winner_score': nullable('winner_score'),
+                'loser_score': nullable('loser_score'),
+                'round_name': self._string(columns['round_name'][node]),
+                'best_of': nullable('best_of'),
+                'winner_characters':
+                    self._string_list(columns['winner_characters'][node]),
+                'loser_characters':
+                    self._string_list(columns['loser_characters'][node])}}
+
+    def path_data(self, player_id):
+        """Return the player path response data, None if the player is not
+        in the tree
+        """
+        node = self.node_index(player_id)
+        if node is None:
+            return None
+        path = []
+        parents = self._nodes['parent']
+        current = node
+        # The root node, without parent, isn't part of the path
+        while parents[current] != -1:
+            path.append(self._hop(current))
+            current = parents[current]
+        return {'player_tag': self._string(self._nodes['tag'][node]),
+                'offline_only': self.offline_only,
+                'path_exist': True,
+                'path': path}
+
+
+def _hash(key):
+    # A hash stable between processes, unlike hash() on str
+    return zlib.crc32(key)
+
+
+def snapshot_path(root_player_id, offline_only):
+    """Return the path of the snapshot of the tree of a root and mode in
+    the TREE_SNAPSHOT_DIR setting directory
+    """
+    return os.path.join(
+        settings.TREE_SNAPSHOT_DIR, 'tree-%s-%s.snapshot'
+        % (quote(root_player_id, safe=''),
+           'offline' if offline_only else 'all'))
+
+
+def write_snapshot(container):
+    """Write the snapshot of the tree of a container if the snapshots are
+    enabled, see TREE_SNAPSHOT_DIR
+    """
+    if not settings.TREE_SNAPSHOT_DIR or container.root_player_id is None:
+        return
+    os.makedirs(settings.TREE_SNAPSHOT_DIR, exist_ok=True)
+    TreeSnapshot.write(
+        snapshot_path(container.root_player_id, container.offline_only),
+        container)
+
+
+class TreeSnapshotStore:
+    """The process-local mapped snapshots of the current trees
+
+    The snapshot of a container is only served if it was written for its
+    current revision: the file of a root and mode is opened again when the
+    registry resolves a new container or revision. A missing or outdated
+    file is looked for again after TREE_CONTAINER_TTL seconds, meanwhile
+    the paths are read from the DB.
+
+    Attributes
+    ----------
+    _entries: dict
+        (root player id, offline_only) -> ((container id, revision),
+        snapshot or None, opening monotonic time)
+    _lock: threading.Lock
+        Guards the openings of the snapshots between threads
+
+    Methods
+    -------
+    get(container)
+        Return the snapshot of the tree of the container, None if there is
+        none up to date
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, container):
+        """Return the snapshot of the tree of the container, None if there
+        is none up to date
+        """
+        if not settings.TREE_SNAPSHOT_DIR or container.root_player_id is None:
+            return None
+        key = (container.root_player_id, container.offline_only)
+        version = (container.id, container.revision)
+        entry = self._entries.get(key)
+        if self._fresh(entry, version):
+            return entry[1]
+        with self._lock:
+            entry = self._entries.get(key)
+            if self._fresh(entry, version):
+                return entry[1]
+            snapshot = self._open(key)
+            if snapshot is not None and \
+                    (snapshot.container_id, snapshot.revision) != version:
+                snapshot = None
+            # The previous snapshot is unmapped once no request reads it
+            self._entries[key] = (version, snapshot, time.monotonic())
+        return snapshot
+
+    @staticmethod
+    def _fresh(entry, version):
+        if entry is None or entry[0] != version:
+            return False
+        return entry[1] is not None or \
+            time.monotonic() - entry[2] <= settings.TREE_CONTAINER_TTL
+
+    @staticmethod
+    def _open(key):
+        try:
+            return TreeSnapshot.open(snapshot_path(*key))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error) as error:
+            logger.warning('Could not open the tree snapshot of %s: %s'
+                           % (key, error))
+            return None
+
+
+# The snapshots mapped by the whole process
+tree_snapshots = TreeSnapshotStore()
@@ -0,0 +1,442 @@
+from array import array
+import threading
+import time
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from upsets.models import Set
+from upsets.lib.containers import container_registry
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+# Postgres sorts NULL values first on a descending order, so with the SQL
+# engine a set from a tournament without start date is always picked as the
+# most recent one. We mimic that with a date key greater than any ordinal.
+NULL_DATE_KEY = 2 ** 62
+
+
+def qualifying_sets(offline_only=False):
+    """Return the queryset of the sets that can be used as upsets
+
+    DQs (a -1 score) and sets without any reported score are excluded, as
+    well as online tournaments sets when offline_only is True.
+    """
+    sets = Set.objects.all()
+    if offline_only:
+        sets = sets.exclude(tournament__online=True)
+    return sets \
+        .exclude(Q(winner_score=-1) | Q(loser_score=-1)) \
+        .exclude(Q(winner_score=0) & Q(loser_score=0))
+
+
+class UpsetGraph:
+    """A compact in-memory graph of all the upsets between players
+
+    Players are mapped to consecutive integer indexes, and the sets are
+    stored as a CSR (compressed sparse row) structure keyed by loser: the
+    wins against the player of index i are the edges between
+    _offsets[i] and _offsets[i+1]. All the per-edge data is kept in flat
+    typed arrays, which makes the graph cheap enough to hold millions of
+    sets in memory and to run the tree BFS without any DB round trip.
+    Each edge is tagged with its tournament online flag, so the same graph
+    serves both the online and the offline only trees.
+
+    Attributes
+    ----------
+    _player_ids: list of str
+        The player id of each player index
+    _player_index: dict
+        The player index of each player id
+    _set_ids: list of str
+        The set id of each set index
+    _offsets: array.array
+        The CSR offsets, per loser player index
+    _winners: array.array
+        The winner player index of each edge
+    _edge_sets: array.array
+        The set index of each edge
+    _edge_dates: array.array
+        The tournament date key of each edge, used to pick recent upsets
+    _edge_online: bytearray
+        The tournament online flag of each edge
+    _wins: tuple of array.array
+        The CSR of the edges keyed by winner, see _wins_index
+
+    Methods
+    -------
+    load()
+        Stream the qualifying sets from the DB and build the graph
+    from_rows(rows)
+        Build the graph from (set_id, winner_id, loser_id, start_date,
+        online) rows
+    player_index(player_id)
+        Return the index of a player id, None if the player has no sets
+    player_id(index)
+        Return the player id of a player index
+    set_id(index)
+        Return the set id of a set index
+    bfs(root_player_id, offline_only)
+        Run the upset tree BFS, yielding the tree layers one by one
+    shortest_path(player_id, target_player_id, offline_only)
+        Return the set indexes of the shortest upset path between two
+        players
+    """
+
+    def __init__(self):
+        self._player_ids = []
+        self._player_index = {}
+        self._set_ids = []
+        self._offsets = array('l', [0])
+        self._winners = array('l')
+        self._edge_sets = array('l')
+        self._edge_dates = array('q')
+        self._edge_online = bytearray()
+        self._wins = None
+
+    @classmethod
+    def load(cls):
+        """Stream the qualifying sets from the DB and build the graph
+        """
+        rows = qualifying_sets() \
+            .order_by('pk') \
+            .values_list('id', 'winner_id', 'loser_id',
+                         'tournament__start_date', 'tournament__online') \
+            .iterator(chunk_size=20000)
+        return cls.from_rows(rows)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build the graph from (set_id, winner_id, loser_id, start_date,
+        online) rows
+        """
+        graph = cls()
+        player_index = graph._player_index
+        player_ids = graph._player_ids
+
+        def index_of(player_id):
+            index = player_index.get(player_id)
+            if index is None:
+                index = len(player_ids)
+                player_index[player_id] = index
+                player_ids.append(player_id)
+            return index
+
+        # First pass: gather the edges in arrival order
+        losers = array('l')
+        winners = array('l')
+        dates = array('q')
+        online = bytearray()
+        for (set_id, winner_id, loser_id, start_date, is_online) in rows:
+            winners.append(index_of(winner_id))
+            losers.append(index_of(loser_id))
+            dates.append(NULL_DATE_KEY if start_date is None
+                         else start_date.toordinal())
+            online.append(1 if is_online else 0)
+            graph._set_ids.append(set_id)
+
+        # Second pass: counting sort of the edges by loser
+        players_count = len(player_ids)
+        edges_count = len(winners)
+        offsets = array('l', [0]) * (players_count + 1)
+        for loser in losers:
+            offsets[loser + 1] += 1
+        for i in range(players_count):
+            offsets[i + 1] += offsets[i]
+        cursor = array('l', offsets)
+        graph._winners = array('l', [0]) * edges_count
+        graph._edge_sets = array('l', [0]) * edges_count
+        graph._edge_dates = array('q', [0]) * edges_count
+        graph._edge_online = bytearray(edges_count)
+        for set_index in range(edges_count):
+            position = cursor[losers[set_index]]
+            cursor[losers[set_index]] += 1
+            graph._winners[position] = winners[set_index]
+            graph._edge_sets[position] = set_index
+            graph._edge_dates[position] = dates[set_index]
+            graph._edge_online[position] = online[set_index]
+        graph._offsets = offsets
+
+        logger.info('Loaded upset graph with %s players and %s sets'
+                    % (players_count, edges_count))
+        return graph
+
+    def player_index(self, player_id):
+        """Return the index of a player id, None if the player has no sets
+        """
+        return self._player_index.get(player_id)
+
+    def player_id(self, index):
+        """Return the player id of a player index
+        """
+        return self._player_ids[index]
+
+    def set_id(self, index):
+        """Return the set id of a set index
+        """
+        return self._set_ids[index]
+
+    def bfs(self, root_player_id, offline_only=False):
+        """Run the upset tree BFS, yielding the tree layers one by one
+
+        Each layer is a list of (winner_index, loser_index, set_index)
+        tuples, where the loser is the winner's parent in the tree and the
+        set is the most recent upset of the winner against any player of the
+        previous layer. The root layer itself is not yielded. Online sets
+        are skipped when offline_only is True.
+        """
+        root = self._player_index.get(root_player_id)
+        if root is None:
+            return
+        offsets = self._offsets
+        winners = self._winners
+        edge_sets = self._edge_sets
+        edge_dates = self._edge_dates
+        edge_online = self._edge_online
+        seen = bytearray(len(self._player_ids))
+        seen[root] = 1
+        frontier = [root]
+
+        while frontier:
+            # winner index -> ((date key, -set index), loser index)
+            best = {}
+            for loser in frontier:
+                for edge in range(offsets[loser], offsets[loser + 1]):
+                    winner = winners[edge]
+                    if seen[winner] or (offline_only and edge_online[edge]):
+                        continue
+                    candidate = (edge_dates[edge], -edge_sets[edge])
+                    current = best.get(winner)
+                    # On equal dates the first set in pk order is kept
+                    if current is None or candidate > current[0]:
+                        best[winner] = (candidate, loser)
+            if not best:
+                return
+            layer = [(winner, loser, -key[1])
+                     for winner, (key, loser) in best.items()]
+            for winner in best:
+                seen[winner] = 1
+            frontier = list(best)
+            yield layer
+
+    def _wins_index(self):
+        """Return the CSR of the edges keyed by winner, built on first use
+
+        The wins of the player of index i are the positions between
+        win_offsets[i] and win_offsets[i+1] of the (win_offsets, losers,
+        edges) arrays returned: losers holds the loser player index of each
+        win and edges its position in the edge arrays keyed by loser, which
+        hold the other per-edge data.
+        """
+        if self._wins is not None:
+            return self._wins
+        offsets = self._offsets
+        winners = self._winners
+        players_count = len(self._player_ids)
+        edges_count = len(winners)
+        win_offsets = array('l', [0]) * (players_count + 1)
+        for winner in winners:
+            win_offsets[winner + 1] += 1
+        for i in range(players_count):
+            win_offsets[i + 1] += win_offsets[i]
+        cursor = array('l', win_offsets)
+        losers = array('l', [0]) * edges_count
+        edges = array('l', [0]) * edges_count
+        for loser in range(players_count):
+            for edge in range(offsets[loser], offsets[loser + 1]):
+                position = cursor[winners[edge]]
+                cursor[winners[edge]] += 1
+                losers[position] = loser
+                edges[position] = edge
+        # A concurrent build gives the same arrays, the last one is kept
+        self._wins = (win_offsets, losers, edges)
+        return self._wins
+
+    def shortest_path(self, player_id, target_player_id, offline_only=False):
+        """Return the set indexes of the shortest upset path between two
+        players
+
+        The path goes from the player, who won the first set, to the target
+        player, who lost the last one. It is the path of the player in the
+        upset tree of the target player: among the shortest paths, each set
+        is the most recent upset of its winner against a player one step
+        closer to the target, see bfs. Online sets are skipped when
+        offline_only is True. None is returned if there is no path, an empty
+        list if both players are the same.
+
+        The distances are found by a bidirectional BFS, following the wins
+        from the player and the loses from the target, always expanding the
+        smaller frontier, so that only a fraction of the graph is visited.
+        """
+        source = self._player_index.get(player_id)
+        target = self._player_index.get(target_player_id)
+        if player_id == target_player_id:
+            return []
+        if source is None or target is None:
+            return None
+        (win_offsets, win_losers, win_edges) = self._wins_index()
+        offsets = self._offsets
+        winners = self._winners
+        edge_sets = self._edge_sets
+        edge_dates = self._edge_dates
+        edge_online = self._edge_online
+
+        # player index -> number of sets from the player, to the target
+        from_source = {source: 0}
+        to_target = {target: 0}
+        source_layers = [[source]]
+        target_frontier = [target]
+        meeting = []
+        while not meeting and source_layers[-1] and target_frontier:
+            if len(source_layers[-1]) <= len(target_frontier):
+                depth = len(source_layers)
+                layer = []
+                for winner in source_layers[-1]:
+                    for position in range(win_offsets[winner],
+                                          win_offsets[winner + 1]):
+                        loser = win_losers[position]
+                        if loser in from_source or (
+                                offline_only
+                                and edge_online[win_edges[position]]):
+                            continue
+                        from_source[loser] = depth
+                        layer.append(loser)
+                source_layers.append(layer)
+                meeting = [player for player in layer if player in to_target]
+            else:
+                depth = to_target[target_frontier[0]] + 1
+                layer = []
+                for loser in target_frontier:
+                    for edge in range(offsets[loser], offsets[loser + 1]):
+                        winner = winners[edge]
+                        if winner in to_target or (
+                                offline_only and edge_online[edge]):
+                            continue
+                        to_target[winner] = depth
+                        layer.append(winner)
+                target_frontier = layer
+                meeting = [player for player in layer
+                           if player in from_source]
+        if not meeting:
+            return None
+        # The first meeting players are all at the same distances, from the
+        # last layer of the player side
+        length = from_source[meeting[0]] + to_target[meeting[0]]
+
+        # The players of the player side on a shortest path, the ones with
+        # a win against such a player of the next layer
+        on_path = set(meeting)
+        next_layer = set(meeting)
+        for layer in reversed(source_layers[:-1]):
+            layer_on_path = set()
+            for winner in layer:
+                for position in range(win_offsets[winner],
+                                      win_offsets[winner + 1]):
+                    if win_losers[position] in next_layer and not (
+                            offline_only
+                            and edge_online[win_edges[position]]):
+                        layer_on_path.add(winner)
+                        break
+            on_path |= layer_on_path
+            next_layer = layer_on_path
+
+        def distance(player):
+            if player in on_path:
+                return length - from_source[player]
+            return to_target.get(player)
+
+        # Walk from the player, picking the most recent upset one step
+        # closer to the target at each step
+        path = []
+        current = source
+        while current != target:
+            best = None
+            for position in range(win_offsets[current],
+                                  win_offsets[current + 1]):
+                edge = win_edges[position]
+                if offline_only and edge_online[edge]:
+                    continue
+                loser = win_losers[position]
+                if distance(loser) != length - len(path) - 1:
+                    continue
+                candidate = (edge_dates[edge], -edge_sets[edge])
+                # On equal dates the first set in pk order is kept
+                if best is None or candidate > best[0]:
+                    best = (candidate, loser)
+            path.append(-best[0][1])
+            current = best[1]
+        return path
+
+
+class UpsetGraphHolder:
+    """The process-local upset graph of the API, loaded lazily
+
+    The graph answers the shortest upset paths between any two players, see
+    UpsetGraph.shortest_path. It is loaded on first use (or at warmup when
+    the UPSET_GRAPH_WARMUP setting is on), then loaded again in a background
+    thread once a new tree is ready or updated, which means a data import
+    finished, or once it is older than UPSET_GRAPH_MAX_AGE seconds. The
+    previous graph keeps serving the requests meanwhile.
+
+    Methods
+    -------
+    warmup()
+        Load the graph if it isn't loaded yet
+    get()
+        Return the current graph
+    """
+
+    def __init__(self):
+        # (graph, registry generation, monotonic load time)
+        self._entry = None
+        self._lock = threading.Lock()
+        self._loading = False
+
+    def warmup(self):
+        """Load the graph if it isn't loaded yet
+        """
+        if self._entry is None:
+            self._load()
+
+    def _load(self):
+        # Resolve the trees first so that their generation is the current one
+        container_registry.get(offline_only=False)
+        generation = container_registry.generation
+        graph = UpsetGraph.load()
+        graph._wins_index()
+        self._entry = (graph, generation, time.monotonic())
+
+    def _load_in_background(self):
+        with self._lock:
+            if self._loading:
+                return
+            self._loading = True
+
+        def run():
+            try:
+                self._load()
+            except Exception:
+                logger.exception('Failed to reload the upset graph')
+            finally:
+                self._loading = False
+                connection.close()
+        threading.Thread(target=run, daemon=True).start()
+
+    def get(self):
+        """Return the current graph
+        """
+        # Resolving the online tree updates the registry generation
+        container_registry.get(offline_only=False)
+        entry = self._entry
+        if entry is None:
+            self._load()
+            entry = self._entry
+        elif entry[1] != container_registry.generation \
+                or time.monotonic() - entry[2] > \
+                settings.UPSET_GRAPH_MAX_AGE:
+            self._load_in_background()
+        return entry[0]
+
+
+# The graph shared by the whole process
+upset_graph = UpsetGraphHolder()
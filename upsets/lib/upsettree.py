@@ -1,6 +1,15 @@
-from upsets.models import Set, UpsetTreeNode, TreeContainer
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from upsets.models import Player, UpsetTreeNode, TreeContainer
+from upsets.lib.upsetgraph import UpsetGraph, qualifying_sets
+from upsets.lib.pathcache import UpsetPathCache
+from upsets.lib.containers import container_registry
+from upsets.lib.treesnapshot import write_snapshot
 from utils.decorators import time_it
-from django.db.models import Q, Prefetch
+from utils.instrumentation import phase, current_phase, phased
+from django.db import connection, transaction
+from django.db.models import F, Prefetch
 # LOGGING
 import logging
 logger = logging.getLogger('data_processing')
@@ -18,27 +27,48 @@ class UpsetTreeManager:
     players, but in the case of a fixed target player it makes the processing
     simpler but mainly faster, for quick enduser results.
 
+    The tree can be built by two engines: 'sql' runs one query per tree
+    layer, 'graph' streams all the sets once in an in-memory UpsetGraph and
+    runs the BFS in Python. Both build the same tree. With the graph engine
+    the online and offline only trees are built from a single graph load,
+    and the ready trees can also be updated incrementally: only the nodes
+    which differ from a full rebuild are written.
+
     Attributes
     ----------
     _root_player_id: str
         The id of the player to use as the target player
+    _engine: str
+        The engine used to build the trees, 'graph' or 'sql'
 
     Methods
     -------
-    create_from_scratch()
+    create_from_scratch(tree_container, graph)
         Create the upset tree from scratch for the given tree_container
-    update_tree()
+    update_in_place(tree_container, graph)
+        Write in the given tree_container only its nodes which changed
+    update_tree(offline_only, graph, prerender, incremental)
         Update the upset tree using a container to assure zero downtime
-    update_all_trees()
+    update_all_trees(parallel, prerender, incremental)
         Update both online and offline upset trees
     """
 
-    def __init__(self, root_player_id):
+    ENGINES = ('graph', 'sql')
+
+    def __init__(self, root_player_id, engine='graph'):
+        if engine not in self.ENGINES:
+            raise ValueError('Unknown tree engine %s, possibles are %s.'
+                             % (engine, ', '.join(self.ENGINES)))
         self._root_player_id = root_player_id
+        self._engine = engine
 
     @time_it(logger)
-    def create_from_scratch(self, tree_container):
+    def create_from_scratch(self, tree_container, graph=None, layers=None):
         """Create the upset tree from scratch for the given tree_container
+
+        With the graph engine, an already loaded UpsetGraph can be given to
+        avoid loading the sets again, and the layers of its BFS if they are
+        already computed, see MultiRootTreeManager.
         """
         root = UpsetTreeNode(
             player_id=self._root_player_id,
@@ -46,84 +76,440 @@ class UpsetTreeManager:
             tree_container=tree_container)
         root.save()
 
+        if self._engine == 'graph':
+            self._create_from_graph(tree_container, root, graph, layers)
+        else:
+            self._create_from_sql(tree_container, root)
+
+    def _create_from_graph(self, tree_container, root, graph=None,
+                           layers=None):
+        """Build the tree layers with an in-memory BFS on the upset graph
+        """
+        if graph is None:
+            graph = UpsetGraph.load()
+        if layers is None:
+            layers = graph.bfs(self._root_player_id,
+                               offline_only=tree_container.offline_only)
+        # player index -> node of the previous layer
+        parent_nodes = {graph.player_index(self._root_player_id): root}
+        current_depth = 0
+        for layer in phased(layers, 'layer %s', rows=len):
+            current_depth += 1
+            nodes = {}
+            for (winner, loser, set_index) in layer:
+                parent = parent_nodes[loser]
+                nodes[winner] = UpsetTreeNode(
+                    player_id=graph.player_id(winner),
+                    parent=parent,
+                    ancestors=[parent.id] + parent.ancestors,
+                    upset_id=graph.set_id(set_index),
+                    node_depth=current_depth,
+                    tree_container=tree_container)
+            # bulk_create sets the primary keys on postgres, which are
+            # needed as parent ids for the next layer
+            UpsetTreeNode.objects.bulk_create(
+                nodes.values(), batch_size=10000)
+            parent_nodes = nodes
+            logger.info('Processed %s Players in layer #%s'
+                        % (len(nodes), current_depth))
+        logger.info('No players in layer #%s, the tree is now completed.'
+                    % (current_depth+1))
+
+    def _create_from_sql(self, tree_container, root):
+        """Build the tree layers with one SQL query per layer
+        """
         cont = True
         current_depth = 0
         target_players_ids = [self._root_player_id]
         seen_players_ids = [self._root_player_id]
 
-        sets = Set.objects.all()
-        if tree_container.offline_only:
-            sets = sets.exclude(tournament__online=True)
+        sets = qualifying_sets(tree_container.offline_only)
 
         while cont:
-            logger.info(
-                'Processing Upset Tree layer #%s...' % (current_depth+1))
-            upsets = sets \
-                .exclude(winner_id__in=seen_players_ids) \
-                .filter(loser_id__in=target_players_ids) \
-                .exclude(Q(winner_score=-1) | Q(loser_score=-1)) \
-                .exclude(Q(winner_score=0) & Q(loser_score=0)) \
-                .order_by('winner_id', '-tournament__start_date') \
-                .distinct('winner_id') \
-                .prefetch_related(Prefetch(
-                    'loser__upsettreenode_set',
-                    queryset=UpsetTreeNode.objects.filter(
-                        tree_container_id=tree_container.id),
-                    to_attr='matching_nodes'))
-            # .distinct('col_name') works only on postgres and select the
-            # first row given the order_by placed before (see django doc)
-            # Here, we keep the most recent upset of all the possible ones.
-            # .select_related to pretetch the upset nodes needed later
-
-            if upsets:
-                current_depth += 1
-                to_bulk_create = []
-                players_ids = []
-                for upset in upsets:
-                    elt = UpsetTreeNode(
-                        # directly use winner_id to avoid fetching the player
-                        # object related to the upset
-                        player_id=upset.winner_id,
-                        parent=upset.loser.matching_nodes[0],
-                        upset=upset,
-                        node_depth=current_depth,
-                        tree_container=tree_container)
-                    to_bulk_create.append(elt)
-                    players_ids.append(upset.winner_id)
-
-                seen_players_ids += players_ids
-                target_players_ids = players_ids
-                UpsetTreeNode.objects.bulk_create(to_bulk_create)
+            # The query of the layer and the writes of its nodes
+            with phase('layer %s' % (current_depth+1)) as current:
                 logger.info(
-                    'Processed %s Players in layer #%s'
-                    % (len(to_bulk_create), current_depth))
-            else:
-                cont = False
-                logger.info(
-                    'No players in layer #%s, the tree is now completed.'
-                    % current_depth)
+                    'Processing Upset Tree layer #%s...' % (current_depth+1))
+                upsets = sets \
+                    .exclude(winner_id__in=seen_players_ids) \
+                    .filter(loser_id__in=target_players_ids) \
+                    .order_by('winner_id', '-tournament__start_date') \
+                    .distinct('winner_id') \
+                    .prefetch_related(Prefetch(
+                        'loser__upsettreenode_set',
+                        queryset=UpsetTreeNode.objects.filter(
+                            tree_container_id=tree_container.id),
+                        to_attr='matching_nodes'))
+                # .distinct('col_name') works only on postgres and select
+                # the first row given the order_by placed before (see django
+                # doc) Here, we keep the most recent upset of all the
+                # possible ones.
+                # .select_related to pretetch the upset nodes needed later
+
+                if upsets:
+                    current_depth += 1
+                    to_bulk_create = []
+                    players_ids = []
+                    for upset in upsets:
+                        parent = upset.loser.matching_nodes[0]
+                        elt = UpsetTreeNode(
+                            # directly use winner_id to avoid fetching the
+                            # player object related to the upset
+                            player_id=upset.winner_id,
+                            parent=parent,
+                            ancestors=[parent.id] + parent.ancestors,
+                            upset=upset,
+                            node_depth=current_depth,
+                            tree_container=tree_container)
+                        to_bulk_create.append(elt)
+                        players_ids.append(upset.winner_id)
+
+                    seen_players_ids += players_ids
+                    target_players_ids = players_ids
+                    UpsetTreeNode.objects.bulk_create(to_bulk_create)
+                    current.rows = len(to_bulk_create)
+                    logger.info(
+                        'Processed %s Players in layer #%s'
+                        % (len(to_bulk_create), current_depth))
+                else:
+                    cont = False
+                    current.rows = 0
+                    logger.info(
+                        'No players in layer #%s, the tree is now completed.'
+                        % current_depth)
+
+    @time_it(logger)
+    def update_in_place(self, tree_container, graph=None, layers=None):
+        """Write in the given tree_container only its nodes which changed
+
+        The BFS runs on the whole graph, which takes little time in memory,
+        and its layers are compared with the stored nodes: the nodes of the
+        players which left the tree are deleted, the ones of the new players
+        are created, and only the nodes whose depth, upset, parent or
+        ancestors changed are updated. The nodes of the players staying in
+        the tree keep their primary key, so a node whose parent didn't move
+        keeps the same ancestors. The result is the same tree as a full
+        rebuild with the graph engine. The layers of the BFS can be given if
+        they are already computed.
 
-    def update_tree(self, offline_only=False):
+        Return the numbers of created, updated and deleted nodes.
+        """
+        if graph is None:
+            graph = UpsetGraph.load()
+        if layers is None:
+            layers = graph.bfs(self._root_player_id,
+                               offline_only=tree_container.offline_only)
+        # player id -> (node id, parent node id, upset id, depth)
+        # A single streamed query rather than keyset_iterator: the rows are
+        # plain tuples with nothing to prefetch
+        stored = {
+            player_id: (node_id, parent_id, upset_id, depth)
+            for (node_id, player_id, parent_id, upset_id, depth)
+            in UpsetTreeNode.objects
+            .filter(tree_container=tree_container)
+            .values_list('id', 'player_id', 'parent_id', 'upset_id',
+                         'node_depth')
+            .iterator(chunk_size=20000)}
+        root = stored.pop(self._root_player_id)
+        # player index -> (node id, ancestors, whether the ancestors
+        # changed) of the previous layer
+        parent_nodes = {
+            graph.player_index(self._root_player_id): (root[0], [], False)}
+        created = updated = 0
+        current_depth = 0
+        for layer in phased(layers, 'layer %s', rows=len):
+            current_depth += 1
+            nodes = {}
+            to_create = {}
+            to_update = []
+            for (winner, loser, set_index) in layer:
+                parent_id, parent_ancestors, moved = parent_nodes[loser]
+                player_id = graph.player_id(winner)
+                upset_id = graph.set_id(set_index)
+                node = UpsetTreeNode(
+                    player_id=player_id,
+                    parent_id=parent_id,
+                    ancestors=[parent_id] + parent_ancestors,
+                    upset_id=upset_id,
+                    node_depth=current_depth,
+                    tree_container=tree_container)
+                previous = stored.pop(player_id, None)
+                if previous is None:
+                    to_create[winner] = node
+                    continue
+                node.id = previous[0]
+                moved = moved or previous[1] != parent_id
+                if moved or previous[2:] != (upset_id, current_depth):
+                    to_update.append(node)
+                nodes[winner] = (node.id, node.ancestors, moved)
+            # The created nodes get their primary keys, needed as parent ids
+            # for the next layer
+            UpsetTreeNode.objects.bulk_create(
+                to_create.values(), batch_size=10000)
+            UpsetTreeNode.objects \
+                .filter(tree_container=tree_container) \
+                .bulk_update(
+                    to_update, ['parent', 'upset', 'node_depth', 'ancestors'],
+                    batch_size=1000)
+            for winner, node in to_create.items():
+                nodes[winner] = (node.id, node.ancestors, True)
+            parent_nodes = nodes
+            created += len(to_create)
+            updated += len(to_update)
+            logger.info('Layer #%s: %s Players, %s new and %s updated nodes'
+                        % (current_depth, len(nodes), len(to_create),
+                           len(to_update)))
+        # The remaining nodes belong to players who left the tree, no node
+        # points to them anymore.
+        UpsetTreeNode.objects \
+            .filter(tree_container=tree_container,
+                    id__in=[node[0] for node in stored.values()]) \
+            .delete()
+        return created, updated, len(stored)
+
+    def _incremental_container(self, offline_only):
+        """Return the ready container which can be updated in place, if any
+        """
+        return TreeContainer.objects \
+            .filter(ready=True, offline_only=offline_only,
+                    root_player_id=self._root_player_id) \
+            .order_by('-update_date') \
+            .first()
+
+    def update_tree(self, offline_only=False, graph=None, prerender=False,
+                    incremental=False, layers=None):
         """Update the upset tree using a container to assure zero downtime
+
+        With prerender, all the paths of the new tree are serialized in the
+        path cache before the tree is marked as ready. The cached responses
+        are keyed by container, so the swap itself invalidates them.
+
+        With incremental and the graph engine, the ready tree is updated in
+        place in a single transaction, see update_in_place, and its revision
+        is incremented so that the cached responses are invalidated too. A
+        full rebuild is done when there is no ready tree of the same root.
+
+        The layers of the BFS of the graph engine can be given if they are
+        already computed. When TREE_SNAPSHOT_DIR is set, the snapshot of the
+        tree is written before it is served, see TreeSnapshot.
         """
         str_type = "Offline" if offline_only else "Online"
-        logger.info("Building new %s Upset Tree." % str_type)
+        if incremental and self._engine != 'graph':
+            raise ValueError('Incremental updates need the graph engine.')
+        container = self._incremental_container(offline_only) \
+            if incremental else None
 
-        container = TreeContainer.objects.create(offline_only=offline_only)
-        self.create_from_scratch(container)
+        if container is not None:
+            logger.info("Updating the %s Upset Tree in place." % str_type)
+            with transaction.atomic():
+                created, updated, deleted = self.update_in_place(
+                    container, graph=graph, layers=layers)
+                container.revision += 1
+                container.save()
+                if prerender:
+                    UpsetPathCache().prerender(container)
+                with phase('snapshot'):
+                    write_snapshot(container)
+            logger.info("Updated the %s Upset Tree: %s created, %s updated "
+                        "and %s deleted nodes."
+                        % (str_type, created, updated, deleted))
+            container_registry.reload(offline_only, self._root_player_id)
+            return
+
+        logger.info("Building new %s Upset Tree of %s."
+                    % (str_type, self._root_player_id))
+        container = TreeContainer.objects.create(
+            offline_only=offline_only, root_player_id=self._root_player_id)
+        self.create_from_scratch(container, graph=graph, layers=layers)
+        if prerender:
+            UpsetPathCache().prerender(container)
+        with phase('snapshot'):
+            write_snapshot(container)
         # When all the data is built, switch the container to ready and
-        # delete the past container (the cascade will delete the related
-        # update tree nodes)
+        # delete the past container (with the partition of its nodes, see
+        # TreeContainer)
         container.ready = True
         container.save()
         logger.info("The new Tree data is ready, deleting the old data...")
-        TreeContainer.objects.filter(offline_only=offline_only) \
+        TreeContainer.objects.filter(offline_only=offline_only,
+                                     root_player_id=self._root_player_id) \
                              .exclude(id=container.id) \
                              .delete()
         logger.info("Successfully deleted old %s Tree data." % str_type)
+        # Serve the new tree right away if this process also serves the API
+        container_registry.reload(offline_only, self._root_player_id)
 
-    def update_all_trees(self):
+    @time_it(logger)
+    def update_all_trees(self, parallel=False, prerender=False,
+                         incremental=False, graph=None):
         """Update both online and offline upset trees
+
+        The sets are loaded once for both trees with the graph engine, an
+        already loaded graph can also be given. With parallel, the trees are
+        built in two threads, each with its own DB connection, so that the
+        writes of one tree overlap the BFS of the other.
         """
-        self.update_tree(offline_only=False)
-        self.update_tree(offline_only=True)
+        if self._engine == 'graph' and graph is None:
+            with phase('load_graph'):
+                graph = UpsetGraph.load()
+        # The phases of the trees are recorded in the phase of this call,
+        # even from the building threads
+        parent = current_phase()
+
+        def build(offline_only):
+            with phase('update_tree %s'
+                       % ('offline' if offline_only else 'online'),
+                       parent=parent):
+                self.update_tree(offline_only=offline_only, graph=graph,
+                                 prerender=prerender,
+                                 incremental=incremental)
+
+        if not parallel:
+            build(False)
+            build(True)
+            return
+
+        def build_in_thread(offline_only):
+            try:
+                build(offline_only)
+            finally:
+                # Django opens one connection per thread, close it here as
+                # the thread won't be reused by the request cycle
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(build_in_thread, offline_only)
+                       for offline_only in (False, True)]
+            # Raise the first exception from the building threads, if any
+            for future in futures:
+                future.result()
+
+
+# The graph of the BFS worker processes, see MultiRootTreeManager
+_pool_graph = None
+
+
+def _init_bfs_worker(graph):
+    global _pool_graph
+    _pool_graph = graph
+
+
+def _bfs_layers(task):
+    """Return the BFS layers of a (root player id, offline_only) task, run
+    in a worker process
+    """
+    (root_player_id, offline_only) = task
+    return list(_pool_graph.bfs(root_player_id, offline_only=offline_only))
+
+
+class MultiRootTreeManager:
+    """A manager to update the upset trees of several root players
+
+    With the graph engine, the sets are loaded once in an UpsetGraph for
+    all the trees. With more than one process, the BFS of the trees run in
+    a process pool forked once the graph is loaded, so that the workers
+    share it, while this process writes the trees as their layers come
+    back, in the order of the roots. Otherwise each root is updated in turn
+    by its UpsetTreeManager, its online and offline trees being built in
+    two threads with parallel.
+
+    The roots which aren't players of the DB are skipped, as their tree
+    can't have a root node.
+
+    Attributes
+    ----------
+    _root_player_ids: list of str
+        The ids of the root players
+    _engine: str
+        The engine used to build the trees, 'graph' or 'sql'
+    _processes: int
+        The number of processes running the BFS of the trees
+
+    Methods
+    -------
+    update_all_trees(parallel, prerender, incremental)
+        Update the online and offline upset trees of all the roots
+    """
+
+    def __init__(self, root_player_ids, engine='graph', processes=1):
+        if engine not in UpsetTreeManager.ENGINES:
+            raise ValueError('Unknown tree engine %s, possibles are %s.'
+                             % (engine, ', '.join(UpsetTreeManager.ENGINES)))
+        self._root_player_ids = list(dict.fromkeys(root_player_ids))
+        self._engine = engine
+        self._processes = processes
+
+    @time_it(logger)
+    def update_all_trees(self, parallel=False, prerender=False,
+                         incremental=False):
+        """Update the online and offline upset trees of all the roots
+        """
+        existing = set(Player.objects
+                       .filter(id__in=self._root_player_ids)
+                       .values_list('id', flat=True))
+        roots = []
+        for root_player_id in self._root_player_ids:
+            if root_player_id in existing:
+                roots.append(root_player_id)
+            else:
+                logger.warning('Unknown root player %s, skipping its trees.'
+                               % root_player_id)
+        graph = None
+        if self._engine == 'graph':
+            with phase('load_graph'):
+                graph = UpsetGraph.load()
+
+        if graph is None or self._processes <= 1:
+            for root_player_id in roots:
+                with phase('root %s' % root_player_id):
+                    UpsetTreeManager(root_player_id, engine=self._engine) \
+                        .update_all_trees(parallel=parallel,
+                                          prerender=prerender,
+                                          incremental=incremental,
+                                          graph=graph)
+            return
+
+        tasks = deque((root_player_id, offline_only)
+                      for root_player_id in roots
+                      for offline_only in (False, True))
+        pending = deque()
+        with multiprocessing.Pool(
+                self._processes, initializer=_init_bfs_worker,
+                initargs=(graph,)) as pool:
+            while tasks or pending:
+                # At most two trees per process are computed ahead of the
+                # writes, so that their layers don't pile up in memory
+                while tasks and len(pending) < 2 * self._processes:
+                    task = tasks.popleft()
+                    pending.append(
+                        (task, pool.apply_async(_bfs_layers, (task, ))))
+                ((root_player_id, offline_only), result) = pending.popleft()
+                with phase('update_tree %s %s' % (
+                        root_player_id,
+                        'offline' if offline_only else 'online')):
+                    UpsetTreeManager(root_player_id, engine=self._engine) \
+                        .update_tree(offline_only=offline_only, graph=graph,
+                                     prerender=prerender,
+                                     incremental=incremental,
+                                     layers=result.get())
+
+
+def refresh_tree_revisions():
+    """Increment the revision of all the ready trees, once their players
+    were processed
+
+    The nodes don't change, but the served paths hold processed fields of
+    the players, like their main character. The new revisions invalidate
+    the cached responses and the snapshots, which are written again, and
+    change the generation of the container registry, which rebuilds the
+    process-local structures depending on the players, like the player
+    search index. The other processes see it once their registry entries
+    expire.
+    """
+    trees = TreeContainer.objects.filter(ready=True)
+    trees.update(revision=F('revision') + 1)
+    for container in trees:
+        with phase('snapshot'):
+            write_snapshot(container)
+        container_registry.reload(container.offline_only,
+                                  container.root_player_id)
@@ -0,0 +1,459 @@
+import ast
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from upsets.models import Player, TreeContainer, UpsetTreeNode
+from upsets.lib.upsettree import UpsetTreeManager
+from upsets.lib.playersearch import search_players, scan_search_players
+from upsets.lib.searchindex import PlayerSearchIndex
+from upsets.lib.archiveparser import parse_games, parse_round_name, \
+    literal_eval_games
+from upsets.lib.synthetic import SyntheticArchive, write_synthetic_archive
+from upsets.lib.requestmetrics import request_metrics
+from upsets.lib.theplayerdatabase import SqliteArchiveReader
+from upsets.lib.playerprocessor import PlayerProcessor
+from utils.decorators import log_exceptions
+from utils.instrumentation import RunReport, phase
+# LOGGING
+import logging
+logger = logging.getLogger('data_processing')
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the data processing on the current DB data'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            type=str,
+            choices=['trees', 'search', 'archive', 'parsers', 'loader',
+                     'players', 'suite'],
+            help='What to benchmark.')
+        parser.add_argument(
+            '--root',
+            type=str,
+            default=settings.DEFAULT_ROOT_PLAYER_ID,
+            help='Root player id of the benchmarked trees.')
+        parser.add_argument(
+            '--offline-only',
+            action='store_true',
+            help='Benchmark the offline only trees.')
+        parser.add_argument(
+            '--players',
+            type=int,
+            help=('Number of synthetic players, a million for the search '
+                  + 'benchmark and a tenth of the sets for the suite by '
+                  + 'default.'))
+        parser.add_argument(
+            '--sets',
+            type=int,
+            default=5000,
+            help='Number of sets of the smallest synthetic archive.')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10000,
+            help='Chunk size of the archive reader.')
+        parser.add_argument(
+            '--archive',
+            type=str,
+            help=('Sqlite archive to take the parsers samples from, a '
+                  + 'synthetic one is used by default.'))
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Seed of the synthetic data of the suite.')
+        parser.add_argument(
+            '--direct',
+            action='store_true',
+            help=('Write the synthetic data of the suite straight into the '
+                  + 'DB instead of timing the import of an archive.'))
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Number of requests per endpoint of the suite load test.')
+        parser.add_argument(
+            '--output',
+            type=str,
+            help='JSON file to write the suite results to.')
+
+    @log_exceptions(logger)
+    def handle(self, *args, **options):
+        getattr(self, 'benchmark_%s' % options['target'])(options)
+
+    def benchmark_trees(self, options):
+        """Build the same tree with every engine and compare them
+        """
+        trees = {}
+        for engine in UpsetTreeManager.ENGINES:
+            manager = UpsetTreeManager(options['root'], engine=engine)
+            # The container is never marked as ready, so the API won't
+            # serve it while we benchmark
+            container = TreeContainer.objects.create(
+                offline_only=options['offline_only'],
+                root_player_id=options['root'])
+            try:
+                ts = time.perf_counter()
+                manager.create_from_scratch(container)
+                elapsed = time.perf_counter() - ts
+                trees[engine] = {
+                    player_id: (depth, upset_id)
+                    for (player_id, depth, upset_id) in UpsetTreeNode.objects
+                    .filter(tree_container=container)
+                    .values_list('player_id', 'node_depth', 'upset_id')}
+            finally:
+                container.delete()
+            self.stdout.write('%s engine: %.2fs for %s nodes'
+                              % (engine, elapsed, len(trees[engine])))
+
+        reference, *others = trees.values()
+        for engine, tree in zip(UpsetTreeManager.ENGINES[1:], others):
+            depths_match = {k: v[0] for k, v in tree.items()} == \
+                {k: v[0] for k, v in reference.items()}
+            # Equal depth upsets on the same date can legitimately differ
+            same_upsets = sum(1 for player_id, value in tree.items()
+                              if reference.get(player_id) == value)
+            self.stdout.write(
+                '%s engine: depths %s, %s/%s identical upsets'
+                % (engine, 'match' if depths_match else 'DIFFER',
+                   same_upsets, len(tree)))
+
+    def benchmark_search(self, options):
+        """Compare the player search queries on a synthetic Player table
+
+        The synthetic players are inserted in a transaction which is rolled
+        back at the end, the DB is left untouched.
+        """
+        terms = ['a', 'le', 'leo', 'mkleo', 'kami', 'zé', 'ra', 'ikora',
+                 'tsu', 'momo', 'xyz']
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT setseed(0.42)")
+                # Tags made of 1 to 3 random syllables, some accentuated
+                cursor.execute("""
+                    WITH syllables AS (
+                        SELECT ARRAY['ka', 'mi', 'le', 'o', 'ré', 'zé',
+                                     'ta', 'su', 'ko', 'ra', 'mö', 'ni',
+                                     'mk', 'ga', 'yu', 'bé', 'ri', 'to']
+                            AS s)
+                    INSERT INTO upsets_player (
+                        id, tag, played_sets_count, search_tag)
+                    SELECT 'bench-' || i,
+                        s[1 + floor(random() * 18)::int]
+                        || s[1 + floor(random() * 18)::int]
+                        || CASE WHEN random() < 0.5
+                           THEN s[1 + floor(random() * 18)::int] ELSE ''
+                           END,
+                        floor(random() * 1000)::int, NULL
+                    FROM generate_series(1, %s) AS i, syllables
+                    """, [options['players'] or 1000000])
+                cursor.execute(
+                    "UPDATE upsets_player"
+                    " SET search_tag = UPPER(UNACCENT(tag))"
+                    " WHERE search_tag IS NULL")
+                cursor.execute("ANALYZE upsets_player")
+            self.stdout.write('Inserted %s synthetic players.'
+                              % (options['players'] or 1000000))
+            ts = time.perf_counter()
+            index = PlayerSearchIndex.build()
+            self.stdout.write('Built the in-process index in %.2fs.'
+                              % (time.perf_counter() - ts))
+
+            def index_search(term, limit=20):
+                return index.search(term.upper(), limit)
+
+            def index_players(term):
+                ids = [player['id'] for player in index_search(term)]
+                return sorted(Player.objects.filter(id__in=ids),
+                              key=lambda p: ids.index(p.id))
+
+            for term in terms:
+                with connection.cursor() as cursor:
+                    cursor.execute("SELECT UPPER(UNACCENT(%s))", [term])
+                    normalized_term = cursor.fetchone()[0]
+
+                def ranking(players):
+                    # Players with equal ranks can come in any order
+                    return [(p.search_tag == normalized_term,
+                             p.search_tag.startswith(normalized_term),
+                             p.played_sets_count) for p in players]
+
+                timings = {}
+                results = {}
+                for name, search in (('scan', scan_search_players),
+                                     ('indexed', search_players),
+                                     ('memory', index_search)):
+                    ts = time.perf_counter()
+                    for _ in range(3):
+                        results[name] = search(term)
+                    timings[name] = (time.perf_counter() - ts) / 3 * 1000
+                # The index only answers the ASCII terms, see searchindex
+                results['memory'] = index_players(term) \
+                    if term.isascii() else results['indexed']
+                self.stdout.write(
+                    '%-6s scan: %8.1fms  indexed: %8.1fms  memory: %6.2fms'
+                    '  results %s'
+                    % (term, timings['scan'], timings['indexed'],
+                       timings['memory'],
+                       'match' if ranking(results['scan']) ==
+                       ranking(results['indexed']) ==
+                       ranking(results['memory']) else 'DIFFER'))
+            transaction.set_rollback(True)
+
+    def benchmark_archive(self, options):
+        """Measure the peak Python memory of imports of growing archives
+
+        Synthetic archives of 1, 2 and 4 times --sets sets are imported in a
+        transaction which is rolled back, the DB is left untouched. With the
+        streamed reads the peak memory must not grow with the archive size,
+        the peak of a fetchall of the sets is given for comparison.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            for factor in (1, 2, 4):
+                path = os.path.join(directory, 'archive-%s.db' % factor)
+                sets = options['sets'] * factor
+                write_synthetic_archive(
+                    path, players=max(sets // 20, 2),
+                    tournaments=max(sets // 200, 1), sets=sets)
+
+                tracemalloc.start()
+                cur = sqlite3.connect(path).cursor()
+                cur.execute("SELECT * FROM sets")
+                rows = cur.fetchall()
+                fetchall_peak = tracemalloc.get_traced_memory()[1]
+                del rows
+                tracemalloc.stop()
+
+                reader = SqliteArchiveReader(
+                    path, chunk_size=options['chunk_size'])
+                with transaction.atomic():
+                    tracemalloc.start()
+                    ts = time.perf_counter()
+                    reader.update_all_data()
+                    elapsed = time.perf_counter() - ts
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+                    transaction.set_rollback(True)
+                self.stdout.write(
+                    '%8s sets: import peak %6.1fMB in %.1fs'
+                    ' (fetchall of the sets alone: %6.1fMB)'
+                    % (sets, peak / 2**20, elapsed, fetchall_peak / 2**20))
+
+    def benchmark_parsers(self, options):
+        """Compare the archive parsers with ast.literal_eval on sets samples
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = options['archive']
+            if path is None:
+                path = os.path.join(directory, 'archive.db')
+                write_synthetic_archive(
+                    path, players=1000, tournaments=100,
+                    sets=options['sets'])
+            samples = sqlite3.connect(path).execute(
+                "SELECT location_names, game_data FROM sets LIMIT ?",
+                [options['sets']]).fetchall()
+
+        def safe(parse, value):
+            try:
+                return parse(value)
+            except (ValueError, SyntaxError) as ex:
+                return type(ex)
+
+        for name, column, reference, parser in (
+                ('location_names', 0,
+                 lambda value: ast.literal_eval(value)[-1], parse_round_name),
+                ('game_data', 1, literal_eval_games, parse_games)):
+            values = [sample[column] for sample in samples]
+            timings = {}
+            results = {}
+            for engine, parse in (('literal_eval', reference),
+                                  ('parser', parser)):
+                ts = time.perf_counter()
+                results[engine] = [safe(parse, value) for value in values]
+                timings[engine] = time.perf_counter() - ts
+            self.stdout.write(
+                '%-14s literal_eval: %6.2fus  parser: %6.2fus  x%.1f'
+                '  results %s'
+                % (name, timings['literal_eval'] / len(values) * 1e6,
+                   timings['parser'] / len(values) * 1e6,
+                   timings['literal_eval'] / timings['parser'],
+                   'match' if results['literal_eval'] == results['parser']
+                   else 'DIFFER'))
+
+    def benchmark_loader(self, options):
+        """Compare the bulk engines importing the same synthetic archive
+
+        Each engine, serial then pipelined, imports the archive twice, in a
+        transaction which is rolled back: once in an empty DB, then once
+        again over its own unchanged rows, which is close to the nightly
+        update case. The DB is left untouched.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.db')
+            sets = options['sets']
+            write_synthetic_archive(path, players=max(sets // 20, 2),
+                                    tournaments=max(sets // 200, 1),
+                                    sets=sets)
+            for engine in SqliteArchiveReader.BULK_ENGINES:
+                for pipelined in (False, True):
+                    reader = SqliteArchiveReader(
+                        path, chunk_size=options['chunk_size'],
+                        bulk_engine=engine, pipelined=pipelined)
+                    timings = []
+                    with transaction.atomic():
+                        for _ in range(2):
+                            ts = time.perf_counter()
+                            reader.update_all_data()
+                            timings.append(time.perf_counter() - ts)
+                        transaction.set_rollback(True)
+                    self.stdout.write(
+                        '%-4s engine%s: %s sets created in %.1fs'
+                        ' (%d sets/s), imported again in %.1fs (%d sets/s)'
+                        % (engine, ', pipelined' if pipelined else '', sets,
+                           timings[0], sets / timings[0], timings[1],
+                           sets / timings[1]))
+
+    def benchmark_players(self, options):
+        """Compare the player processing engines on a synthetic archive
+
+        The archive of --sets sets is imported in a transaction which is
+        rolled back at the end, the DB is left untouched. Each engine
+        processes all the players from the same state.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'archive.db')
+            sets = options['sets']
+            write_synthetic_archive(path, players=max(sets // 20, 2),
+                                    tournaments=max(sets // 200, 1),
+                                    sets=sets)
+            with transaction.atomic():
+                SqliteArchiveReader(path, bulk_engine='copy') \
+                    .update_all_data()
+                results = {}
+                for engine in PlayerProcessor.ENGINES:
+                    with transaction.atomic():
+                        ts = time.perf_counter()
+                        processed = PlayerProcessor(engine=engine) \
+                            .process_all()
+                        elapsed = time.perf_counter() - ts
+                        results[engine] = dict(Player.objects.values_list(
+                            'id', 'played_sets_count'))
+                        transaction.set_rollback(True)
+                    self.stdout.write(
+                        '%-6s engine: %s players processed in %.2fs'
+                        % (engine, processed, elapsed))
+                transaction.set_rollback(True)
+        # The main characters and last tournaments can differ on ties, see
+        # PlayerProcessor, the tests check them
+        self.stdout.write('played sets counts %s' % (
+            'match' if results['python'] == results['sql'] else 'DIFFER'))
+
+    def benchmark_suite(self, options):
+        """Time the whole data processing and the API on synthetic data
+
+        A synthetic archive of --sets sets is generated, imported, then the
+        trees are built from its strongest player and the players are
+        processed, each step being recorded in a RunReport. The three
+        endpoints are then load tested with --requests requests each, on
+        random players, their latency percentiles are taken from the
+        request metrics, see RequestMetricsMiddleware. The requests are
+        served in this thread, without network nor concurrency.
+
+        Everything runs from empty tables in a transaction which is rolled
+        back at the end, the DB is left untouched. The tables are locked
+        meanwhile, the API can't use the DB during the suite. The results
+        are written as JSON to --output, to compare the runs.
+        """
+        sets = options['sets']
+        archive = SyntheticArchive(
+            players=options['players'] or max(sets // 10, 2),
+            tournaments=max(sets // 200, 1), sets=sets, seed=options['seed'])
+        report = RunReport('benchmark suite')
+        with tempfile.TemporaryDirectory() as directory, \
+                transaction.atomic(), report.activate():
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "TRUNCATE upsets_upsettreenode, upsets_treecontainer,"
+                    " upsets_twittertag, upsets_set, upsets_player,"
+                    " upsets_tournament")
+            if options['direct']:
+                with phase('write_db') as current:
+                    archive.write_db(chunk_size=options['chunk_size'])
+                    current.rows = sets
+            else:
+                path = os.path.join(directory, 'archive.db')
+                with phase('write_sqlite') as current:
+                    archive.write_sqlite(path)
+                    current.rows = sets
+                with phase('update_all_data') as current:
+                    SqliteArchiveReader(
+                        path, chunk_size=options['chunk_size'],
+                        bulk_engine='copy').update_all_data()
+                    current.rows = sets
+            UpsetTreeManager('p0').update_all_trees()
+            PlayerProcessor(engine='sql').process_all()
+            with phase('load_test') as current:
+                endpoints = self._load_test(archive, options['requests'])
+                current.rows = 3 * options['requests']
+            transaction.set_rollback(True)
+
+        results = report.to_dict()
+        results['parameters'] = {
+            'players': archive.players, 'tournaments': archive.tournaments,
+            'sets': archive.sets, 'seed': archive.seed,
+            'direct': options['direct'], 'requests': options['requests']}
+        results['endpoints'] = endpoints
+        for step in results['phases']:
+            self.stdout.write('%-16s %8.2fs  %6s queries%s' % (
+                step['name'], step['elapsed'], step['queries'],
+                '  %d rows/s' % step['rows_per_second']
+                if 'rows_per_second' in step else ''))
+        for (endpoint, stats) in endpoints.items():
+            self.stdout.write(
+                '%-36s p50 %7.2fms  p95 %7.2fms  p99 %7.2fms'
+                '  %.1f queries/request'
+                % (endpoint, stats['total']['p50'], stats['total']['p95'],
+                   stats['total']['p99'], stats['queries_per_request']))
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write('Results written to %s.' % options['output'])
+
+    def _load_test(self, archive, requests):
+        """Request each endpoint on random players of the archive and return
+        the metrics of the requests, by endpoint
+        """
+        rng = random.Random(archive.seed)
+        client = Client()
+        statuses = {}
+        request_metrics.reset()
+        with override_settings(REQUEST_METRICS_SAMPLE_RATE=1.):
+            for endpoint in ('playerpath', 'search', 'twittertag'):
+                for i in range(requests):
+                    player = rng.randrange(archive.players)
+                    if endpoint == 'playerpath':
+                        url = '/upsets/playerpath/p%s/?offline_only=%s' \
+                            '&root=p0' % (player, bool(i % 2))
+                    elif endpoint == 'search':
+                        # The terms match from one to all the players
+                        url = '/upsets/players/search/?term=%s' \
+                            % str(player)[:rng.randrange(1, 4)]
+                    else:
+                        url = '/upsets/twittertag/player/p%s/' % player
+                    status = client.get(url).status_code
+                    statuses[status] = statuses.get(status, 0) + 1
+        if set(statuses) != {200}:
+            logger.warning('Load test response statuses: %s' % statuses)
+        endpoints = request_metrics.stats()
+        request_metrics.reset()
+        return endpoints
@@ -1,8 +1,8 @@
 from django.core.management.base import BaseCommand
-from django.core.paginator import Paginator
-from upsets.models import Player
+from upsets.lib.playerprocessor import PlayerProcessor
+from upsets.lib.upsettree import refresh_tree_revisions
 from utils.decorators import log_exceptions
-from utils.orm_operators import BulkBatchManager
+from utils.instrumentation import reporting
 # LOGGING
 import logging
 logger = logging.getLogger('data_processing')
@@ -11,37 +11,49 @@ logger = logging.getLogger('data_processing')
 class Command(BaseCommand):
     help = 'Update players processed fields'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--engine',
+            type=str,
+            choices=PlayerProcessor.ENGINES,
+            default='python',
+            help=('Compute the fields with the Player methods (python) or '
+                  + 'with aggregate queries in the DB (sql).'))
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=2000,
+            help='Number of players processed at a time.')
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help=('Only process the players of the sets which changed since '
+                  + 'the last processing.'))
+        parser.add_argument(
+            '--report',
+            type=str,
+            help=('Write a JSON report of the run phases timings, queries '
+                  + 'and memory to this path.'))
+        parser.add_argument(
+            '--profile',
+            type=str,
+            help='Write a cProfile profile of the run to this path.')
+
     @log_exceptions(logger)
     def handle(self, *args, **options):
 
-        logger.info('Updating processed data for all players...')
-
-        # While in a perfect world you would use queryset.iterator(), there it
-        # fails to load any prefetch_related() fields specified (see docs).
-        # Using Paginator() we can mimic the same functionality with prefetch
-
-        def queryset_iterator():
-            # Paginator() throws a warning if there is no sorting attached to
-            # the queryset, so we sort by pk
-            queryset = Player.objects \
-                .all() \
-                .prefetch_related('wins__tournament', 'loses__tournament') \
-                .order_by('pk')
-            paginator = Paginator(queryset, 2000)
-            for index in range(paginator.num_pages):
-                yield from paginator.get_page(index + 1)
-
-        def player_generator(players):
-            for player in players:
-                player.update_main_character()
-                player.update_last_tournament()
-                player.update_played_sets_count()
-                yield player
-
-        batcher = BulkBatchManager(Player, logger=logger)
-
-        batcher.bulk_update(
-            player_generator(queryset_iterator()),
-            ['main_character', 'last_tournament', 'played_sets_count'])
-
-        logger.info('Done updating processed data for all players in DB.')
+        scope = 'updated' if options['incremental'] else 'all'
+        logger.info('Updating processed data for %s players...' % scope)
+
+        with reporting('process_players', options['report'],
+                       options['profile']):
+            count = PlayerProcessor(
+                engine=options['engine'],
+                batch_size=options['batch_size'],
+                incremental=options['incremental']).process_all()
+            # The served paths and the player search index hold processed
+            # fields
+            refresh_tree_revisions()
+
+        logger.info('Done updating processed data for %s %s players in DB.'
+                    % (count, scope))
@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.core.management.base import BaseCommand
 from upsets.lib.theplayerdatabase import SqliteArchiveReader
-from upsets.lib.upsettree import UpsetTreeManager
+from upsets.lib.upsettree import MultiRootTreeManager, UpsetTreeManager
 from utils.decorators import log_exceptions
+from utils.instrumentation import reporting
 # LOGGING
 import logging
 logger = logging.getLogger('data_processing')
@@ -26,12 +28,86 @@ class Command(BaseCommand):
             '-f',
             action='store_true',
             help=('Force a full backfill of the data (instead of just 6 months)'))
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=10000,
+            help=('Number of rows read from the db file and written to the DB '
+                  + 'at once.'))
+        parser.add_argument(
+            '--workers',
+            '-w',
+            type=int,
+            default=1,
+            help=('Number of processes parsing the sets of the db file.'))
+        parser.add_argument(
+            '--bulk-engine',
+            type=str,
+            choices=SqliteArchiveReader.BULK_ENGINES,
+            default='orm',
+            help=('How the rows are written in the DB, the Django bulk '
+                  + 'methods or the postgres COPY.'))
+        parser.add_argument(
+            '--pipelined',
+            action='store_true',
+            help=('Read and parse the db file in background threads while '
+                  + 'the DB is written.'))
+        parser.add_argument(
+            '--engine',
+            '-e',
+            type=str,
+            choices=UpsetTreeManager.ENGINES,
+            default='graph',
+            help=('Engine used to build the upset trees, the in-memory graph '
+                  + 'or the per-layer sql queries.'))
+        parser.add_argument(
+            '--roots',
+            type=str,
+            help=('Comma separated ids of the root players of the upset '
+                  + 'trees, the TREE_ROOT_PLAYER_IDS setting by default.'))
+        parser.add_argument(
+            '--tree-processes',
+            type=int,
+            default=1,
+            help=('Number of processes running the BFS of the upset trees '
+                  + 'of the roots (graph engine only).'))
+        parser.add_argument(
+            '--prerender',
+            action='store_true',
+            help=('Serialize all the upset paths in the cache when building '
+                  + 'the trees.'))
+        parser.add_argument(
+            '--incremental',
+            action='store_true',
+            help=('Update the ready trees in place, writing only their '
+                  + 'changed nodes (graph engine only).'))
+        parser.add_argument(
+            '--report',
+            type=str,
+            help=('Write a JSON report of the run phases timings, queries '
+                  + 'and memory to this path.'))
+        parser.add_argument(
+            '--profile',
+            type=str,
+            help='Write a cProfile profile of the run to this path.')
 
     @log_exceptions(logger)
     def handle(self, *args, **options):
+        with reporting('update_data', options['report'], options['profile']):
+            self.update(options)
+
+    def update(self, options):
         path = options['path']
-        reader = SqliteArchiveReader(path, full_backfill=options['full'])
-        tree_manager = UpsetTreeManager('222927')
+        reader = SqliteArchiveReader(path, full_backfill=options['full'],
+                                     chunk_size=options['chunk_size'],
+                                     workers=options['workers'],
+                                     bulk_engine=options['bulk_engine'],
+                                     pipelined=options['pipelined'])
+        roots = options['roots'].split(',') if options['roots'] \
+            else settings.TREE_ROOT_PLAYER_IDS
+        tree_manager = MultiRootTreeManager(
+            roots, engine=options['engine'],
+            processes=options['tree_processes'])
         if options['object']:
             if options['object'] == 'players':
                 reader.update_players()
@@ -40,10 +116,14 @@ class Command(BaseCommand):
             elif options['object'] == 'sets':
                 reader.update_sets()
             elif options['object'] == 'trees':
-                tree_manager.update_all_trees()
+                tree_manager.update_all_trees(
+                    parallel=True, prerender=options['prerender'],
+                    incremental=options['incremental'])
             else:
                 logger.error('Unknown object type. Possibles are players, '
                              + 'tournaments, sets, or trees.')
         else:
             reader.update_all_data()
-            tree_manager.update_all_trees()
+            tree_manager.update_all_trees(
+                parallel=True, prerender=options['prerender'],
+                incremental=options['incremental'])
@@ -0,0 +1,97 @@
+from contextlib import contextmanager, nullcontext
+import random
+import time
+from django.conf import settings
+from django.db import connection
+from upsets.lib.requestmetrics import request_metrics
+
+
+class _RequestTiming:
+    """The DB, serialization and render durations of a sampled request
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.
+        self.serialize_time = 0.
+        self.render_time = 0.
+        self._render_start = None
+
+    def execute(self, execute, sql, params, many, context):
+        ts = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.db_time += time.perf_counter() - ts
+
+    @contextmanager
+    def serializing(self):
+        ts = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.serialize_time += time.perf_counter() - ts
+
+    def render_started(self):
+        self._render_start = time.perf_counter()
+
+    def rendered(self, response):
+        self.render_time = time.perf_counter() - self._render_start
+
+
+class RequestMetricsMiddleware:
+    """Measure a sample of the API requests
+
+    A fraction of the requests, REQUEST_METRICS_SAMPLE_RATE, are measured:
+    their total duration, the number and duration of their SQL queries, the
+    serialization duration of their data (the DRF serializers, timed by the
+    views, see serializing) and the rendering duration of their response
+    (the encoding to JSON). The queries run by the serializers count in
+    both the DB and serialization durations. The durations are sent in a
+    Server-Timing header and aggregated in the process by endpoint, see
+    RequestMetrics and the requests stats endpoint. The other requests go
+    straight through, with the sample rate at 0 the middleware costs a
+    settings lookup per request.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = settings.REQUEST_METRICS_SAMPLE_RATE
+        if not rate or random.random() >= rate:
+            return self.get_response(request)
+        timing = _RequestTiming()
+        request.request_timing = timing
+        ts = time.perf_counter()
+        with connection.execute_wrapper(timing.execute):
+            response = self.get_response(request)
+        total = time.perf_counter() - ts
+        match = request.resolver_match
+        request_metrics.record(
+            match.route if match else 'unresolved', total, timing.db_time,
+            timing.queries, timing.serialize_time, timing.render_time)
+        response['Server-Timing'] = \
+            'db;dur=%.2f;desc="%s queries", serialize;dur=%.2f, ' \
+            'render;dur=%.2f, total;dur=%.2f' % (
+                timing.db_time * 1000, timing.queries,
+                timing.serialize_time * 1000, timing.render_time * 1000,
+                total * 1000)
+        return response
+
+    def process_template_response(self, request, response):
+        timing = getattr(request, 'request_timing', None)
+        if timing is not None:
+            # Called right before the rendering of the response
+            timing.render_started()
+            response.add_post_render_callback(timing.rendered)
+        return response
+
+
+def serializing(request):
+    """Return a context manager timing its block as serialization work of
+    the request, when the request is measured by RequestMetricsMiddleware
+    """
+    timing = getattr(request, 'request_timing', None)
+    return timing.serializing() if timing is not None else nullcontext()
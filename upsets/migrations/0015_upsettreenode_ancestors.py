@@ -0,0 +1,20 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:03
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+import upsets.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0014_auto_20201210_1523'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upsettreenode',
+            name='ancestors',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=upsets.models.empty_array, size=None),
+        ),
+    ]
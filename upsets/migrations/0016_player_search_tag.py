@@ -0,0 +1,33 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:06
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import TrigramExtension
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0015_upsettreenode_ancestors'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='player',
+            name='search_tag',
+            field=models.CharField(blank=True, max_length=1000, null=True),
+        ),
+        # Fill the new column before building the indexes
+        migrations.RunSQL(
+            'UPDATE upsets_player SET search_tag = UPPER(UNACCENT(tag));',
+            migrations.RunSQL.noop),
+        migrations.AddIndex(
+            model_name='player',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_tag'], name='upsets_play_search_trgm_idx', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['search_tag'], name='upsets_play_search_prefix_idx', opclasses=['varchar_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0016_player_search_tag'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treecontainer',
+            name='revision',
+            field=models.IntegerField(default=0),
+        ),
+    ]
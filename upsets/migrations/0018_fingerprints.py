@@ -0,0 +1,28 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0017_treecontainer_revision'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='fingerprint',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='set',
+            name='fingerprint',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='tournament',
+            name='fingerprint',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
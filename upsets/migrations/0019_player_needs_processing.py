@@ -0,0 +1,22 @@
+# Generated by Django 3.1.2 on 2026-10-18 11:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0018_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='needs_processing',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(condition=models.Q(needs_processing=True), fields=['id'], name='upsets_play_needs_proc_idx'),
+        ),
+    ]
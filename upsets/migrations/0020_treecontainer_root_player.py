@@ -0,0 +1,26 @@
+# Generated by Django 3.1.2 on 2026-10-18 12:09
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0019_player_needs_processing'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='treecontainer',
+            name='root_player',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='upsets.player'),
+        ),
+        # The root player of the existing trees is the player of their root
+        # node
+        migrations.RunSQL(
+            'UPDATE upsets_treecontainer c SET root_player_id = n.player_id '
+            'FROM upsets_upsettreenode n '
+            'WHERE n.tree_container_id = c.id AND n.parent_id IS NULL;',
+            migrations.RunSQL.noop),
+    ]
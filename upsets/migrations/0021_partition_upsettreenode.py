@@ -0,0 +1,100 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+TABLE = 'upsets_upsettreenode'
+
+
+def _rebuild_table(schema_editor, partitioned):
+    '''
+    Move the tree nodes to a new table, partitioned by tree container or
+    not, keeping the sequence, the constraints and the indexes of the
+    current one, with their names. A partitioned table needs its partition
+    key in its primary key, and can't be referenced by a foreign key on id
+    alone, hence the parent foreign key without constraint.
+    '''
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f') "
+            "ORDER BY contype <> 'p', conname",
+            [TABLE])
+        constraints = cursor.fetchall()
+        cursor.execute(
+            'SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i '
+            'WHERE i.indrelid = %s::regclass AND NOT EXISTS ('
+            '    SELECT 1 FROM pg_constraint c '
+            '    WHERE c.conindid = i.indexrelid)',
+            [TABLE])
+        indexes = [row[0] for row in cursor.fetchall()]
+        cursor.execute(
+            'SELECT id FROM upsets_treecontainer ORDER BY id')
+        container_ids = [row[0] for row in cursor.fetchall()]
+
+        # The new table takes the sequence over, it would be dropped with
+        # the old one otherwise
+        cursor.execute(
+            'ALTER SEQUENCE upsets_upsettreenode_id_seq OWNED BY NONE')
+        cursor.execute(
+            'CREATE TABLE upsets_upsettreenode_new '
+            '(LIKE upsets_upsettreenode INCLUDING DEFAULTS)'
+            + (' PARTITION BY LIST (tree_container_id)'
+               if partitioned else ''))
+        if partitioned:
+            for container_id in container_ids:
+                cursor.execute(
+                    'CREATE TABLE upsets_upsettreenode_%s PARTITION OF '
+                    'upsets_upsettreenode_new FOR VALUES IN (%s)'
+                    % (container_id, container_id))
+        cursor.execute(
+            'INSERT INTO upsets_upsettreenode_new '
+            'SELECT * FROM upsets_upsettreenode')
+        # Frees the names of the constraints and indexes, and the
+        # partitions of a partitioned one
+        cursor.execute('DROP TABLE upsets_upsettreenode CASCADE')
+        cursor.execute(
+            'ALTER TABLE upsets_upsettreenode_new '
+            'RENAME TO upsets_upsettreenode')
+        cursor.execute(
+            'ALTER SEQUENCE upsets_upsettreenode_id_seq '
+            'OWNED BY upsets_upsettreenode.id')
+        for (name, definition) in constraints:
+            if definition.startswith('PRIMARY KEY'):
+                definition = 'PRIMARY KEY (id, tree_container_id)' \
+                    if partitioned else 'PRIMARY KEY (id)'
+            elif definition.startswith('FOREIGN KEY (parent_id)'):
+                continue
+            cursor.execute('ALTER TABLE upsets_upsettreenode '
+                           'ADD CONSTRAINT %s %s' % (name, definition))
+        for definition in indexes:
+            cursor.execute(definition)
+
+
+def partition_tree_nodes(apps, schema_editor):
+    # A partitioned table can't have a primary key before PostgreSQL 11
+    if schema_editor.connection.pg_version < 110000:
+        raise RuntimeError(
+            'The tree nodes partitions need PostgreSQL 11 or later, the DB '
+            'runs %s.' % schema_editor.connection.pg_version)
+    _rebuild_table(schema_editor, partitioned=True)
+
+
+def unpartition_tree_nodes(apps, schema_editor):
+    _rebuild_table(schema_editor, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('upsets', '0020_treecontainer_root_player'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='upsettreenode',
+            name='parent',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, to='upsets.upsettreenode'),
+        ),
+        # Each tree container gets its own partition of the nodes, see
+        # TreeContainer
+        migrations.RunPython(partition_tree_nodes, unpartition_tree_nodes),
+    ]
@@ -1,7 +1,10 @@
-from django.db import models
+from django.db import connection, models, transaction
 from main.settings import TWITTER_BEARER_TOKEN
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.lookups import Unaccent
 from django.db.models import Q
+from django.db.models.functions import Upper
 import requests
 from datetime import datetime
 # LOGGING
@@ -19,6 +22,8 @@ class Tournament(models.Model):
     start_date = models.DateField(null=True, blank=True)
     name = models.CharField(max_length=1000)
     online = models.BooleanField()
+    # Hash of the imported fields, to skip the unchanged rows on import
+    fingerprint = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         indexes = [
@@ -33,12 +38,54 @@ class Player(models.Model):
     last_tournament = models.ForeignKey(
         Tournament, on_delete=models.SET_NULL, null=True, blank=True)
     played_sets_count = models.IntegerField(default=0)
+    # The tag unaccented and upper cased by the DB, as the player search
+    # compares them. Stored so that it can be indexed (UNACCENT isn't
+    # immutable, it can't be used in an index expression).
+    search_tag = models.CharField(max_length=1000, null=True, blank=True)
+    # Hash of the imported fields, to skip the unchanged rows on import
+    fingerprint = models.BigIntegerField(null=True, blank=True)
+    # Whether the processed fields (main character, last tournament, played
+    # sets count) may be outdated, set by the import for the players of the
+    # new or changed sets
+    needs_processing = models.BooleanField(default=True)
 
     class Meta:
         indexes = [
             models.Index(fields=['tag', '-played_sets_count']),
+            models.Index(fields=['id'], condition=Q(needs_processing=True),
+                         name='upsets_play_needs_proc_idx'),
+            # Contains search
+            GinIndex(fields=['search_tag'], opclasses=['gin_trgm_ops'],
+                     name='upsets_play_search_trgm_idx'),
+            # Prefix search
+            models.Index(fields=['search_tag'],
+                         opclasses=['varchar_pattern_ops'],
+                         name='upsets_play_search_prefix_idx'),
         ]
 
+    @staticmethod
+    def update_search_tags():
+        '''
+        Set the search_tag of all the players whose tag changed or is new.
+        The normalization is done by the DB to match exactly the search.
+        '''
+        normalized_tag = Upper(Unaccent('tag'))
+        return Player.objects \
+            .exclude(search_tag=normalized_tag) \
+            .update(search_tag=normalized_tag)
+
+    @staticmethod
+    def mark_for_processing(sets):
+        '''
+        Flag the winners and losers of the given Set queryset as needing
+        processing, so that an incremental process_players recomputes them.
+        '''
+        return Player.objects \
+            .filter(Q(id__in=sets.values('winner_id'))
+                    | Q(id__in=sets.values('loser_id'))) \
+            .filter(needs_processing=False) \
+            .update(needs_processing=True)
+
     def update_main_character(self):
         character_counts = {}
         for set in self.wins.all():
@@ -166,6 +213,8 @@ class Set(models.Model):
     loser_score = models.IntegerField(null=True, blank=True)
     round_name = models.CharField(max_length=1000, null=True, blank=True)
     best_of = models.IntegerField(null=True, blank=True)
+    # Hash of the imported fields, to skip the unchanged rows on import
+    fingerprint = models.BigIntegerField(null=True, blank=True)
 
     class Meta:
         indexes = [
@@ -174,6 +223,27 @@ class Set(models.Model):
         ]
 
 
+# The key of the advisory lock taken by the creations and drops of the tree
+# partitions: they lock the nodes and containers tables in different orders,
+# two of them running at once could deadlock
+PARTITIONS_LOCK = 7308
+# The first PostgreSQL version (as connection.pg_version) which can detach a
+# partition concurrently
+CONCURRENT_DETACH_VERSION = 140000
+
+
+class TreeContainerQuerySet(models.QuerySet):
+
+    def delete(self):
+        '''
+        Drop the partitions of the trees before deleting the containers, see
+        TreeContainer.drop_partition.
+        '''
+        for container in self:
+            container.drop_partition()
+        return super().delete()
+
+
 class TreeContainer(models.Model):
     '''
     This model allow us to manipulate different trees. It is usefull for 2
@@ -181,10 +251,101 @@ class TreeContainer(models.Model):
     iteratively which could be complex, we just build another tree and delete
     the old when the new is ready) and it allows to have 2 different trees,
     one with online sets included, one where they're excluded.
+    A ready tree can also be updated in place with only its changed nodes,
+    each such update increments the revision of its container.
+    Each container holds the tree of its root player, there is a ready tree
+    per root player and mode.
+    The nodes table is partitioned by container: each container gets its own
+    partition when created, which is dropped with it, so deleting an old
+    tree costs the same whatever its size and leaves no dead rows behind.
     '''
     update_date = models.DateTimeField(auto_now_add=True)
     ready = models.BooleanField(default=False)
     offline_only = models.BooleanField()
+    revision = models.IntegerField(default=0)
+    # Null only for the containers created before they had a root player
+    root_player = models.ForeignKey(
+        Player, on_delete=models.PROTECT, null=True, blank=True)
+
+    objects = TreeContainerQuerySet.as_manager()
+
+    def partition_name(self):
+        '''
+        Return the name of the partition holding the nodes of the tree.
+        '''
+        return '%s_%s' % (UpsetTreeNode._meta.db_table, self.id)
+
+    def save(self, *args, **kwargs):
+        '''
+        Save the container, creating the partition of its tree if it is new.
+        '''
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                           [PARTITIONS_LOCK])
+            super().save(*args, **kwargs)
+            cursor.execute(
+                'CREATE TABLE %s PARTITION OF %s FOR VALUES IN (%%s)'
+                % (connection.ops.quote_name(self.partition_name()),
+                   connection.ops.quote_name(UpsetTreeNode._meta.db_table)),
+                [self.id])
+
+    def delete(self, *args, **kwargs):
+        self.drop_partition()
+        return super().delete(*args, **kwargs)
+
+    def drop_partition(self):
+        '''
+        Drop the partition of the tree, with all its nodes.
+        Outside of a transaction, the partition is first detached
+        concurrently: the readers aren't blocked meanwhile, and see either
+        the whole tree or no node at all. In a transaction, or before
+        PostgreSQL 14 which can't detach concurrently, the detach locks the
+        nodes table until the end of the statement or the commit.
+        '''
+        with connection.cursor() as cursor:
+            if connection.in_atomic_block:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                               [PARTITIONS_LOCK])
+                # The deferred constraint checks of the nodes created in the
+                # transaction must run before the drop
+                cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+                cursor.execute('SET CONSTRAINTS ALL DEFERRED')
+                self._drop_partition(cursor, concurrently=False)
+                return
+            cursor.execute('SELECT pg_advisory_lock(%s)', [PARTITIONS_LOCK])
+            try:
+                self._drop_partition(cursor, concurrently=True)
+            finally:
+                cursor.execute('SELECT pg_advisory_unlock(%s)',
+                               [PARTITIONS_LOCK])
+
+    def _drop_partition(self, cursor, concurrently):
+        table = connection.ops.quote_name(UpsetTreeNode._meta.db_table)
+        partition = connection.ops.quote_name(self.partition_name())
+        if connection.pg_version < CONCURRENT_DETACH_VERSION:
+            # No pending detach before the concurrent ones
+            cursor.execute(
+                'SELECT false FROM pg_inherits '
+                'WHERE inhrelid = to_regclass(%s)', [self.partition_name()])
+            concurrently = False
+        else:
+            cursor.execute(
+                'SELECT inhdetachpending FROM pg_inherits '
+                'WHERE inhrelid = to_regclass(%s)', [self.partition_name()])
+        attached = cursor.fetchone()
+        if attached is not None:
+            if not concurrently:
+                mode = ''
+            elif attached[0]:
+                # An interrupted concurrent detach
+                mode = ' FINALIZE'
+            else:
+                mode = ' CONCURRENTLY'
+            cursor.execute('ALTER TABLE %s DETACH PARTITION %s%s'
+                           % (table, partition, mode))
+        cursor.execute('DROP TABLE IF EXISTS %s' % partition)
 
 
 class UpsetTreeNode(models.Model):
@@ -201,12 +362,18 @@ class UpsetTreeNode(models.Model):
     player = models.ForeignKey(Player, on_delete=models.PROTECT)
     # TreeNodes will be deleted all together by deleting the associated
     # TreeContainer object. We use DO_NOTHING to avoid a deluge of
-    # useless DB request performing the successive cascade operations
+    # useless DB request performing the successive cascade operations.
+    # The table is partitioned by container, its ids alone can't be
+    # referenced by a foreign key constraint.
     parent = models.ForeignKey(
-        'self', on_delete=models.DO_NOTHING, null=True, blank=True)
+        'self', on_delete=models.DO_NOTHING, null=True, blank=True,
+        db_constraint=False)
     upset = models.ForeignKey(
         Set, on_delete=models.PROTECT, null=True, blank=True)
     node_depth = models.IntegerField()
+    # Ids of all the ancestor nodes, from the parent up to the root. They are
+    # stored at build time to fetch a whole root path in a single query.
+    ancestors = ArrayField(models.IntegerField(), default=empty_array)
     # container object
     tree_container = models.ForeignKey(TreeContainer, on_delete=models.CASCADE)
 
@@ -216,10 +383,59 @@ class UpsetTreeNode(models.Model):
             models.Index(fields=['tree_container', 'player']),
         ]
 
+    @staticmethod
+    def get_root_paths(nodes):
+        '''
+        Return the root path of each of the given nodes, by node id, like
+        get_root_path does. The nodes of all the paths are fetched at once,
+        the ones shared by several paths being the same objects.
+        '''
+        ids = set()
+        for node in nodes:
+            if node.parent_id is not None:
+                ids.add(node.id)
+                ids.update(node.ancestors)
+        path_nodes = {}
+        for container_id in {node.tree_container_id for node in nodes}:
+            path_nodes.update(UpsetTreeNode.objects
+                              .filter(tree_container_id=container_id,
+                                      id__in=ids)
+                              .exclude(parent=None)
+                              .select_related('upset__tournament',
+                                              'upset__winner',
+                                              'upset__loser')
+                              .in_bulk())
+        paths = {}
+        for node in nodes:
+            if node.parent_id is None:
+                paths[node.id] = []
+            elif not node.ancestors:
+                # Trees built before the ancestors were stored
+                paths[node.id] = node.get_root_path()
+            else:
+                # The ancestors go from the parent up to the root, which
+                # isn't fetched
+                paths[node.id] = [
+                    path_nodes[node_id]
+                    for node_id in [node.id] + node.ancestors
+                    if node_id in path_nodes]
+        return paths
+
     def get_root_path(self):
-        logger.info(self)
-        if self.parent is None:
+        '''
+        Return the nodes from this one up to the root (excluded), with their
+        upsets and related objects already loaded for serialization.
+        '''
+        if self.parent_id is None:
             # We do not return the last node as it is empty and useless
             return []
-        else:
+        if not self.ancestors:
+            # Trees built before the ancestors were stored
             return [self] + self.parent.get_root_path()
+        return list(UpsetTreeNode.objects
+                    .filter(tree_container_id=self.tree_container_id,
+                            id__in=[self.id] + self.ancestors)
+                    .exclude(parent=None)
+                    .select_related('upset__tournament', 'upset__winner',
+                                    'upset__loser')
+                    .order_by('-node_depth'))
@@ -0,0 +1,154 @@
+import os
+import sqlite3
+import tempfile
+from collections import Counter
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from upsets.models import Player, Set, Tournament
+from upsets.lib.playerprocessor import PlayerProcessor
+from upsets.lib.synthetic import write_synthetic_archive
+from upsets.lib.theplayerdatabase import SqliteArchiveReader
+from upsets.tests import tests_models
+from utils.instrumentation import RunReport
+from utils.orm_operators import keyset_iterator
+
+
+def processed_fields():
+    return {player_id: (main_character, last_tournament_id, count)
+            for (player_id, main_character, last_tournament_id, count)
+            in Player.objects.values_list(
+                'id', 'main_character', 'last_tournament_id',
+                'played_sets_count')}
+
+
+class PlayerProcessor_EnginesTestCase(TestCase):
+    def setUp(self):
+        tests_models.Models_GeneralTestCase.setUp(self)
+
+    def test_engines_match(self):
+        PlayerProcessor(engine='python').process_all()
+        reference = processed_fields()
+        Player.objects.update(main_character=None, last_tournament=None,
+                              played_sets_count=-1)
+        # Batches smaller than the table, the last one empty
+        processed = PlayerProcessor(engine='sql', batch_size=2).process_all()
+        self.assertEqual(processed, 5)
+        self.assertEqual(processed_fields(), reference)
+        self.assertEqual(reference['1'], ('joker', '1', 4))
+        self.assertEqual(reference['3'], (None, None, 0))
+
+    def test_keep_fields_without_data(self):
+        Player.objects.filter(id='3').update(main_character='mario')
+        Player.objects.filter(id='1').update(main_character='fox')
+        PlayerProcessor(engine='sql').process_all()
+        self.assertEqual(Player.objects.get(id='3').main_character, 'mario')
+        self.assertEqual(Player.objects.get(id='1').main_character, 'joker')
+
+    def test_run_report(self):
+        report = RunReport('process')
+        with report.activate():
+            PlayerProcessor(engine='sql', batch_size=2).process_all()
+        data = report.to_dict()
+        self.assertEqual(data['name'], 'process')
+        [process_all] = data['phases']
+        self.assertEqual(process_all['name'], 'process_all')
+        self.assertEqual(process_all['rows'], 5)
+        # A query per batch, the last one empty, each in a savepoint of the
+        # test transaction
+        self.assertEqual(process_all['queries'], 4 * 3)
+        self.assertEqual([batch['rows'] for batch in process_all['batches']],
+                         [2, 2, 1])
+        self.assertGreater(process_all['process_peak_rss_kb'], 0)
+
+    def test_unknown_engine(self):
+        self.assertRaises(ValueError, PlayerProcessor, engine='rust')
+
+
+class PlayerProcessor_SyntheticTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'archive.db')
+        write_synthetic_archive(
+            self.path, players=30, tournaments=5, sets=200)
+        SqliteArchiveReader(self.path).update_all_data()
+
+    def test_engines_match_on_synthetic_data(self):
+        PlayerProcessor(engine='python').process_all()
+        reference = processed_fields()
+        Player.objects.update(main_character=None, last_tournament=None,
+                              played_sets_count=-1)
+        PlayerProcessor(engine='sql', batch_size=7).process_all()
+        start_dates = dict(
+            Tournament.objects.values_list('id', 'start_date'))
+        for player_id, (character, tournament_id, count) in \
+                processed_fields().items():
+            (ref_character, ref_tournament_id, ref_count) = \
+                reference[player_id]
+            self.assertEqual(count, ref_count)
+            # The engines break the ties differently, the characters must
+            # be played as often and the tournaments start the same day
+            sets = Set.objects.filter(winner_id=player_id) \
+                .values_list('winner_characters', flat=True).union(
+                    Set.objects.filter(loser_id=player_id)
+                    .values_list('loser_characters', flat=True), all=True)
+            counts = Counter(char for chars in sets for char in chars)
+            self.assertEqual(counts[character], counts[ref_character])
+            self.assertEqual(start_dates.get(tournament_id),
+                             start_dates.get(ref_tournament_id))
+
+    def test_incremental(self):
+        for engine in PlayerProcessor.ENGINES:
+            self.assertEqual(PlayerProcessor(engine=engine).process_all(), 30)
+            self.assertEqual(PlayerProcessor(
+                engine=engine, incremental=True).process_all(), 0)
+            reference = processed_fields()
+            archive = sqlite3.connect(self.path)
+            # A new set between the players of s3
+            archive.execute(
+                "INSERT INTO sets SELECT ?, tournament_key, winner_id, p1_id,"
+                " p2_id, p1_score, p2_score, location_names, best_of,"
+                " game_data FROM sets WHERE key = 's3'", ['new-' + engine])
+            (p1_id, p2_id) = archive.execute(
+                "SELECT p1_id, p2_id FROM sets WHERE key = 's3'").fetchone()
+            archive.commit()
+            SqliteArchiveReader(self.path).update_all_data()
+            self.assertEqual(
+                set(Player.objects.filter(needs_processing=True)
+                    .values_list('id', flat=True)), {p1_id, p2_id})
+            self.assertEqual(PlayerProcessor(
+                engine=engine, incremental=True).process_all(), 2)
+            incremental = processed_fields()
+            self.assertEqual({player_id for player_id in reference
+                              if incremental[player_id] !=
+                              reference[player_id]}, {p1_id, p2_id})
+            # Same as a full run
+            PlayerProcessor(engine=engine).process_all()
+            self.assertEqual(processed_fields(), incremental)
+            # Back to the original archive for the next engine
+            write_synthetic_archive(
+                self.path, players=30, tournaments=5, sets=200)
+            SqliteArchiveReader(self.path).update_all_data()
+
+
+class PlayerProcessor_KeysetIteratorTestCase(TransactionTestCase):
+    def setUp(self):
+        tests_models.Models_GeneralTestCase.setUp(self)
+
+    def test_keyset_iterator(self):
+        queryset = Player.objects.prefetch_related('wins', 'loses')
+        expected = [(player.id, len(player.wins.all()),
+                     len(player.loses.all()))
+                    for player in queryset.order_by('pk')]
+        # 3 queries per chunk, and a last empty one after a full chunk
+        for (chunk_size, queries) in ((1, 16), (2, 9), (5, 4), (10, 3)):
+            for prefetch_next in (False, True):
+                # The chunks are prefetched by another connection
+                with self.assertNumQueries(0 if prefetch_next else queries):
+                    players = [(player.id, len(player.wins.all()),
+                                len(player.loses.all()))
+                               for player in keyset_iterator(
+                                   queryset, chunk_size=chunk_size,
+                                   prefetch_next=prefetch_next)]
+                self.assertEqual(players, expected)
+        self.assertFalse(connection.in_atomic_block)
@@ -0,0 +1,283 @@
+import os
+import sqlite3
+import tempfile
+from django.test import SimpleTestCase, TestCase
+from upsets.models import Player, Tournament, Set, TwitterTag
+from upsets.lib.archiveparser import SET_FIELDS, parse_set_row, \
+    parse_games, parse_round_name, literal_eval_games
+from upsets.lib.synthetic import SyntheticArchive, write_synthetic_archive
+from upsets.lib.theplayerdatabase import SqliteArchiveReader
+from utils.orm_operators import CopyBulkBatchManager
+
+
+def imported_data():
+    """Return all the imported rows, to compare two imports
+    """
+    return [list(model.objects.order_by('pk').values_list())
+            for model in (Player, Tournament, Set)] + \
+        [sorted(TwitterTag.objects.values_list('tag', 'player_id'))]
+
+
+class ArchiveDataMixin:
+    """A synthetic archive of 30 players, 5 tournaments and 100 sets, in a
+    temporary sqlite file at self.path
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'archive.db')
+        write_synthetic_archive(
+            self.path, players=30, tournaments=5, sets=100)
+
+
+class ThePlayerDatabase_ReaderTestCase(ArchiveDataMixin, TestCase):
+    def test_update_all_data_by_chunks(self):
+        # Chunks smaller than the tables and not dividing their sizes
+        SqliteArchiveReader(self.path, chunk_size=7).update_all_data()
+        self.assertEqual(Player.objects.count(), 30)
+        self.assertEqual(Tournament.objects.count(), 5)
+        self.assertEqual(Set.objects.count(), 100)
+        self.assertEqual(TwitterTag.objects.count(), 20)
+        archive = sqlite3.connect(self.path)
+        (key, winner_id, p1_id, p2_id, game_data) = archive.execute(
+            "SELECT key, winner_id, p1_id, p2_id, game_data FROM sets"
+            " WHERE game_data != '[]' LIMIT 1").fetchone()
+        set = Set.objects.get(id=key)
+        self.assertEqual(set.winner_id, winner_id)
+        self.assertEqual(set.loser_id, p2_id if winner_id == p1_id else p1_id)
+        self.assertTrue(set.winner_characters)
+        self.assertEqual(Player.objects.get(id='p7').search_tag, 'PLAYER 7')
+
+    def test_update_sets_in_pool(self):
+        reader = SqliteArchiveReader(self.path, chunk_size=7, workers=2)
+        reader.update_tournaments()
+        reader.update_players()
+        reader.update_sets()
+        archive = sqlite3.connect(self.path)
+        expected = sorted(parse_set_row(row) for row in archive.execute(
+            "SELECT key, tournament_key, winner_id, p1_id, p2_id, p1_score,"
+            " p2_score, location_names, best_of, game_data FROM sets"))
+        self.assertEqual(
+            sorted(Set.objects.values_list(*SET_FIELDS)), expected)
+
+    def test_pipelined_import(self):
+        SqliteArchiveReader(self.path, chunk_size=7).update_all_data()
+        reference = imported_data()
+        Player.objects.update(tag='old', fingerprint=None)
+        Set.objects.update(winner_score=-1, fingerprint=None)
+        for workers in (1, 2):
+            SqliteArchiveReader(self.path, chunk_size=7, workers=workers,
+                                pipelined=True).update_all_data()
+            self.assertEqual(imported_data(), reference)
+
+    def test_pipelined_failure(self):
+        archive = sqlite3.connect(self.path)
+        archive.execute("UPDATE players SET social = 'x' WHERE rowid = 20")
+        archive.commit()
+        reader = SqliteArchiveReader(self.path, chunk_size=7, pipelined=True)
+        # The error of the build thread is raised here
+        self.assertRaises(ValueError, reader.update_all_data)
+
+
+class ThePlayerDatabase_FingerprintTestCase(ArchiveDataMixin, TestCase):
+    def check_skip_unchanged(self, bulk_engine):
+        reader = SqliteArchiveReader(
+            self.path, chunk_size=7, bulk_engine=bulk_engine)
+        reader.update_tournaments()
+        reader.update_players()
+        self.assertEqual(reader.update_sets(),
+                         {'new': 100, 'changed': 0, 'unchanged': 0})
+        archive = sqlite3.connect(self.path)
+        archive.execute("UPDATE players SET tag = 'new' WHERE rowid < 3")
+        archive.execute(
+            "UPDATE sets SET p1_score = 5 WHERE key IN ('s3', 's4')")
+        archive.commit()
+        self.assertEqual(reader.update_players(),
+                         {'new': 0, 'changed': 2, 'unchanged': 28})
+        Player.objects.update(needs_processing=False)
+        self.assertEqual(reader.update_sets(),
+                         {'new': 0, 'changed': 2, 'unchanged': 98})
+        # Only the players of the changed sets need processing
+        players = set()
+        for set_ in Set.objects.filter(id__in=['s3', 's4']):
+            players.update([set_.winner_id, set_.loser_id])
+        self.assertEqual(
+            set(Player.objects.filter(needs_processing=True)
+                .values_list('id', flat=True)), players)
+        self.assertEqual(Player.objects.filter(tag='new').count(), 2)
+
+    def test_skip_unchanged_orm(self):
+        self.check_skip_unchanged('orm')
+
+    def test_skip_unchanged_copy(self):
+        self.check_skip_unchanged('copy')
+
+    def test_engines_same_fingerprints(self):
+        SqliteArchiveReader(self.path, chunk_size=7).update_all_data()
+        # The copy engine finds the rows written by the orm one unchanged
+        reader = SqliteArchiveReader(
+            self.path, chunk_size=7, bulk_engine='copy')
+        self.assertEqual(reader.update_players()['unchanged'], 30)
+        self.assertEqual(reader.update_sets()['unchanged'], 100)
+
+    def check_mark_previous_players(self, bulk_engine):
+        reader = SqliteArchiveReader(
+            self.path, chunk_size=7, bulk_engine=bulk_engine)
+        reader.update_all_data()
+        previous = Set.objects.get(id='s3')
+        (winner_id, loser_id) = sorted(
+            {'p1', 'p2', 'p3', 'p4'}
+            - {previous.winner_id, previous.loser_id})[:2]
+        # The set now opposes two other players
+        archive = sqlite3.connect(self.path)
+        archive.execute(
+            "UPDATE sets SET winner_id = ?, p1_id = ?, p2_id = ?"
+            " WHERE key = 's3'", (winner_id, winner_id, loser_id))
+        archive.commit()
+        Player.objects.update(needs_processing=False)
+        self.assertEqual(reader.update_sets()['changed'], 1)
+        self.assertEqual(Set.objects.get(id='s3').winner_id, winner_id)
+        # Both the previous and the new players need processing
+        self.assertEqual(
+            set(Player.objects.filter(needs_processing=True)
+                .values_list('id', flat=True)),
+            {previous.winner_id, previous.loser_id, winner_id, loser_id})
+
+    def test_mark_previous_players_orm(self):
+        self.check_mark_previous_players('orm')
+
+    def test_mark_previous_players_copy(self):
+        self.check_mark_previous_players('copy')
+
+
+class ThePlayerDatabase_CopyTestCase(ArchiveDataMixin, TestCase):
+    def test_copy_engine_imports_same_data(self):
+        SqliteArchiveReader(self.path, chunk_size=7).update_all_data()
+        reference = imported_data()
+        Set.objects.all().delete()
+        TwitterTag.objects.all().delete()
+        Player.objects.all().delete()
+        Tournament.objects.all().delete()
+        reader = SqliteArchiveReader(
+            self.path, chunk_size=7, bulk_engine='copy')
+        reader.update_all_data()
+        self.assertEqual(imported_data(), reference)
+        # A second import updates the existing rows
+        Player.objects.update(tag='old', fingerprint=None)
+        reader.update_all_data()
+        self.assertEqual(imported_data(), reference)
+
+    def test_copy_values(self):
+        Tournament.objects.create(id='1', name='t', online=False)
+        Player.objects.bulk_create(
+            [Player(id='1', tag='a'), Player(id='2', tag='b')])
+        batcher = CopyBulkBatchManager(Set, batch_size=3)
+        sets = [Set(id=str(i), tournament_id='1', winner_id='1',
+                    loser_id='2', winner_characters=characters,
+                    round_name=round_name)
+                for i, (characters, round_name) in enumerate([
+                    (['a"b', 'c,d', 'e\\f', '{g}', 'NULL'], 'x\ny'),
+                    ([], None),
+                    (['h'], ''),
+                    (["i'j"], '"quoted", \\N')])]
+        # The last of the duplicates wins
+        sets.append(Set(id='1', tournament_id='1', winner_id='1',
+                        loser_id='2', winner_characters=['last']))
+        batcher.bulk_update_or_create(
+            iter(sets), ['winner_characters', 'round_name'])
+        del sets[1]
+        for set in sets:
+            saved = Set.objects.get(id=set.id)
+            self.assertEqual(saved.winner_characters, set.winner_characters)
+            self.assertEqual(saved.round_name, set.round_name)
+        batcher = CopyBulkBatchManager(Set)
+        batcher.bulk_update(
+            iter([Set(id='0', round_name='updated')]), ['round_name'])
+        self.assertEqual(Set.objects.get(id='0').round_name, 'updated')
+        self.assertEqual(Set.objects.count(), 4)
+
+
+class ThePlayerDatabase_ParsersTestCase(SimpleTestCase):
+    def test_parse_games(self):
+        game = {'winner_id': 12, 'loser_id': 3, 'winner_score': 1,
+                'loser_score': None, 'winner_char': 'ultimate/mario',
+                'loser_char': 'ultimate/fox', 'stage': 'Final Destination'}
+        samples = [
+            repr([game, dict(game, winner_id='3', stage=None)]),
+            repr([dict(game, winner_char="ultimate/d'x")]),
+            repr([dict(game, stage='None: True\\n')]),
+            repr([dict(game, winner_id=1.5, loser_char='ultimate/é')]),
+            repr([]),
+            repr((game, )),
+            "[{'winner_id': 1, 'winner_char': 'a', 'loser_char': 'b'},]",
+        ]
+        for sample in samples:
+            self.assertEqual(parse_games(sample), literal_eval_games(sample))
+        # The malformed values fail like ast.literal_eval
+        for sample in ["[{'winner_id': x}]", "[null]", "[{'a': NaN}]"]:
+            self.assertRaises(ValueError, parse_games, sample)
+        self.assertRaises(SyntaxError, parse_games, "[{'winner_id'")
+        self.assertRaises(KeyError, parse_games, "[{'winner_id': 1}]")
+
+    def test_parse_null_game_data(self):
+        row = ('s1', 't1', 'p1', 'p1', 'p2', 2, 1,
+               "['Pools', 'Winners Round 1']", 3, None)
+        self.assertRaises(ValueError, parse_games, None)
+        # The games are skipped, not the set
+        self.assertEqual(parse_set_row(row),
+                         ('s1', 't1', 'p1', 'p2', 2, 1, 'Winners Round 1', 3,
+                          [], []))
+
+    def test_parse_round_name(self):
+        self.assertEqual(parse_round_name("['Pools', 'Winners Round 1']"),
+                         'Winners Round 1')
+        self.assertEqual(parse_round_name(repr(['Pools', "Loser's Final"])),
+                         "Loser's Final")
+
+
+class ThePlayerDatabase_SyntheticTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'archive.db')
+        self.archive = SyntheticArchive(players=50, tournaments=10, sets=500)
+
+    def test_deterministic(self):
+        rows = list(self.archive.set_rows())
+        self.assertEqual(list(self.archive.set_rows()), rows)
+        self.assertEqual(list(SyntheticArchive(
+            players=50, tournaments=10, sets=500).set_rows()), rows)
+        self.assertNotEqual(list(SyntheticArchive(
+            players=50, tournaments=10, sets=500, seed=1).set_rows()), rows)
+
+    def test_distribution(self):
+        self.archive.write_sqlite(self.path)
+        SqliteArchiveReader(self.path).update_all_data()
+        wins = {player.id: player.wins.count()
+                for player in Player.objects.all()}
+        # The stronger players win most of the sets
+        self.assertGreater(wins['p0'], wins['p10'])
+        self.assertGreater(wins['p10'], wins['p49'])
+        self.assertGreater(Set.objects.filter(winner_id='p0').count(),
+                           2 * Set.objects.filter(loser_id='p0').count())
+        # With some upsets
+        self.assertTrue(Set.objects.filter(loser_id='p0').exists())
+        online = Tournament.objects.filter(online=True).count()
+        self.assertTrue(0 < online < 10)
+
+    def test_write_db_matches_import(self):
+        self.archive.write_sqlite(self.path)
+        SqliteArchiveReader(self.path, chunk_size=70).update_all_data()
+        reference = imported_data()
+        Set.objects.all().delete()
+        TwitterTag.objects.all().delete()
+        Player.objects.all().delete()
+        Tournament.objects.all().delete()
+        self.archive.write_db(chunk_size=70)
+        self.assertEqual(imported_data(), reference)
+        # An import of the same archive finds all the rows unchanged
+        reader = SqliteArchiveReader(self.path, chunk_size=70)
+        self.assertEqual(reader.update_sets(),
+                         {'new': 0, 'changed': 0, 'unchanged': 500})
@@ -1,11 +1,37 @@
-from datetime import datetime
-from django.test import TestCase
+from datetime import date, datetime, timedelta
+import random
+import threading
+import time
+from unittest import mock
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from upsets.models import Player, Tournament, Set, UpsetTreeNode, TreeContainer
-from upsets.lib.upsettree import UpsetTreeManager
+from upsets.lib.upsettree import MultiRootTreeManager, UpsetTreeManager
+from upsets.lib.upsetgraph import UpsetGraph
+from upsets.serializers import UpsetTreeNodeSerializer
+from utils.instrumentation import RunReport
 
 
-class UpsetTree_GeneralTestCase(TestCase):
+def tree_of(container):
+    """Return the tree of a container independently of its node ids
+    """
+    nodes = UpsetTreeNode.objects.filter(tree_container=container)
+    players = dict(nodes.values_list('id', 'player_id'))
+    return {
+        node.player_id: (node.node_depth, node.upset_id,
+                         [players[ancestor] for ancestor in node.ancestors],
+                         players.get(node.parent_id))
+        for node in nodes}
+
+
+class UpsetTreeDataMixin:
+    """The six players, three tournaments and sets of the tree tests, with
+    the tree manager of the best player as self.manager
+    """
+
     def setUp(self):
+        super().setUp()
         Player.objects.bulk_create([
             Player(id='1', tag='player1'),
             Player(id='2', tag='player2'),
@@ -67,6 +93,8 @@ class UpsetTree_GeneralTestCase(TestCase):
         Set.objects.bulk_create(sets_to_bulk_create)
         self.manager = UpsetTreeManager('3')
 
+
+class UpsetTree_GeneralTestCase(UpsetTreeDataMixin, TestCase):
     def test_create_from_scratch(self):
         self.manager.update_all_trees()
         # OFFLINE ONLY TREE
@@ -113,3 +141,294 @@ class UpsetTree_GeneralTestCase(TestCase):
         # player 5 is level 1
         node5_online = online_nodes.get(player_id='5')
         self.assertEqual(node5_online.parent, node3_online)
+
+    def test_engines_build_same_tree(self):
+        def tree_of(engine, offline_only):
+            container = TreeContainer.objects.create(offline_only=offline_only)
+            UpsetTreeManager('3', engine=engine).create_from_scratch(container)
+            return {
+                node.player_id: (node.node_depth, node.upset_id,
+                                 node.parent_id and node.parent.player_id)
+                for node in UpsetTreeNode.objects
+                .filter(tree_container=container)
+                .select_related('parent')}
+        for offline_only in (False, True):
+            self.assertEqual(tree_of('graph', offline_only),
+                             tree_of('sql', offline_only))
+
+    def test_layer_phases(self):
+        graph = UpsetGraph.load()
+
+        def slow_bfs():
+            for layer in graph.bfs('3', offline_only=True):
+                time.sleep(0.05)
+                yield layer
+        for engine in UpsetTreeManager.ENGINES:
+            container = TreeContainer.objects.create(offline_only=True)
+            report = RunReport('trees')
+            with report.activate():
+                UpsetTreeManager('3', engine=engine).create_from_scratch(
+                    container, graph=graph, layers=slow_bfs())
+            [create_from_scratch] = report.root.phases
+            layers = create_from_scratch.phases
+            # Two layers of two players, then the search of the next one
+            self.assertEqual([layer.name for layer in layers],
+                             ['layer 1', 'layer 2', 'layer 3'])
+            self.assertEqual([layer.rows for layer in layers], [2, 2, 0])
+            for layer in layers[:2]:
+                self.assertGreater(layer.metrics['queries'], 0)
+                if engine == 'graph':
+                    # The BFS of the layer is recorded in its phase
+                    self.assertGreaterEqual(layer.metrics['elapsed'], 0.05)
+            if engine == 'sql':
+                self.assertGreater(layers[2].metrics['queries'], 0)
+
+    def test_update_in_place(self):
+        Player.objects.create(id='7', tag='player7')
+        Set.objects.create(id='100', tournament_id='2', winner_id='7',
+                           loser_id='1')
+        self.manager.update_all_trees()
+        containers = {c.offline_only: c for c in TreeContainer.objects.all()}
+        node_ids = dict(UpsetTreeNode.objects
+                        .filter(tree_container=containers[True])
+                        .values_list('player_id', 'id'))
+        Tournament.objects.create(id='4', name='new-tournament',
+                                  start_date=date(2021, 1, 1), online=False)
+        Set.objects.bulk_create([
+            # Player 6 enters the tree and player 4 moves up
+            Set(id='101', tournament_id='4', winner_id='6', loser_id='3'),
+            Set(id='102', tournament_id='4', winner_id='4', loser_id='3'),
+            # A more recent upset at the same depth
+            Set(id='103', tournament_id='4', winner_id='5', loser_id='1'),
+        ])
+        # The set is corrected to a DQ, player 7 leaves the tree
+        Set.objects.filter(id='100').update(winner_score=-1)
+        self.manager.update_all_trees(incremental=True)
+
+        for offline_only, container in containers.items():
+            container.refresh_from_db()
+            self.assertEqual(container.revision, 1)
+            reference = TreeContainer.objects.create(
+                offline_only=offline_only)
+            self.manager.create_from_scratch(reference)
+            self.assertEqual(tree_of(container), tree_of(reference))
+        tree = tree_of(containers[True])
+        self.assertEqual(tree['4'][:2], (1, '102'))
+        self.assertEqual(tree['5'][1], '103')
+        self.assertNotIn('7', tree)
+        # The nodes of the players staying in the tree are kept
+        for node in UpsetTreeNode.objects.filter(
+                tree_container=containers[True], player_id__in=['1', '4']):
+            self.assertEqual(node.id, node_ids[node.player_id])
+
+    def test_update_in_place_random(self):
+        # Differential test: random changes of the sets, each followed by an
+        # incremental update which must give the same tree as a rebuild
+        rng = random.Random(42)
+        players = [str(i) for i in range(10, 40)]
+        Player.objects.bulk_create([Player(id=i, tag=i) for i in players])
+        Tournament.objects.bulk_create([
+            Tournament(id=str(i), name=str(i), online=bool(i % 3 == 0),
+                       start_date=date(2018, 1, 1) + timedelta(days=i // 2))
+            for i in range(10, 30)])
+        set_ids = iter(range(1000, 10000))
+
+        def random_sets(count):
+            return [Set(id=str(next(set_ids)),
+                        tournament_id=str(rng.randrange(10, 30)),
+                        winner_id=rng.choice(players + ['3']),
+                        loser_id=rng.choice(players + ['1', '3']))
+                    for _ in range(count)]
+        Set.objects.bulk_create(random_sets(40))
+        self.manager.update_all_trees()
+        for _ in range(6):
+            dqs = rng.sample(
+                list(Set.objects.values_list('id', flat=True)), 8)
+            Set.objects.filter(id__in=dqs).update(loser_score=-1)
+            Set.objects.bulk_create(random_sets(10))
+            self.manager.update_all_trees(incremental=True)
+            for container in TreeContainer.objects.filter(ready=True):
+                reference = TreeContainer.objects.create(
+                    offline_only=container.offline_only)
+                self.manager.create_from_scratch(reference)
+                self.assertEqual(tree_of(container), tree_of(reference))
+                reference.delete()
+
+    def test_get_root_path(self):
+        self.manager.update_all_trees()
+        node4 = UpsetTreeNode.objects.get(
+            tree_container__offline_only=True, player_id='4')
+        node1 = UpsetTreeNode.objects.get(
+            tree_container__offline_only=True, player_id='1')
+        node3 = UpsetTreeNode.objects.get(
+            tree_container__offline_only=True, player_id='3')
+        self.assertEqual(node4.ancestors, [node1.id, node3.id])
+        # The whole path and its serialized data come from a single query
+        with self.assertNumQueries(1):
+            path = node4.get_root_path()
+            data = UpsetTreeNodeSerializer(path, many=True).data
+        self.assertEqual(path, [node4, node1])
+        self.assertEqual([hop['upset']['loser']['id'] for hop in data],
+                         ['1', '3'])
+
+
+class UpsetTree_MultiRootTestCase(UpsetTreeDataMixin, TestCase):
+    def test_update_all_trees(self):
+        for processes in (1, 2):
+            with self.assertLogs('data_processing', 'WARNING'):
+                MultiRootTreeManager(['3', '1', 'unknown', '3'],
+                                     processes=processes).update_all_trees()
+            containers = TreeContainer.objects.filter(ready=True)
+            self.assertEqual(
+                sorted(containers.values_list('root_player_id',
+                                              'offline_only')),
+                [('1', False), ('1', True), ('3', False), ('3', True)])
+            for container in containers:
+                reference = TreeContainer.objects.create(
+                    offline_only=container.offline_only)
+                UpsetTreeManager(container.root_player_id) \
+                    .create_from_scratch(reference)
+                self.assertEqual(tree_of(container), tree_of(reference))
+                reference.delete()
+        # Incremental updates of the trees of each root
+        Set.objects.create(id='100', tournament_id='1', winner_id='6',
+                           loser_id='1')
+        MultiRootTreeManager(['3', '1'], processes=2).update_all_trees(
+            incremental=True)
+        for container in TreeContainer.objects.filter(ready=True):
+            self.assertEqual(container.revision, 1)
+            self.assertIn('6', tree_of(container))
+
+
+class UpsetTree_PairPathTestCase(UpsetTreeDataMixin, TestCase):
+    def test_shortest_path(self):
+        graph = UpsetGraph.load()
+
+        def losers(player_id, target_id, offline_only):
+            path = graph.shortest_path(player_id, target_id, offline_only)
+            if path is None:
+                return None
+            return [Set.objects.get(id=graph.set_id(index)).loser_id
+                    for index in path]
+        self.assertEqual(losers('4', '3', True), ['1', '3'])
+        self.assertEqual(losers('5', '3', True), ['2', '3'])
+        self.assertEqual(losers('5', '3', False), ['3'])
+        # The paths don't need to go through the best player
+        self.assertEqual(losers('5', '1', True), ['4', '1'])
+        self.assertIsNone(losers('6', '3', False))
+        self.assertIsNone(losers('unknown', '3', False))
+        self.assertEqual(losers('3', '3', False), [])
+
+    def test_shortest_path_matches_trees(self):
+        # Differential test: the path between two players is the path of
+        # the player in the tree of the target, on random sets with many
+        # equal dates
+        rng = random.Random(7)
+        players = [str(i) for i in range(10, 50)]
+        Player.objects.bulk_create([Player(id=i, tag=i) for i in players])
+        Tournament.objects.bulk_create([
+            Tournament(id=str(i), name=str(i), online=bool(i % 3 == 0),
+                       start_date=date(2018, 1, 1) + timedelta(days=i // 4))
+            for i in range(10, 30)])
+        Set.objects.bulk_create([
+            Set(id=str(i), tournament_id=str(rng.randrange(10, 30)),
+                winner_id=rng.choice(players), loser_id=rng.choice(players))
+            for i in range(1000, 1150)])
+        graph = UpsetGraph.load()
+        for target in rng.sample(players, 6) + ['3']:
+            for offline_only in (False, True):
+                container = TreeContainer.objects.create(
+                    offline_only=offline_only)
+                UpsetTreeManager(target).create_from_scratch(container)
+                nodes = {node.player_id: node for node in UpsetTreeNode
+                         .objects.filter(tree_container=container)}
+                for player_id in players + ['1', '6']:
+                    path = graph.shortest_path(
+                        player_id, target, offline_only)
+                    if player_id not in nodes:
+                        self.assertIsNone(path)
+                        continue
+                    self.assertEqual(
+                        [graph.set_id(index) for index in path],
+                        [node.upset_id
+                         for node in nodes[player_id].get_root_path()])
+
+
+class UpsetTree_ParallelTestCase(UpsetTreeDataMixin, TransactionTestCase):
+    # The parallel build uses other DB connections, which can't see the data
+    # of a TestCase transaction
+
+    def test_update_all_trees_parallel(self):
+        self.manager.update_all_trees(parallel=True)
+        self.manager.update_all_trees(parallel=True)
+        # Only the last containers are kept, one per mode
+        self.assertEqual(TreeContainer.objects.filter(ready=True).count(), 2)
+        for offline_only, parent in ((True, '2'), (False, '3')):
+            node5 = UpsetTreeNode.objects.get(
+                tree_container__offline_only=offline_only, player_id='5')
+            self.assertEqual(node5.parent.player_id, parent)
+
+
+class UpsetTree_PartitionTestCase(UpsetTreeDataMixin, TransactionTestCase):
+    # The reader and the swap of the trees use their own DB connections
+
+    def test_swap_readers(self):
+        # Don't leave the partitions behind the flush of the tables
+        self.addCleanup(TreeContainer.objects.all().delete)
+        self.manager.update_tree(offline_only=False)
+        old = TreeContainer.objects.get()
+        nodes = UpsetTreeNode.objects.filter(tree_container=old).count()
+        counts = []
+        in_transaction = threading.Event()
+        swapped = threading.Event()
+
+        def count():
+            counts.append(
+                UpsetTreeNode.objects.filter(tree_container=old).count())
+
+        def read():
+            try:
+                # The drop of the old tree waits for the readers in the
+                # middle of a transaction
+                with transaction.atomic():
+                    count()
+                    in_transaction.set()
+                    time.sleep(0.5)
+                    count()
+                while not swapped.is_set():
+                    count()
+                count()
+            finally:
+                connection.close()
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        in_transaction.wait()
+        self.manager.update_tree(offline_only=False)
+        swapped.set()
+        reader.join()
+        # The reader saw the whole tree, then no node at all
+        self.assertEqual(counts[:2], [nodes, nodes])
+        self.assertEqual(counts[-1], 0)
+        self.assertEqual(set(counts), {nodes, 0})
+        self.assertNotIn(old.partition_name(),
+                         connection.introspection.table_names())
+        new = TreeContainer.objects.get()
+        self.assertEqual(
+            UpsetTreeNode.objects.filter(tree_container=new).count(), nodes)
+
+    def test_swap_before_pg14(self):
+        self.addCleanup(TreeContainer.objects.all().delete)
+        self.manager.update_tree(offline_only=False)
+        old = TreeContainer.objects.get()
+        # No concurrent detach, nor pending detach to look for
+        with mock.patch.object(connection, 'pg_version', 130000), \
+                CaptureQueriesContext(connection) as context:
+            self.manager.update_tree(offline_only=False)
+        statements = ' '.join(query['sql']
+                              for query in context.captured_queries)
+        self.assertIn('DETACH PARTITION', statements)
+        self.assertNotIn('CONCURRENTLY', statements)
+        self.assertNotIn('inhdetachpending', statements)
+        self.assertNotIn(old.partition_name(),
+                         connection.introspection.table_names())
@@ -0,0 +1,391 @@
+import json
+import re
+import shutil
+import tempfile
+import warnings
+from urllib.parse import quote
+from unittest import mock
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.cache.backends.base import CacheKeyWarning
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from upsets.models import Player, Set
+from upsets.lib.playersearch import search_players, scan_search_players
+from upsets.lib.searchindex import PlayerSearchIndex, \
+    PlayerSearchIndexHolder, player_search_index
+from upsets.serializers import PlayerSerializer
+from upsets.lib.upsettree import UpsetTreeManager
+from upsets.lib.containers import container_registry
+from upsets.lib.treesnapshot import tree_snapshots
+from upsets.lib.upsetgraph import upset_graph
+from upsets.lib.requestmetrics import DurationHistogram, request_metrics
+from upsets.tests import tests_upsettree
+
+
+class UpsetPathDataMixin(tests_upsettree.UpsetTreeDataMixin):
+    """The data of the tree tests, without cached paths nor resolved trees
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        container_registry.invalidate()
+
+
+@override_settings(DEFAULT_ROOT_PLAYER_ID='3')
+class Views_UpsetPathTestCase(UpsetPathDataMixin, TestCase):
+
+    def test_playerpath(self):
+        self.manager.update_all_trees()
+        response = self.client.get('/upsets/playerpath/4/?offline_only=True')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['path_exist'])
+        self.assertEqual(
+            [hop['upset']['loser']['id'] for hop in response.data['path']],
+            ['1', '3'])
+        response = self.client.get('/upsets/playerpath/6/')
+        self.assertFalse(response.data['path_exist'])
+        response = self.client.get('/upsets/playerpath/unknown/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_playerpath_root(self):
+        UpsetTreeManager('1').update_all_trees()
+        self.manager.update_all_trees()
+        response = self.client.get('/upsets/playerpath/5/?root=1')
+        self.assertEqual(
+            [hop['upset']['loser']['id'] for hop in response.data['path']],
+            ['4', '1'])
+        response = self.client.get(
+            '/upsets/playerpath/5/?root=3&offline_only=True')
+        self.assertEqual(
+            [hop['upset']['loser']['id'] for hop in response.data['path']],
+            ['2', '3'])
+        # No tree for this root
+        response = self.client.get('/upsets/playerpath/5/?root=2')
+        self.assertFalse(response.data['path_exist'])
+
+    def test_playerpath_cache(self):
+        self.manager.update_all_trees()
+        response = self.client.get('/upsets/playerpath/5/')
+        # No query at all once the response is cached
+        with self.assertNumQueries(0):
+            cached_response = self.client.get('/upsets/playerpath/5/')
+        self.assertEqual(cached_response.data, response.data)
+        # A new tree changes the container and thus the cache keys
+        self.manager.update_tree(offline_only=False)
+        with self.assertNumQueries(3):
+            self.client.get('/upsets/playerpath/5/')
+
+    def test_playerpath_cache_key(self):
+        self.manager.update_all_trees()
+        # The keys are valid for memcached whatever the requested id
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', CacheKeyWarning)
+            response = self.client.get(
+                '/upsets/playerpath/%s/' % quote('a b\n' * 100))
+            self.assertEqual(response.status_code, 404)
+            response = self.client.post(
+                '/upsets/playerpaths/', {'player_ids': ['a b' * 100, '4']},
+                content_type='application/json')
+            self.assertIsNone(response.data['paths']['a b' * 100])
+            self.assertTrue(response.data['paths']['4']['path_exist'])
+
+    def test_playerpath_prerender(self):
+        UpsetTreeManager('3').update_all_trees(prerender=True)
+        with self.assertNumQueries(0):
+            response = self.client.get(
+                '/upsets/playerpath/4/?offline_only=True')
+        self.assertEqual(
+            [hop['upset']['loser']['id'] for hop in response.data['path']],
+            ['1', '3'])
+        self.assertEqual(response.data['path'][0]['node_depth'], 2)
+
+    def test_playerpath_stale_container(self):
+        self.manager.update_all_trees()
+        stale = container_registry.get(False)
+        # Another process rebuilds the tree, this one still trusts the old
+        # and now deleted container
+        with mock.patch('upsets.lib.upsettree.container_registry'):
+            self.manager.update_tree(offline_only=False)
+        self.assertEqual(container_registry.get(False), stale)
+        response = self.client.get('/upsets/playerpath/4/')
+        self.assertTrue(response.data['path_exist'])
+        self.assertNotEqual(container_registry.get(False), stale)
+
+    def test_playerpath_snapshot(self):
+        Set.objects.filter(winner_id='4').update(
+            round_name='Grand Final', winner_characters=['ultimate/joker'],
+            loser_characters=['ultimate/wolf', 'ultimate/fox'])
+        Player.objects.filter(id='1').update(main_character='ultimate/roy')
+        urls = ['/upsets/playerpath/%s/%s' % (id, mode) for id in '123456'
+                for mode in ('', '?offline_only=True')]
+        self.manager.update_all_trees()
+        expected = {url: json.loads(self.client.get(url).content)
+                    for url in urls}
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+        tree_snapshots._entries = {}
+        self.addCleanup(setattr, tree_snapshots, '_entries', {})
+        with override_settings(TREE_SNAPSHOT_DIR=snapshot_dir):
+            # Served from the DB until the snapshots are written
+            self.assertIsNone(
+                tree_snapshots.get(container_registry.get(False)))
+            self.manager.update_all_trees()
+            # Nothing is cached, the path is read from the snapshot
+            cache.clear()
+            with self.assertNumQueries(0):
+                response = self.client.get('/upsets/playerpath/4/')
+            self.assertEqual(json.loads(response.content),
+                             expected['/upsets/playerpath/4/'])
+            for url in urls:
+                self.assertEqual(
+                    json.loads(self.client.get(url).content), expected[url])
+            # An update in place writes the snapshot of the new revision
+            Set.objects.filter(winner_id='4').update(round_name='Top 8')
+            self.manager.update_all_trees(incremental=True)
+            response = self.client.get('/upsets/playerpath/4/')
+            self.assertEqual(
+                response.data['path'][0]['upset']['round_name'], 'Top 8')
+            snapshot = tree_snapshots.get(container_registry.get(False))
+            self.assertEqual(snapshot.revision, 1)
+            self.assertIsNone(snapshot.node_index('6'))
+
+    def test_playerpath_snapshot_process_players(self):
+        urls = ['/upsets/playerpath/%s/%s' % (id, mode) for id in '123456'
+                for mode in ('', '?offline_only=True')]
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+        tree_snapshots._entries = {}
+        self.addCleanup(setattr, tree_snapshots, '_entries', {})
+        with override_settings(TREE_SNAPSHOT_DIR=snapshot_dir):
+            self.manager.update_all_trees()
+            Set.objects.filter(winner_id='1').update(
+                winner_characters=['ultimate/roy'])
+            call_command('process_players')
+            cache.clear()
+            # The snapshot of the new revision is served
+            with self.assertNumQueries(0):
+                response = self.client.get('/upsets/playerpath/4/')
+            self.assertEqual(
+                response.data['path'][0]['upset']['loser']['main_character'],
+                'ultimate/roy')
+            served = {url: json.loads(self.client.get(url).content)
+                      for url in urls}
+        cache.clear()
+        for url in urls:
+            self.assertEqual(
+                served[url], json.loads(self.client.get(url).content))
+
+    @override_settings(PLAYER_SEARCH_INDEX=True)
+    def test_search_index_process_players(self):
+        player_search_index._index = None
+        self.addCleanup(setattr, player_search_index, '_index', None)
+        Player.update_search_tags()
+        self.manager.update_all_trees()
+        stale = player_search_index.search('player')
+        self.assertIsNone(stale[0]['last_tournament'])
+        revision = container_registry.get(False).revision
+        call_command('process_players')
+        self.assertEqual(container_registry.get(False).revision, revision + 1)
+        # The registry generation changed, the index is rebuilt
+        with mock.patch.object(PlayerSearchIndexHolder,
+                               '_build_in_background',
+                               PlayerSearchIndexHolder._build):
+            player_search_index.search('player')
+        self.assertEqual(
+            player_search_index.search('player'),
+            PlayerSerializer(search_players('player'), many=True).data)
+        self.assertNotEqual(player_search_index.search('player'), stale)
+
+
+@override_settings(DEFAULT_ROOT_PLAYER_ID='3')
+class Views_UpsetPathsTestCase(UpsetPathDataMixin, TestCase):
+    def post(self, player_ids, query=''):
+        return self.client.post(
+            '/upsets/playerpaths/' + query, {'player_ids': player_ids},
+            content_type='application/json')
+
+    def test_playerpaths(self):
+        self.manager.update_all_trees()
+        response = self.post(['4', '5', '6', 'unknown', '4'],
+                             '?offline_only=True')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['offline_only'])
+        self.assertEqual(list(response.data['paths']),
+                         ['4', '5', '6', 'unknown'])
+        self.assertIsNone(response.data['paths']['unknown'])
+        for id in ('4', '5', '6'):
+            single = self.client.get(
+                '/upsets/playerpath/%s/?offline_only=True' % id)
+            self.assertEqual(response.data['paths'][id], single.data)
+        # The players, their nodes, the registry check for the players
+        # without node, and the path nodes, whatever the number of players
+        for player_ids in (['2', '6'], ['1', '2', '4', '5', '6', '3']):
+            cache.clear()
+            with self.assertNumQueries(4):
+                response = self.post(player_ids)
+            self.assertEqual(len(response.data['paths']), len(player_ids))
+        # All cached now
+        with self.assertNumQueries(0):
+            cached = self.post(['1', '2', '4', '5', '6', '3'])
+        self.assertEqual(cached.data, response.data)
+
+    def test_playerpaths_errors(self):
+        self.assertEqual(self.post('4').status_code, 400)
+        self.assertEqual(self.post([4]).status_code, 400)
+        self.assertEqual(self.post(['4'], '?offline_only=1').status_code, 400)
+        with override_settings(PLAYER_PATHS_MAX_IDS=2):
+            self.assertEqual(self.post(['4', '5', '6']).status_code, 400)
+
+    def test_playerpaths_throttle(self):
+        self.manager.update_all_trees()
+        self.post(['1', '2', '4', '5', '6'])
+        # The request counts once against the anonymous rate
+        self.assertEqual(len(cache.get('throttle_anon_127.0.0.1')), 1)
+
+
+class Views_PlayerPairPathTestCase(tests_upsettree.UpsetTreeDataMixin,
+                                   TestCase):
+    def setUp(self):
+        super().setUp()
+        container_registry.invalidate()
+        upset_graph._entry = None
+        self.addCleanup(setattr, upset_graph, '_entry', None)
+
+    def test_pair_path(self):
+        response = self.client.get(
+            '/upsets/playerpath/4/to/3/?offline_only=True')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['player_tag'], 'player4')
+        self.assertEqual(response.data['target_tag'], 'bestplayer')
+        self.assertTrue(response.data['path_exist'])
+        self.assertEqual(
+            [hop['upset']['loser']['id'] for hop in response.data['path']],
+            ['1', '3'])
+        self.assertEqual(
+            [hop['node_depth'] for hop in response.data['path']], [2, 1])
+        # The graph is loaded, the players and the sets are fetched
+        with self.assertNumQueries(2):
+            response = self.client.get('/upsets/playerpath/5/to/1/')
+        self.assertEqual(
+            [hop['upset']['loser']['id'] for hop in response.data['path']],
+            ['4', '1'])
+        response = self.client.get('/upsets/playerpath/6/to/3/')
+        self.assertFalse(response.data['path_exist'])
+        self.assertNotIn('path', response.data)
+        response = self.client.get('/upsets/playerpath/4/to/unknown/')
+        self.assertEqual(response.status_code, 404)
+        response = self.client.get(
+            '/upsets/playerpath/4/to/3/?offline_only=yes')
+        self.assertEqual(response.status_code, 400)
+
+
+class Views_PlayerSearchTestCase(TestCase):
+    def setUp(self):
+        tags = ['Éric', 'eric', 'Erica', 'Americ', 'Mario', 'MkLeo', 'Leo',
+                'Léon', 'Cléo', 'eri_c', 'Eri%c', 'Ryu', 'Hungrybox']
+        Player.objects.bulk_create([
+            Player(id=str(i), tag=tag, played_sets_count=i * 7 % 13)
+            for i, tag in enumerate(tags)])
+        Player.update_search_tags()
+
+    def test_search_players(self):
+        for term in ['eric', 'ÉRIC', 'ri', 'e', 'leo', 'éo', '%', '_', 'x']:
+            for limit in (1, 2, 3, 20):
+                self.assertEqual(search_players(term, limit),
+                                 scan_search_players(term, limit))
+
+    def test_search_players_literal_term(self):
+        # The term is normalized beforehand, the prefix query compares the
+        # tags to a literal so that it can use the btree pattern index
+        with CaptureQueriesContext(connection) as context:
+            search_players('leo', 1)
+        self.assertEqual(len(context.captured_queries), 2)
+        self.assertNotIn('UNACCENT', context.captured_queries[1]['sql'])
+        self.assertIn("LIKE 'LEO%'", context.captured_queries[1]['sql'])
+
+    def test_search_endpoint(self):
+        response = self.client.get('/upsets/players/search/?term=leo')
+        self.assertEqual([player['tag'] for player in response.data],
+                         ['Leo', 'Léon', 'MkLeo', 'Cléo'])
+        response = self.client.get('/upsets/players/search/')
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(PLAYER_SEARCH_INDEX=True)
+    def test_search_index(self):
+        player_search_index._index = None
+        self.addCleanup(setattr, player_search_index, '_index', None)
+        for threshold in (1000, 0):
+            with mock.patch.object(
+                    PlayerSearchIndex, 'SCAN_THRESHOLD', threshold):
+                for term in ['eric', 'ri', 'e', 'leo', 'LEO', '%', '_', 'x']:
+                    for limit in (1, 2, 3, 20):
+                        self.assertEqual(
+                            player_search_index.search(term, limit),
+                            PlayerSerializer(search_players(term, limit),
+                                             many=True).data)
+        # The accentuated terms are searched in the DB
+        self.assertIsNone(player_search_index.search('éo'))
+        response = self.client.get('/upsets/players/search/?term=éo')
+        self.assertEqual([player['tag'] for player in response.data],
+                         [player.tag for player in search_players('éo')])
+        # The ready container is already resolved, the DB isn't hit at all
+        with self.assertNumQueries(0):
+            response = self.client.get('/upsets/players/search/?term=leo')
+        self.assertEqual([player['tag'] for player in response.data],
+                         ['Leo', 'Léon', 'MkLeo', 'Cléo'])
+
+
+class Views_RequestMetricsTestCase(TestCase):
+    def setUp(self):
+        Player.objects.create(id='1', tag='MkLeo', search_tag='MKLEO')
+        request_metrics.reset()
+        self.addCleanup(request_metrics.reset)
+
+    def test_not_sampled(self):
+        response = self.client.get('/upsets/players/search/?term=leo')
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(request_metrics.stats(), {})
+
+    @override_settings(REQUEST_METRICS_SAMPLE_RATE=1.)
+    def test_sampled(self):
+        for _ in range(3):
+            response = self.client.get('/upsets/players/search/?term=leo')
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^db;dur=[0-9.]+;desc="[0-9]+ queries", serialize;dur=[0-9.]+, '
+            r'render;dur=[0-9.]+, total;dur=[0-9.]+$')
+        queries = int(re.search(r'"([0-9]+) queries"',
+                                response['Server-Timing']).group(1))
+        self.assertGreater(queries, 0)
+        # Admins only
+        response = self.client.get('/upsets/stats/requests/')
+        self.assertEqual(response.status_code, 403)
+        User.objects.create_superuser('admin', password='password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get('/upsets/stats/requests/')
+        self.assertEqual(response.status_code, 200)
+        stats = response.data['endpoints']['upsets/players/search/']
+        self.assertEqual(stats['count'], 3)
+        self.assertEqual(stats['queries_per_request'], queries)
+        self.assertLessEqual(stats['total']['p50'], stats['total']['p99'])
+        self.assertGreater(stats['serialize']['max'], 0)
+        # Only the reset request itself is left
+        self.client.delete('/upsets/stats/requests/')
+        self.assertEqual(list(request_metrics.stats()),
+                         ['upsets/stats/requests/'])
+
+    def test_histogram(self):
+        histogram = DurationHistogram()
+        for duration in range(1, 101):
+            histogram.add(duration / 1000)
+        # Within the 25% of the buckets
+        self.assertAlmostEqual(histogram.percentile(0.5), 0.05, delta=0.0125)
+        self.assertAlmostEqual(histogram.percentile(0.99), 0.099,
+                               delta=0.025)
+        self.assertEqual(histogram.percentile(1), 0.1)
+        histogram.add(1000)
+        self.assertEqual(histogram.percentile(1), 1000)
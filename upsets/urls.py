@@ -3,6 +3,10 @@ from upsets import views
 
 urlpatterns = [
     path('playerpath/<str:id>/', views.UpsetPath.as_view()),
+    path('playerpaths/', views.UpsetPaths.as_view()),
+    path('playerpath/<str:id>/to/<str:target_id>/',
+         views.PlayerPairPath.as_view()),
     path('players/search/', views.PlayerSearch.as_view()),
     path('twittertag/player/<str:id>/', views.PlayerTwitterTag.as_view()),
+    path('stats/requests/', views.RequestStats.as_view()),
 ]
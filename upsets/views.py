@@ -1,92 +1,281 @@
-from upsets.models import UpsetTreeNode, Player, TwitterTag, TreeContainer
-from upsets.serializers import UpsetTreeNodeSerializer, PlayerSerializer
+from upsets.models import UpsetTreeNode, Player, Set, TwitterTag
+from upsets.serializers import UpsetTreeNodeSerializer, PlayerSerializer, \
+    SetSerializer
+from upsets.lib.pathcache import UpsetPathCache
+from upsets.lib.containers import container_registry
+from upsets.lib.treesnapshot import tree_snapshots
+from upsets.lib.playersearch import search_players
+from upsets.lib.searchindex import player_search_index
+from upsets.lib.upsetgraph import upset_graph
+from upsets.lib.requestmetrics import request_metrics
+from upsets.middleware import serializing
+from django.conf import settings
 from django.http import Http404, HttpResponseBadRequest
-from django.db.models import BooleanField, Case, Value, When
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView
 from rest_framework.response import Response
 from rest_framework.exceptions import ParseError
+from rest_framework.permissions import IsAdminUser
 import json
 
 from logging import getLogger
 logger = getLogger('data_processing')
 
 
+def offline_only_param(request):
+    """
+    Return the offline_only GET parameter as a bool, None if it is invalid
+    """
+    # GET parameters are always strings.
+    offline_only_str = request.GET.get('offline_only', 'False')
+    if offline_only_str == 'False':
+        return False
+    elif offline_only_str == 'True':
+        return True
+    return None
+
+
+def offline_only_error():
+    """
+    Return the response to an invalid offline_only GET parameter
+    """
+    # Use the same format as DRF errors
+    return HttpResponseBadRequest(
+        json.dumps({
+            'detail': 'GET parameter offline_only should be either ' +
+                      'not defined, True, or False.'
+            }),
+        content_type="application/json")
+
+
 class UpsetPath(APIView):
     """
     Retrieve the upset root path given a player id
+
+    The path leads to the root player given by the root GET parameter, or
+    to the default root player. Responses are cached per tree container,
+    see UpsetPathCache. The ready container itself is resolved from the
+    process-local registry. When the tree has an up to date snapshot, see
+    TreeSnapshot, the paths of its players are read from it without any DB
+    query, the other players are looked up in the DB.
     """
+    path_cache = UpsetPathCache()
 
     def get(self, request, id, format=None):
-        # GET parameters are always strings.
-        offline_only_str = request.GET.get('offline_only', 'False')
-        if offline_only_str == 'False':
-            offline_only = False
-        elif offline_only_str == 'True':
-            offline_only = True
-        else:
-            # Use the same format as DRF errors
-            return HttpResponseBadRequest(
-                json.dumps({
-                    'detail': 'GET parameter offline_only should be either ' +
-                              'not defined, True, or False.'
-                    }),
-                content_type="application/json")
-        # offline_only correctly defined
+        offline_only = offline_only_param(request)
+        if offline_only is None:
+            return offline_only_error()
+        root = request.GET.get('root') or None
+        container = container_registry.get(offline_only, root)
+        if container is None:
+            return Response(
+                self.get_path_data(id, offline_only, container, root))
+        snapshot = tree_snapshots.get(container)
+        if snapshot is not None:
+            data = snapshot.path_data(id)
+            if data is not None:
+                return Response(data)
+        data = self.path_cache.get(id, container)
+        if data is None:
+            data = self.get_path_data(id, offline_only, container, root)
+            self.path_cache.set(id, container, data)
+        return Response(data)
+
+    def get_path_data(self, id, offline_only, container, root=None):
+        """
+        Build the response data of a player path in the given container of
+        the root player
+        """
         try:
             player = Player.objects.get(id=id)
             try:
-                container = TreeContainer.objects \
-                    .filter(ready=True) \
-                    .filter(offline_only=offline_only) \
-                    .order_by('-update_date') \
-                    .first()
                 upset_node = UpsetTreeNode.objects \
                     .filter(tree_container=container) \
                     .get(player=player)
             except UpsetTreeNode.DoesNotExist:
-                return Response(
-                    {'player_tag': player.tag,
-                     'offline_only': offline_only,
-                     'path_exist': False})
+                # The registry may still hold a container deleted by a
+                # rebuild, check with the DB before answering there's no path
+                current = container_registry.reload(offline_only, root)
+                if current is not None and current != container:
+                    return self.get_path_data(
+                        id, offline_only, current, root)
+                return {'player_tag': player.tag,
+                        'offline_only': offline_only,
+                        'path_exist': False}
         except Player.DoesNotExist:
             raise Http404
 
         upset_root_path = upset_node.get_root_path()
-        serializer = UpsetTreeNodeSerializer(upset_root_path, many=True)
-        return Response(
-            {'player_tag': player.tag,
-             'offline_only': offline_only,
-             'path_exist': True,
-             'path': serializer.data})
+        with serializing(self.request):
+            path = UpsetTreeNodeSerializer(upset_root_path, many=True).data
+        return {'player_tag': player.tag,
+                'offline_only': offline_only,
+                'path_exist': True,
+                'path': path}
+
+
+class UpsetPaths(APIView):
+    """
+    Retrieve the upset root paths of several players at once
+
+    The player ids are posted as a JSON list in player_ids, up to
+    PLAYER_PATHS_MAX_IDS of them, and the offline_only and root GET
+    parameters are the ones of UpsetPath. The paths are read from the tree
+    snapshot or the path cache when possible, the other ones are built with
+    a fixed number of queries whatever the number of players, the nodes
+    shared by several paths being fetched and serialized once. Being a
+    single request, it counts once against the throttle rates.
+    """
+
+    def post(self, request, format=None):
+        offline_only = offline_only_param(request)
+        if offline_only is None:
+            return offline_only_error()
+        player_ids = request.data.get('player_ids') \
+            if isinstance(request.data, dict) else None
+        if not isinstance(player_ids, list) or \
+                not all(isinstance(id, str) for id in player_ids):
+            raise ParseError(
+                detail="Body should contain a 'player_ids' list of player "
+                       "ids.")
+        # Without duplicates, in the requested order
+        player_ids = list(dict.fromkeys(player_ids))
+        if len(player_ids) > settings.PLAYER_PATHS_MAX_IDS:
+            raise ParseError(
+                detail='At most %s player ids can be requested at once.'
+                       % settings.PLAYER_PATHS_MAX_IDS)
+        root = request.GET.get('root') or None
+        container = container_registry.get(offline_only, root)
+        paths = {}
+        if container is not None:
+            snapshot = tree_snapshots.get(container)
+            if snapshot is not None:
+                for id in player_ids:
+                    data = snapshot.path_data(id)
+                    if data is not None:
+                        paths[id] = data
+            paths.update(UpsetPath.path_cache.get_many(
+                [id for id in player_ids if id not in paths], container))
+        missing = [id for id in player_ids if id not in paths]
+        if missing:
+            built = self.get_paths_data(missing, offline_only, container, root)
+            if container is not None:
+                UpsetPath.path_cache.set_many(built, container)
+            paths.update(built)
+        # The unknown players have no data
+        return Response({
+            'offline_only': offline_only,
+            'paths': {id: paths.get(id) for id in player_ids}})
+
+    def get_paths_data(self, player_ids, offline_only, container, root=None):
+        """
+        Build the response data of the paths of the given players in the
+        container of the root player, by player id, like
+        UpsetPath.get_path_data does for one player
+        """
+        players = Player.objects.in_bulk(player_ids)
+        nodes = {}
+        if container is not None:
+            nodes = {node.player_id: node for node in UpsetTreeNode.objects
+                     .filter(tree_container=container,
+                             player_id__in=list(players))}
+        if len(nodes) < len(players):
+            # The registry may still hold a container deleted by a rebuild,
+            # check with the DB before answering there's no path
+            current = container_registry.reload(offline_only, root)
+            if current is not None and current != container:
+                return self.get_paths_data(
+                    player_ids, offline_only, current, root)
+        root_paths = UpsetTreeNode.get_root_paths(list(nodes.values()))
+        with serializing(self.request):
+            # node id -> serialized node, for the nodes shared by several paths
+            serialized = {}
+            data = {}
+            for (id, player) in players.items():
+                node = nodes.get(id)
+                if node is None:
+                    data[id] = {'player_tag': player.tag,
+                                'offline_only': offline_only,
+                                'path_exist': False}
+                    continue
+                path = []
+                for path_node in root_paths[node.id]:
+                    if path_node.id not in serialized:
+                        serialized[path_node.id] = \
+                            UpsetTreeNodeSerializer(path_node).data
+                    path.append(serialized[path_node.id])
+                data[id] = {'player_tag': player.tag,
+                            'offline_only': offline_only,
+                            'path_exist': True,
+                            'path': path}
+        return data
+
+
+class PlayerPairPath(APIView):
+    """
+    Retrieve the shortest upset path from a player to any target player
+
+    The path is found in the process-local upset graph, see UpsetGraph,
+    and is the one the upset tree of the target player would give.
+    """
+
+    def get(self, request, id, target_id, format=None):
+        offline_only = offline_only_param(request)
+        if offline_only is None:
+            return offline_only_error()
+        players = Player.objects.in_bulk([id, target_id])
+        if id not in players or target_id not in players:
+            raise Http404
+        graph = upset_graph.get()
+        set_indexes = graph.shortest_path(
+            id, target_id, offline_only=offline_only)
+        data = {'player_tag': players[id].tag,
+                'target_tag': players[target_id].tag,
+                'offline_only': offline_only,
+                'path_exist': set_indexes is not None}
+        if set_indexes is not None:
+            set_ids = [graph.set_id(index) for index in set_indexes]
+            sets = Set.objects \
+                .select_related('tournament', 'winner', 'loser') \
+                .in_bulk(set_ids)
+            # Like the tree paths, the depth is the distance to the target
+            with serializing(request):
+                data['path'] = [
+                    {'node_depth': len(set_ids) - i,
+                     'upset': SetSerializer(sets[set_id]).data}
+                    for (i, set_id) in enumerate(set_ids)]
+        return Response(data)
 
 
 class PlayerSearch(ListAPIView):
+    """
+    Search the players by tag
+
+    When the PLAYER_SEARCH_INDEX setting is on, the terms are searched in the
+    process-local index, see upsets.lib.searchindex, and only fall back to
+    the DB when the index can't answer them.
+    """
     serializer_class = PlayerSerializer
 
+    def list(self, request, *args, **kwargs):
+        searchterm = request.query_params.get('term', None)
+        if searchterm and player_search_index.enabled():
+            players = player_search_index.search(searchterm, limit=20)
+            if players is not None:
+                return Response(players)
+        players = self.get_queryset()
+        with serializing(request):
+            data = self.get_serializer(players, many=True).data
+        return Response(data)
+
     def get_queryset(self):
         """
         Restricts the returned players by filtering tags against the `term`
-        query parameter in the URL.
+        query parameter in the URL, see search_players.
         """
         searchterm = self.request.query_params.get('term', None)
         if searchterm:
-            queryset = Player.objects \
-                .filter(tag__unaccent__icontains=searchterm) \
-                .annotate(
-                    is_start=Case(
-                        When(tag__unaccent__istartswith=searchterm,
-                             then=Value(True)),
-                        default=False,
-                        output_field=BooleanField()),
-                    is_exact=Case(
-                        When(tag__unaccent__iexact=searchterm,
-                             then=Value(True)),
-                        default=False,
-                        output_field=BooleanField())) \
-                .select_related('last_tournament') \
-                .order_by('-is_exact', '-is_start', '-played_sets_count')
-            return queryset[:20]
+            return search_players(searchterm, limit=20)
         else:
             message = \
                 "Url should contain a non empty 'term' query string parameter."
@@ -119,3 +308,23 @@ class PlayerTwitterTag(APIView):
         return Response(
             {'player_id': player.id,
              'twitter_tag': None})
+
+
+class RequestStats(APIView):
+    """
+    Get the latency percentiles of the API endpoints, in milliseconds.
+
+    Only the requests sampled by RequestMetricsMiddleware, and served by the
+    process answering this request, are counted. Restricted to the admins,
+    a DELETE resets the stats.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response({
+            'sample_rate': settings.REQUEST_METRICS_SAMPLE_RATE,
+            'endpoints': request_metrics.stats()})
+
+    def delete(self, request, format=None):
+        request_metrics.reset()
+        return Response(status=204)
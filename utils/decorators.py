@@ -1,13 +1,16 @@
 import time
 import functools
 from django.http import Http404
+from utils.instrumentation import phase
 
 
 def time_it(logger):
     def decorator(method):
         def timed(*args, **kw):
             ts = time.time()
-            result = method(*args, **kw)
+            # Also a phase of the run report, if any
+            with phase(method.__name__):
+                result = method(*args, **kw)
             te = time.time()
             logger.info(method.__name__ + " took {}".format((te-ts)*1000))
             return result
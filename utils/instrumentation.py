@@ -0,0 +1,269 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import cProfile
+from itertools import count
+import json
+import resource
+import threading
+import time
+from django.db import connection
+
+# The report the phases are recorded in, None when not reporting
+_active_report = None
+# The stack of the running phases of each thread
+_local = threading.local()
+
+
+class Phase:
+    """A timed step of a run, holding its metrics and its sub-phases
+
+    Attributes
+    ----------
+    name: str
+        The name of the phase
+    rows: int
+        The number of rows processed by the phase, if it counts them
+    batches: list of dict
+        The model, rows count and duration of each batch written in the
+        phase, see record_batch
+    phases: list of Phase
+        The sub-phases
+    metrics: dict
+        The timings, DB queries and resources usage of the phase, set when
+        it ends
+
+    Methods
+    -------
+    to_dict()
+        Return the phase as a dict serializable in JSON
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.batches = []
+        self.phases = []
+        self.metrics = {}
+        self._queries = 0
+        self._query_time = 0.
+
+    def _execute(self, execute, sql, params, many, context):
+        """The DB execute wrapper counting the queries of the phase
+        """
+        ts = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self._queries += 1
+            self._query_time += time.perf_counter() - ts
+
+    def to_dict(self):
+        """Return the phase as a dict serializable in JSON
+        """
+        data = {'name': self.name}
+        data.update(self.metrics)
+        if self.rows is not None:
+            data['rows'] = self.rows
+            elapsed = self.metrics.get('elapsed')
+            if elapsed:
+                data['rows_per_second'] = round(self.rows / elapsed, 1)
+        if self.batches:
+            data['batches'] = self.batches
+        if self.phases:
+            data['phases'] = [phase.to_dict() for phase in self.phases]
+        return data
+
+
+class RunReport:
+    """The metrics of a run of a data processing command
+
+    The phases are recorded in the active report, see activate and phase,
+    with their wall and CPU times, their DB queries count and time, the
+    peak RSS of the process since its start at their end, and their
+    batches. The report is written as JSON, to compare the runs of the
+    nightly updates.
+
+    Attributes
+    ----------
+    name: str
+        The name of the run, usually the command name
+    root: Phase
+        The phase of the whole run, holding the top level phases
+
+    Methods
+    -------
+    activate()
+        Record the phases in this report while in the with block
+    to_dict()
+        Return the report as a dict serializable in JSON
+    write(path)
+        Write the report as JSON
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.root = Phase(name)
+        self._started_at = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def activate(self):
+        """Record the phases in this report while in the with block, the
+        whole block being the root phase
+        """
+        global _active_report
+        previous = _active_report
+        _active_report = self
+        self._started_at = datetime.now(timezone.utc)
+        try:
+            with _measure(self.root):
+                yield self
+        finally:
+            _active_report = previous
+
+    def _attach(self, phase, parent):
+        with self._lock:
+            (parent or self.root).phases.append(phase)
+
+    def to_dict(self):
+        """Return the report as a dict serializable in JSON
+        """
+        data = self.root.to_dict()
+        data['started_at'] = self._started_at.isoformat() \
+            if self._started_at else None
+        return data
+
+    def write(self, path):
+        """Write the report as JSON
+        """
+        with open(path, 'w') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def _measure(phase):
+    stack = _stack()
+    stack.append(phase)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    ts = time.perf_counter()
+    try:
+        with connection.execute_wrapper(phase._execute):
+            yield phase
+    finally:
+        stack.pop()
+        end_usage = resource.getrusage(resource.RUSAGE_SELF)
+        phase.metrics.update({
+            'elapsed': round(time.perf_counter() - ts, 4),
+            # The CPU times are the ones of the whole process
+            'cpu_user': round(end_usage.ru_utime - usage.ru_utime, 4),
+            'cpu_system': round(end_usage.ru_stime - usage.ru_stime, 4),
+            'queries': phase._queries,
+            'query_time': round(phase._query_time, 4),
+            # ru_maxrss is in KB on Linux, and can't be reset: it is the
+            # peak of the process since its start, not of the phase
+            'process_peak_rss_kb': end_usage.ru_maxrss,
+            'thread': threading.current_thread().name})
+
+
+@contextmanager
+def phase(name, parent=None):
+    """Record the with block as a phase of the active report, nested in
+    the given parent phase or in the running phase of the thread
+
+    Yield the Phase, whose rows can be set. When no report is active, the
+    phase isn't measured nor recorded.
+    """
+    report = _active_report
+    if report is None:
+        yield Phase(name)
+        return
+    if parent is None:
+        stack = _stack()
+        parent = stack[-1] if stack else None
+    current = Phase(name)
+    report._attach(current, parent)
+    with _measure(current):
+        yield current
+
+
+def current_phase():
+    """Return the running phase of the thread, the root phase of the active
+    report if there is none, or a phase which isn't recorded when no report
+    is active
+    """
+    if _active_report is None:
+        return Phase(None)
+    stack = _stack()
+    return stack[-1] if stack else _active_report.root
+
+
+def phased(iterable, name, rows=None):
+    """Yield the items of the iterable, the computation of each item by the
+    iterable and its processing by the consumer being recorded as a phase
+    named name % its number, from 1
+
+    rows(item) gives the number of rows of the phase, if given. The last
+    phase records the work of the iterable until it is exhausted, with 0
+    rows.
+    """
+    iterator = iter(iterable)
+    for number in count(1):
+        with phase(name % number) as current:
+            item = next(iterator, _EXHAUSTED)
+            if item is _EXHAUSTED:
+                if rows is not None:
+                    current.rows = 0
+                return
+            if rows is not None:
+                current.rows = rows(item)
+            yield item
+
+
+# The end marker of the iterables, see phased
+_EXHAUSTED = object()
+
+
+def record_batch(model, rows, elapsed):
+    """Record a batch of rows written for the model in the running phase
+    of the thread, if a report is active
+    """
+    if _active_report is None:
+        return
+    stack = _stack()
+    current = stack[-1] if stack else _active_report.root
+    current.batches.append({'model': model, 'rows': rows,
+                            'elapsed': round(elapsed, 4)})
+
+
+@contextmanager
+def reporting(name, report_path=None, profile_path=None):
+    """Record a run report written to report_path, and profile the run
+    with cProfile in profile_path, when given
+
+    The report is written even if the run fails. The profile can be read
+    with pstats or a viewer like snakeviz.
+    """
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        if report_path:
+            report = RunReport(name)
+            try:
+                with report.activate():
+                    yield report
+            finally:
+                report.write(report_path)
+        else:
+            yield None
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
@@ -1,4 +1,57 @@
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
+import hashlib
+import io
+import time
+from django.db import connection, transaction
+from django.db.models.fields import AutoFieldMixin
+from utils.instrumentation import record_batch
+
+
+def keyset_iterator(queryset, chunk_size=2000, prefetch_next=False):
+    """Iterate over a queryset by chunks of primary keys
+
+    Unlike queryset.iterator(), the prefetch_related lookups of the queryset
+    are applied to each chunk. Unlike a Paginator, the chunks are selected
+    by primary key (pk > last pk ORDER BY pk LIMIT chunk_size) rather than
+    by offset, each query costs the same whatever the position, and the
+    rows updated during the iteration don't shift the next chunks.
+
+    With prefetch_next, the next chunk is loaded on a background thread
+    while the current one is processed. The background thread has its own
+    DB connection, which can't see the changes of the current transaction:
+    inside an atomic block the chunks are always loaded in the current
+    thread.
+    """
+    queryset = queryset.order_by('pk')
+
+    def fetch(last_pk):
+        chunk = queryset if last_pk is None \
+            else queryset.filter(pk__gt=last_pk)
+        return list(chunk[:chunk_size])
+
+    if not prefetch_next or connection.in_atomic_block:
+        chunk = fetch(None)
+        while chunk:
+            yield from chunk
+            if len(chunk) < chunk_size:
+                break
+            chunk = fetch(chunk[-1].pk)
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        try:
+            future = executor.submit(fetch, None)
+            while future is not None:
+                chunk = future.result()
+                future = None
+                if len(chunk) == chunk_size:
+                    future = executor.submit(fetch, chunk[-1].pk)
+                yield from chunk
+        finally:
+            # Close the connection opened by the background thread, the
+            # connection must be resolved in that thread
+            executor.submit(lambda: connection.close())
 
 
 class BulkBatchManager:
@@ -18,21 +71,53 @@ class BulkBatchManager:
         Use ignore_conflicts on bulk_create calls
     _logger: logging.Logger object
         The logger to use when logging batch steps
+    _fingerprint_field: str
+        The name of a BigIntegerField of the model storing a hash of the
+        updated fields values. With it, bulk_update_or_create only writes
+        the instances whose hash changed.
 
     Methods
     -------
     bulk_create(generator)
         Batch bulk create from a generator
-    bulk_create_or_update(generator, fields)
+    bulk_create_or_update(generator, fields, on_written, on_writing)
         Batch bulk create or update from a generator and a list of fields
+    bulk_update(generator, fields)
+        Batch bulk update from a generator and a list of fields to update
     """
 
     def __init__(self, model, batch_size=10000, ignore_conflicts=False,
-                 logger=None):
+                 logger=None, fingerprint_field=None):
         self._model = model
         self._batch_size = batch_size
         self._ignore_conflicts = ignore_conflicts
         self._logger = logger
+        self._fingerprint_field = fingerprint_field
+
+    def _fingerprinted(self, generator, fields):
+        """Yield the instances of the generator with their fingerprint set
+        to a 64 bits hash of the given fields values
+        """
+        if self._fingerprint_field is None:
+            yield from generator
+            return
+        attnames = [self._model._meta.get_field(name).attname
+                    for name in fields]
+        for item in generator:
+            digest = hashlib.blake2b(
+                repr([getattr(item, attname) for attname in attnames])
+                .encode(), digest_size=8).digest()
+            setattr(item, self._fingerprint_field,
+                    int.from_bytes(digest, 'big', signed=True))
+            yield item
+
+    def _log_counts(self, counts):
+        if self._logger:
+            self._logger.info(
+                "Bulk updated or created %s %s instances: %s new, %s changed"
+                " and %s unchanged"
+                % (sum(counts.values()), self._model.__name__,
+                   counts['new'], counts['changed'], counts['unchanged']))
 
     def bulk_create(self, generator):
         """Batch bulk create from a generator
@@ -42,31 +127,69 @@ class BulkBatchManager:
             items = list(islice(generator, self._batch_size))
             if not items:
                 break
+            ts = time.perf_counter()
             self._model.objects.bulk_create(
                 items, ignore_conflicts=self._ignore_conflicts)
+            record_batch(
+                self._model.__name__, len(items), time.perf_counter() - ts)
 
             if self._logger:
                 self._logger.info(
                     "Bulk created new batch of %s %s instances"
                     % (len(items), self._model.__name__))
 
-    def bulk_update_or_create(self, generator, fields):
+    def bulk_update_or_create(self, generator, fields, on_written=None,
+                              on_writing=None):
         """Batch bulk update or create from a generator and a list of fields
+
+        Return the numbers of new, changed and unchanged instances. Without
+        fingerprint field, all the existing instances count as changed.
+        on_written is called after each batch with the primary keys of its
+        new and changed instances, and on_writing before each batch with the
+        primary keys of its changed instances, while their stored rows still
+        hold the previous values.
         """
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        generator = self._fingerprinted(generator, fields)
+        if self._fingerprint_field:
+            fields = list(fields) + [self._fingerprint_field]
         while True:
 
             items = list(islice(generator, self._batch_size))
             if not items:
                 break
-            # Bulk get or create by creating the new then updating the existing
+            ts = time.perf_counter()
+            # Bulk get or create by creating the new then updating the
+            # existing ones, if their fingerprint changed
+            existing = dict(
+                self._model.objects
+                .filter(pk__in=[item.pk for item in items])
+                .values_list('pk', self._fingerprint_field or 'pk'))
+            new = [item for item in items if item.pk not in existing]
+            changed = [
+                item for item in items if item.pk in existing and (
+                    self._fingerprint_field is None
+                    or existing[item.pk] !=
+                    getattr(item, self._fingerprint_field))]
+            if on_writing is not None:
+                on_writing([item.pk for item in changed])
             self._model.objects.bulk_create(
-                items, ignore_conflicts=self._ignore_conflicts)
-            self._model.objects.bulk_update(items, fields)
+                new, ignore_conflicts=self._ignore_conflicts)
+            self._model.objects.bulk_update(changed, fields)
+            if on_written is not None:
+                on_written([item.pk for item in new + changed])
+            counts['new'] += len(new)
+            counts['changed'] += len(changed)
+            counts['unchanged'] += len(items) - len(new) - len(changed)
+            record_batch(
+                self._model.__name__, len(items), time.perf_counter() - ts)
 
             if self._logger:
                 self._logger.info(
                     "Bulk updated or created new batch of %s %s instances"
                     % (len(items), self._model.__name__))
+        self._log_counts(counts)
+        return counts
 
     def bulk_update(self, generator, fields):
         """Batch bulk update from a generator and a list of fields to update
@@ -76,9 +199,237 @@ class BulkBatchManager:
             items = list(islice(generator, self._batch_size))
             if not items:
                 break
+            ts = time.perf_counter()
             self._model.objects.bulk_update(items, fields)
+            record_batch(
+                self._model.__name__, len(items), time.perf_counter() - ts)
 
             if self._logger:
                 self._logger.info(
                     "Bulk updated new batch of %s %s instances"
                     % (len(items), self._model.__name__))
+
+
+class CopyBulkBatchManager(BulkBatchManager):
+    """A BulkBatchManager writing the batches with the postgres COPY
+
+    Django bulk_update builds a CASE WHEN expression per field which gets
+    very slow on large batches. Here each batch is copied as CSV in a
+    temporary staging table, then written by a single INSERT or UPDATE
+    statement from the staging table: bulk_update_or_create is an INSERT ...
+    ON CONFLICT (pk) DO UPDATE of the given fields only. When a batch holds
+    several instances with the same primary key, the last one wins, like
+    between batches. It has the same API as BulkBatchManager and only works
+    on postgres.
+
+    Methods
+    -------
+    bulk_create(generator)
+        Batch bulk create from a generator
+    bulk_create_or_update(generator, fields, on_written, on_writing)
+        Batch bulk create or update from a generator and a list of fields
+    bulk_update(generator, fields)
+        Batch bulk update from a generator and a list of fields to update
+    """
+
+    def __init__(self, model, batch_size=10000, ignore_conflicts=False,
+                 logger=None, fingerprint_field=None):
+        if connection.vendor != 'postgresql':
+            raise ValueError('COPY bulk operations need postgres, not %s.'
+                             % connection.vendor)
+        super().__init__(model, batch_size=batch_size,
+                         ignore_conflicts=ignore_conflicts, logger=logger,
+                         fingerprint_field=fingerprint_field)
+
+    def bulk_create(self, generator):
+        """Batch bulk create from a generator
+        """
+        opts = self._model._meta
+        fields = [field for field in opts.concrete_fields
+                  if not isinstance(field, AutoFieldMixin)]
+        columns = self._columns(fields)
+        self._copy_batches(
+            generator, fields,
+            "INSERT INTO %s (%s) SELECT %s FROM %%(staging)s"
+            " ORDER BY copy_row %s"
+            % (self._quote(opts.db_table), columns, columns,
+               'ON CONFLICT DO NOTHING' if self._ignore_conflicts else ''),
+            'created')
+
+    def bulk_update_or_create(self, generator, fields, on_written=None,
+                              on_writing=None):
+        """Batch bulk update or create from a generator and a list of fields
+
+        Return the numbers of new, changed and unchanged instances. Without
+        fingerprint field, all the existing instances count as changed.
+        on_written is called after each batch with the primary keys of its
+        new and changed instances, and on_writing before each batch with the
+        primary keys of its changed instances, while their stored rows still
+        hold the previous values.
+        """
+        opts = self._model._meta
+        table = self._quote(opts.db_table)
+        pk = self._quote(opts.pk.column)
+        columns = self._columns(opts.concrete_fields)
+        generator = self._fingerprinted(generator, fields)
+        fields = self._fields(fields)
+        condition = ''
+        # The changed rows of the batch, before the statement
+        changed = "SELECT DISTINCT %s.%s FROM %s" \
+            " JOIN %%(staging)s AS staging ON %s.%s = staging.%s" \
+            % (table, pk, table, table, pk, pk)
+        if self._fingerprint_field:
+            fingerprint = self._fields([self._fingerprint_field])[0]
+            fields.append(fingerprint)
+            condition = ' WHERE %s.%s IS DISTINCT FROM EXCLUDED.%s' % (
+                table, self._quote(fingerprint.column),
+                self._quote(fingerprint.column))
+            changed += ' WHERE %s.%s IS DISTINCT FROM staging.%s' % (
+                table, self._quote(fingerprint.column),
+                self._quote(fingerprint.column))
+        updates = ', '.join(
+            '%s = EXCLUDED.%s' % ((self._quote(field.column),) * 2)
+            for field in fields)
+        counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+        # The rows skipped by the condition are not returned, and xmax is
+        # only 0 for the inserted ones
+        self._copy_batches(
+            generator, opts.concrete_fields,
+            "INSERT INTO %s (%s) SELECT DISTINCT ON (%s) %s"
+            " FROM %%(staging)s ORDER BY %s, copy_row DESC"
+            " ON CONFLICT (%s) %s RETURNING %s, (xmax = 0)"
+            % (table, columns, pk, columns, pk, pk,
+               'DO UPDATE SET %s%s' % (updates, condition) if updates
+               else 'DO NOTHING', pk),
+            'updated or created', counts, on_written,
+            (changed, on_writing) if on_writing is not None else None)
+        self._log_counts(counts)
+        return counts
+
+    def bulk_update(self, generator, fields):
+        """Batch bulk update from a generator and a list of fields to update
+        """
+        opts = self._model._meta
+        table = self._quote(opts.db_table)
+        pk = self._quote(opts.pk.column)
+        fields = self._fields(fields)
+        updates = ', '.join(
+            '%s = staging.%s' % ((self._quote(field.column),) * 2)
+            for field in fields)
+        self._copy_batches(
+            generator, [opts.pk] + fields,
+            "UPDATE %s SET %s FROM (SELECT DISTINCT ON (%s) *"
+            " FROM %%(staging)s ORDER BY %s, copy_row DESC) AS staging"
+            " WHERE %s.%s = staging.%s"
+            % (table, updates, pk, pk, table, pk, pk),
+            'updated')
+
+    @staticmethod
+    def _quote(name):
+        return connection.ops.quote_name(name)
+
+    def _columns(self, fields):
+        return ', '.join(self._quote(field.column) for field in fields)
+
+    def _fields(self, names):
+        # The fields can be given by name or attname, like for bulk_update
+        return [self._model._meta.get_field(name) for name in names]
+
+    def _copy_batches(self, generator, fields, statement, action,
+                      counts=None, on_written=None, before=None):
+        """Copy the batches of the generator in a staging table of the given
+        fields, and run the statement after each copy
+
+        With counts, the statement returns the primary key of each written
+        row and whether it was inserted, the counts are incremented
+        accordingly and the primary keys given to on_written. before is an
+        optional (query, callback) pair: the query runs before the statement
+        and the primary keys it returns are given to the callback.
+        """
+        staging = self._quote('copy_staging_%s' % self._model._meta.db_table)
+        columns = self._columns(fields)
+        statement = statement % {'staging': staging}
+        if before is not None:
+            before = (before[0] % {'staging': staging}, before[1])
+        with connection.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS %s" % staging)
+            cursor.execute(
+                "CREATE TEMPORARY TABLE %s AS SELECT %s FROM %s WITH NO DATA"
+                % (staging, columns,
+                   self._quote(self._model._meta.db_table)))
+            # Numbers the rows in the order they are copied
+            cursor.execute(
+                "ALTER TABLE %s ADD COLUMN copy_row bigserial" % staging)
+            try:
+                while True:
+                    items = list(islice(generator, self._batch_size))
+                    if not items:
+                        break
+                    ts = time.perf_counter()
+                    data = io.StringIO()
+                    for item in items:
+                        data.write(','.join(
+                            _copy_value(field.get_db_prep_save(
+                                field.pre_save(item, add=True), connection))
+                            for field in fields))
+                        data.write('\n')
+                    data.seek(0)
+                    with transaction.atomic():
+                        cursor.execute("TRUNCATE %s" % staging)
+                        cursor.copy_expert(
+                            "COPY %s (%s) FROM STDIN WITH (FORMAT csv)"
+                            % (staging, columns), data)
+                        if before is not None:
+                            cursor.execute(before[0])
+                            before[1]([pk for (pk, ) in cursor.fetchall()])
+                        cursor.execute(statement)
+                        if counts is not None:
+                            written = cursor.fetchall()
+                            new = sum(inserted for (_, inserted) in written)
+                            counts['new'] += new
+                            counts['changed'] += len(written) - new
+                            counts['unchanged'] += \
+                                len({item.pk for item in items}) - len(written)
+                            if on_written is not None:
+                                on_written([pk for (pk, _) in written])
+                    record_batch(self._model.__name__, len(items),
+                                 time.perf_counter() - ts)
+
+                    if self._logger:
+                        self._logger.info(
+                            "Bulk %s new batch of %s %s instances"
+                            % (action, len(items), self._model.__name__))
+            finally:
+                cursor.execute("DROP TABLE IF EXISTS %s" % staging)
+
+
+def _copy_value(value):
+    """Return the CSV field of a value prepared for the DB, an unquoted
+    empty field being NULL for COPY
+    """
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, (list, tuple)):
+        value = _array_literal(value)
+    else:
+        value = str(value)
+    return '"%s"' % value.replace('"', '""')
+
+
+def _array_literal(values):
+    """Return the postgres text representation of an array
+    """
+    elements = []
+    for value in values:
+        if value is None:
+            elements.append('NULL')
+        elif isinstance(value, (list, tuple)):
+            elements.append(_array_literal(value))
+        else:
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            elements.append('"%s"' % str(value)
+                            .replace('\\', '\\\\').replace('"', '\\"'))
+    return '{%s}' % ','.join(elements)
@@ -0,0 +1,230 @@
+import queue
+import threading
+import time
+from django.db import connections
+
+# Marks the end of the items of a queue
+_END = object()
+
+
+class _Failure:
+    """The exception of a stage, forwarded to the next ones
+    """
+
+    def __init__(self, exception):
+        self.exception = exception
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class Pipeline:
+    """A chain of processing stages run in threads connected by bounded queues
+
+    The first stage produces the items, each next stage transforms the
+    items of the previous one, and the items of the last stage are consumed
+    in the calling thread, see output. Each stage runs in its own thread so
+    that the I/O of a stage (sqlite reads, DB writes, which release the GIL)
+    overlaps the work of the others. The items go through the queues by
+    chunks, a queue holding at most maxsize chunks: a stage blocks while
+    its consumer is late, so the memory used doesn't depend on the number
+    of items.
+
+    An exception raised by a stage is forwarded down the queues and raised
+    again in the calling thread by the output iterator. Closing the
+    pipeline, at the end of its with block, cancels the stages still
+    running, joins their threads and logs the throughput of each stage.
+
+    The stage threads don't share the Django DB connection of the calling
+    thread, nor its transaction: the DB writes should be done by the
+    consumer of the output, in the calling thread.
+
+    Attributes
+    ----------
+    name: str
+        The name of the pipeline, for the logs
+    _chunk_size: int
+        The number of items put at once in the queues
+    _maxsize: int
+        The number of chunks a queue can hold
+    _logger: logging.Logger object
+        The logger of the stages stats
+    _stages: list of (str, function)
+        The name and function of each stage
+    _stats: dict
+        stage name -> dict of the items count and timings of the stage
+    _threads: list of threading.Thread
+        The threads running the stages, once started
+    _output_queue: queue.Queue
+        The queue of the items of the last stage
+    _cancelled: threading.Event
+        Set to stop the stages
+
+    Methods
+    -------
+    add(name, function)
+        Add a stage at the end of the pipeline
+    start()
+        Start the threads of the stages
+    output(name)
+        Return an iterator of the items of the last stage
+    close()
+        Cancel the running stages, join their threads and log their stats
+    """
+
+    def __init__(self, name, chunk_size=1000, maxsize=8, logger=None):
+        self.name = name
+        self._chunk_size = chunk_size
+        self._maxsize = maxsize
+        self._logger = logger
+        self._stages = []
+        self._stats = {}
+        self._threads = []
+        self._output_queue = None
+        self._cancelled = threading.Event()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, name, function):
+        """Add a stage at the end of the pipeline
+
+        The function of the first stage takes no argument, the function of
+        the other ones takes an iterator of the items of the previous
+        stage. Both return an iterable of the items of the stage.
+        """
+        if self._threads:
+            raise ValueError('The %s pipeline is already started.'
+                             % self.name)
+        self._stages.append((name, function))
+
+    def _new_stats(self, name):
+        stats = {'items': 0, 'elapsed': 0., 'input_wait': 0.,
+                 'output_wait': 0.}
+        self._stats[name] = stats
+        return stats
+
+    def start(self):
+        """Start the threads of the stages
+        """
+        if self._threads:
+            return
+        if not self._stages:
+            raise ValueError('The %s pipeline has no stage.' % self.name)
+        input_queue = None
+        for (name, function) in self._stages:
+            output_queue = queue.Queue(self._maxsize)
+            thread = threading.Thread(
+                target=self._run_stage,
+                args=(function, input_queue, output_queue,
+                      self._new_stats(name)),
+                name='%s-%s' % (self.name, name),
+                daemon=True)
+            thread.start()
+            self._threads.append(thread)
+            input_queue = output_queue
+        self._output_queue = input_queue
+
+    def output(self, name):
+        """Return an iterator of the items of the last stage, started if
+        needed
+
+        The items are consumed in the calling thread by a stage of the
+        given name, which only appears in the stats.
+        """
+        self.start()
+        stats = self._new_stats(name)
+
+        def items():
+            ts = time.perf_counter()
+            try:
+                for item in self._items(self._output_queue, stats):
+                    stats['items'] += 1
+                    yield item
+            finally:
+                stats['elapsed'] = time.perf_counter() - ts
+        return items()
+
+    def close(self):
+        """Cancel the running stages, join their threads and log their stats
+        """
+        self._cancelled.set()
+        for thread in self._threads:
+            thread.join()
+        if self._logger:
+            for (name, stats) in self._stats.items():
+                busy = max(stats['elapsed'] - stats['input_wait']
+                           - stats['output_wait'], 0.)
+                self._logger.info(
+                    '%s pipeline, %s stage: %s items in %.2fs, busy %.2fs'
+                    ' (%d items/s), waited %.2fs for input and %.2fs for'
+                    ' output'
+                    % (self.name, name, stats['items'], stats['elapsed'],
+                       busy, stats['items'] / busy if busy else 0,
+                       stats['input_wait'], stats['output_wait']))
+
+    def _put(self, output_queue, chunk, stats):
+        ts = time.perf_counter()
+        while True:
+            if self._cancelled.is_set():
+                raise _Cancelled()
+            try:
+                output_queue.put(chunk, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        stats['output_wait'] += time.perf_counter() - ts
+
+    def _items(self, input_queue, stats):
+        """Yield the items of the chunks of the queue, until its end
+        """
+        while True:
+            ts = time.perf_counter()
+            while True:
+                if self._cancelled.is_set():
+                    raise _Cancelled()
+                try:
+                    chunk = input_queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+            stats['input_wait'] += time.perf_counter() - ts
+            if chunk is _END:
+                return
+            if isinstance(chunk, _Failure):
+                raise chunk.exception
+            yield from chunk
+
+    def _run_stage(self, function, input_queue, output_queue, stats):
+        ts = time.perf_counter()
+        try:
+            if input_queue is None:
+                items = function()
+            else:
+                items = function(self._items(input_queue, stats))
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) >= self._chunk_size:
+                    self._put(output_queue, chunk, stats)
+                    stats['items'] += len(chunk)
+                    chunk = []
+            if chunk:
+                self._put(output_queue, chunk, stats)
+                stats['items'] += len(chunk)
+            self._put(output_queue, _END, stats)
+        except _Cancelled:
+            pass
+        except BaseException as ex:
+            try:
+                self._put(output_queue, _Failure(ex), stats)
+            except _Cancelled:
+                pass
+        finally:
+            stats['elapsed'] = time.perf_counter() - ts
+            # The connections a stage may have opened are its own
+            connections.close_all()
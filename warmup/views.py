@@ -1,5 +1,15 @@
+from django.conf import settings
 from django.http import HttpResponse
+from upsets.lib.containers import container_registry
+from upsets.lib.searchindex import player_search_index
+from upsets.lib.upsetgraph import upset_graph
 
 
 def appengine_warmup(request):
+    # Resolve the ready trees before the instance receives traffic
+    container_registry.refresh()
+    if player_search_index.enabled():
+        player_search_index.warmup()
+    if settings.UPSET_GRAPH_WARMUP:
+        upset_graph.warmup()
     return HttpResponse("Successfully Warmed Up.")